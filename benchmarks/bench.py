@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Conversion throughput benchmarks.
+
+Each case runs in a fresh python, so its peak RSS is its own, and the
+results are written as JSON to compare between releases:
+
+    python benchmarks/bench.py --output results.json
+    python benchmarks/bench.py --quick --case bash_parse
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+# runs from a checkout, without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from script2ansible import __version__  # noqa: E402
+from script2ansible.BashLexParser import BashLexParser  # noqa: E402
+from script2ansible.PerlParser import PerlParser  # noqa: E402
+from script2ansible.config import DEFAULT_CONFIG  # noqa: E402
+from script2ansible.generators import GeneratorFactory  # noqa: E402
+from script2ansible.processors import ScriptProcessor, SlackRoleProcessor  # noqa: E402
+
+import synthetic  # noqa: E402
+
+
+def timed(repeat, fn):
+    """
+    best of repeat runs of fn, and what it returned
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bash_parse(work_dir, repeat, commands, variables, nesting):
+    script = synthetic.bash_script(commands, variables, nesting)
+    # each repeat lexes the script again, rather than reusing its parse trees
+    config = {"parse_cache_size": 0}
+    seconds, task_container = timed(
+        repeat, lambda: BashLexParser(script_string=script, config=config).parse()
+    )
+    return seconds, len(task_container.tasks)
+
+
+def perl_parse(work_dir, repeat, ops, scripts=1, perl_workers=0):
+    config = {"perl_workers": perl_workers}
+    sources = [synthetic.perl_script(ops, seed=n) for n in range(scripts)]
+
+    def parse():
+        return sum(
+            len(PerlParser(script_string=source, config=config).parse().tasks)
+            for source in sources
+        )
+
+    return timed(repeat, parse)
+
+
+def slack_config(work_dir):
+    return {
+        **DEFAULT_CONFIG,
+        "output": os.path.join(work_dir, "ansible"),
+        "generator": "role",
+        # parsing is timed, not the parse tree cache
+        "parse_cache_size": 0,
+    }
+
+
+def slack_roles(roles_dir, config):
+    for role_name in sorted(os.listdir(roles_dir)):
+        output_dir = os.path.join(config["output"], "roles", role_name)
+        role_config = {**config, "input": roles_dir, "role_name": role_name}
+        yield os.path.join(roles_dir, role_name), output_dir, role_config
+
+
+def slack_process(work_dir, repeat, roles, subroles, files, commands, perl_ops=0):
+    roles_dir = synthetic.slack_tree(
+        work_dir, roles, subroles, files, commands, perl_ops
+    )
+    config = slack_config(work_dir)
+
+    def process():
+        # a fresh output for each repeat, so every file is staged again
+        output = tempfile.mkdtemp(prefix="ansible", dir=work_dir)
+        tasks = 0
+        for role_dir, output_dir, role_config in slack_roles(roles_dir, {**config, "output": output}):
+            processor = SlackRoleProcessor(role_dir, output_dir, role_config)
+            processor.process()
+            tasks += sum(tc.size() for tc in processor.get_tasks())
+        return tasks
+
+    return timed(repeat, process)
+
+
+def generate(work_dir, repeat, generator, commands):
+    """
+    only the generator is timed, the script is parsed beforehand
+    """
+    if generator == "role":
+        roles_dir = synthetic.slack_tree(
+            work_dir, roles=1, subroles=0, files=1, commands=commands
+        )
+        role_dir, output_dir, config = next(slack_roles(roles_dir, slack_config(work_dir)))
+        processor = SlackRoleProcessor(role_dir, output_dir, config)
+    else:
+        script = os.path.join(work_dir, "script.sh")
+        with open(script, "w") as f:
+            f.write(synthetic.bash_script(commands))
+        config = {
+            **DEFAULT_CONFIG,
+            "input": script,
+            "output": os.path.join(work_dir, "out.yml"),
+            "generator": generator,
+        }
+        processor = ScriptProcessor(script, config)
+    processor.process()
+    tasks = sum(len(tc.tasks) for tc in processor.get_tasks())
+    output_format = config.get("output_format", "yaml")
+
+    def write():
+        GeneratorFactory.build_generator(generator, processor, output_format).generate()
+        return tasks
+
+    return timed(repeat, write)
+
+
+# name: (function, arguments, arguments for --quick)
+CASES = {
+    "bash_parse_flat": (
+        bash_parse,
+        {"commands": 10000, "variables": 20, "nesting": 0},
+        {"commands": 200, "variables": 5, "nesting": 0},
+    ),
+    "bash_parse_nested": (
+        bash_parse,
+        {"commands": 10000, "variables": 200, "nesting": 4},
+        {"commands": 200, "variables": 20, "nesting": 3},
+    ),
+    "perl_parse": (
+        perl_parse,
+        {"ops": 10000},
+        {"ops": 200},
+    ),
+    "perl_parse_many": (
+        perl_parse,
+        {"ops": 50, "scripts": 100},
+        {"ops": 10, "scripts": 5},
+    ),
+    "perl_parse_many_workers": (
+        perl_parse,
+        {"ops": 50, "scripts": 100, "perl_workers": 1},
+        {"ops": 10, "scripts": 5, "perl_workers": 1},
+    ),
+    "slack_process": (
+        slack_process,
+        {"roles": 50, "subroles": 3, "files": 100, "commands": 200},
+        {"roles": 3, "subroles": 1, "files": 5, "commands": 20},
+    ),
+    "slack_process_perl": (
+        slack_process,
+        {"roles": 20, "subroles": 1, "files": 20, "commands": 100, "perl_ops": 100},
+        {"roles": 2, "subroles": 1, "files": 2, "commands": 10, "perl_ops": 10},
+    ),
+    "generate_role": (
+        generate,
+        {"generator": "role", "commands": 10000},
+        {"generator": "role", "commands": 200},
+    ),
+    "generate_role_tasks": (
+        generate,
+        {"generator": "role_tasks", "commands": 10000},
+        {"generator": "role_tasks", "commands": 200},
+    ),
+    "generate_playbook": (
+        generate,
+        {"generator": "playbook", "commands": 10000},
+        {"generator": "playbook", "commands": 200},
+    ),
+}
+
+
+def run_case(name, quick=False, repeat=3):
+    """
+    run one case in this process, returning its result
+    """
+    fn, arguments, quick_arguments = CASES[name]
+    arguments = quick_arguments if quick else arguments
+    work_dir = tempfile.mkdtemp(prefix=f"s2a_bench_{name}_")
+    try:
+        seconds, tasks = fn(work_dir, repeat, **arguments)
+    finally:
+        shutil.rmtree(work_dir)
+    # ru_maxrss is in kilobytes on linux
+    return {
+        "arguments": arguments,
+        "seconds": seconds,
+        "tasks": tasks,
+        "tasks_per_second": tasks / seconds if seconds else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def run_case_in_subprocess(name, quick, repeat):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", name, "--repeat", str(repeat)]
+    if quick:
+        cmd.append("--quick")
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1:]}
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark script2ansible conversions")
+    parser.add_argument("--case", action="append", help="run cases whose name contains CASE")
+    parser.add_argument("--quick", action="store_true", help="small inputs, a smoke test")
+    parser.add_argument("--repeat", type=int, default=3, help="best of REPEAT runs")
+    parser.add_argument("--output", help="write the results as JSON to OUTPUT")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+
+    if args.child:
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(run_case(args.child, args.quick, args.repeat)))
+        return
+
+    names = [
+        name
+        for name in CASES
+        if not args.case or any(pattern in name for pattern in args.case)
+    ]
+    results = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "libyaml": yaml.__with_libyaml__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "quick": args.quick,
+        "cases": {},
+    }
+    for name in names:
+        result = run_case_in_subprocess(name, args.quick, args.repeat)
+        results["cases"][name] = result
+        if "error" in result:
+            print(f"{name:28} failed: {result['error']}")
+            continue
+        print(
+            f"{name:28} {result['seconds']:9.3f}s {result['tasks']:8} tasks "
+            f"{result['tasks_per_second']:10.0f} tasks/s "
+            f"{result['peak_rss_kb'] / 1024:7.1f}MB peak"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if any("error" in result for result in results["cases"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Synthetic inputs for the benchmarks, generated from a seed so a given
+size is always the same script or tree
+"""
+import os
+import random
+
+BASH_COMMANDS = [
+    "touch /tmp/${var}/file{n}.txt",
+    "mkdir -p /opt/${var}/dir{n}",
+    "cp /tmp/${var}/file{n}.txt /tmp/copy{n}.txt",
+    "mv /tmp/copy{n}.txt /tmp/moved{n}.txt",
+    "ln -s /tmp/${var}/file{n}.txt /tmp/link{n}",
+    "chmod 644 /tmp/${var}/file{n}.txt",
+    "chown root:root /tmp/${var}/file{n}.txt",
+    "echo \"line {n} of ${var}\" >> /tmp/${var}/log.txt",
+    "apt install -y pkg{n}",
+    "gunzip /tmp/archive{n}.gz",
+]
+
+PERL_OPS = [
+    "mkdir '/opt/dir{n}', 0755;",
+    "rmdir '/opt/old{n}';",
+    "unlink '/tmp/file{n}.txt';",
+    "rename '/tmp/a{n}', '/tmp/b{n}';",
+    "system(\"rm '/tmp/rm{n}'\");",
+    "system('uptime');",
+    "open(my $fh{n}, '>', \"$ENV{{STAGE}}/out{n}.txt\");",
+    "File::Copy::copy('/tmp/src{n}', '/tmp/dest{n}');",
+    "make_path('/opt/path{n}/a', '/opt/path{n}/b');",
+]
+
+
+def bash_script(commands=1000, variables=20, nesting=2, seed=0):
+    """
+    a bash script of about commands commands, using variables
+    variables, with if/for blocks nested up to nesting deep,
+    so for bodies hold compound commands as well as simple ones
+    """
+    rng = random.Random(seed)
+    names = [f"VAR{i}" for i in range(max(variables, 1))]
+    lines = ["#!/bin/bash"]
+    for i, name in enumerate(names):
+        export = "export " if i % 4 == 0 else ""
+        lines.append(f"{export}{name}=value{i}")
+    blocks = []
+    for n in range(commands):
+        if len(blocks) < nesting and rng.random() < 0.05:
+            indent = "  " * len(blocks)
+            if rng.random() < 0.5:
+                lines.append(f"{indent}if [ $? -eq 0 ]; then")
+                blocks.append("fi")
+            else:
+                lines.append(f"{indent}for item{len(blocks)} in a b c; do")
+                blocks.append("done")
+        template = rng.choice(BASH_COMMANDS)
+        lines.append("  " * len(blocks) + template.format(var=rng.choice(names), n=n))
+        if blocks and rng.random() < 0.2:
+            end = blocks.pop()
+            lines.append("  " * len(blocks) + end)
+    while blocks:
+        end = blocks.pop()
+        lines.append("  " * len(blocks) + end)
+    return "\n".join(lines) + "\n"
+
+
+def perl_script(ops=1000, seed=0):
+    rng = random.Random(seed)
+    lines = [
+        "#!/usr/bin/env perl",
+        "use File::Path qw(make_path);",
+        "use File::Copy;",
+    ]
+    for n in range(ops):
+        lines.append(rng.choice(PERL_OPS).format(n=n))
+    return "\n".join(lines) + "\n"
+
+
+def slack_tree(
+    root, roles=10, subroles=2, files=20, commands=100, perl_ops=0, seed=0
+):
+    """
+    a slack roles/ directory under root, each role with a files/
+    directory and subroles files.subN, files files in each, a bash
+    preinstall and, given perl_ops, a Perl postinstall.
+    Returns the roles/ directory
+    """
+    roles_dir = os.path.join(root, "roles")
+    for r in range(roles):
+        role_dir = os.path.join(roles_dir, f"role{r}")
+        for files_dir in ["files"] + [f"files.sub{s}" for s in range(subroles)]:
+            for n in range(files):
+                file_path = os.path.join(
+                    role_dir, files_dir, "etc", f"conf{n % 5}", f"file{n}.conf"
+                )
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, "w") as f:
+                    f.write(f"setting{n} = {r}\n" * (1 + n % 10))
+        scripts_dir = os.path.join(role_dir, "scripts")
+        os.makedirs(scripts_dir, exist_ok=True)
+        with open(os.path.join(scripts_dir, "preinstall"), "w") as f:
+            f.write(bash_script(commands, variables=5, seed=seed + r))
+        if perl_ops:
+            with open(os.path.join(scripts_dir, "postinstall"), "w") as f:
+                f.write(perl_script(perl_ops, seed=seed + r))
+    return roles_dir
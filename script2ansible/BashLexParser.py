@@ -1,9 +1,14 @@
 
 from bashlex import parser, ast
+from collections import namedtuple
+from contextlib import contextmanager
+import functools
 import re
 
 from .Parser import Parser
 from .utility import TaskContainer
+from .profiling import profiled, script_size
+from .cache import ParseTreeCache
 
 # class ScopedVariables:
 #     def __init__(self, parent, context):
@@ -19,6 +24,172 @@ from .utility import TaskContainer
 #                 self.parent.pop_variable(k)
 
 
+# ${VAR}, ${VAR:-default}, ${VAR-default} or $VAR
+VARIABLE_PATTERN = re.compile(
+    r"\$\{(?P<braced>[A-Za-z_][A-Za-z0-9_]*)(?:(?P<op>:?-)(?P<default>[^{}]*))?\}"
+    r"|\$(?P<plain>\w+)"
+)
+
+# a variable reference within a word, raw is the reference as written
+VariableSegment = namedtuple("VariableSegment", ["var", "raw", "op", "default"])
+
+
+@functools.lru_cache(maxsize=4096)
+def tokenize_variables(stringy: str) -> tuple:
+    """
+    split a word into literal strings and VariableSegments, once per
+    distinct word
+    'a_${B}_c' -> ('a_', VariableSegment('B', '${B}', None, None), '_c')
+    """
+    segments = []
+    pos = 0
+    for match in VARIABLE_PATTERN.finditer(stringy):
+        if match.start() > pos:
+            segments.append(stringy[pos:match.start()])
+        var = match.group("braced") or match.group("plain")
+        segments.append(
+            VariableSegment(var, match.group(0), match.group("op"), match.group("default"))
+        )
+        pos = match.end()
+    if pos < len(stringy):
+        segments.append(stringy[pos:])
+    return tuple(segments)
+
+
+@functools.lru_cache(maxsize=4096)
+def quoted_segments(raw: str) -> tuple:
+    """
+    split a word as written into (text, quote) runs, quote being None,
+    '"' or "'", with the quotes and escaping backslashes removed
+    'a"$B c"$D' -> (('a', None), ('$B c', '"'), ('$D', None))
+    """
+    segments = []
+    text = []
+    quote = None
+    chars = iter(raw)
+    for char in chars:
+        if quote != "'" and char == "\\":
+            escaped = next(chars, "")
+            if quote is None or escaped in '"\\$`':
+                # an escaped character is as good as quoted
+                segments.append(("".join(text), quote))
+                segments.append((escaped, "'"))
+                text = []
+            else:
+                text += [char, escaped]
+        elif char == quote or (quote is None and char in "'\""):
+            segments.append(("".join(text), quote))
+            text = []
+            quote = None if char == quote else char
+        else:
+            text.append(char)
+    segments.append(("".join(text), quote))
+    return tuple(segment for segment in segments if segment[0] or segment[1])
+
+
+# argument specs of the supported commands, see CommandVisitor.process_args
+#   ov: options taking a value
+#   o: flag options
+#   sub_cmd: eg the install in 'apt install'
+COMMAND_SPECS = {
+    "cp": {
+        "ov": set(),
+        "o": {
+            "-f", "-n",
+        },
+    },
+    "mv": {
+        "ov": set(),
+        "o": {
+            "-r",
+        },
+    },
+    "ln": {
+        "ov": set(),
+        "o": {
+            "-s",
+        },
+    },
+    "ssh": {
+        "ov": set(),
+        "o": set(),
+    },
+    "scp": {
+        "ov": {
+            "-i",
+            "-P",
+        },
+        "o": {
+            "-r",
+        },
+    },
+    "chmod": {
+        "ov": set(),
+        "o": {
+            "-R",
+            "-f",
+            "-v",
+        },
+    },
+    "chown": {
+        "ov": set(),
+        "o": {
+            "-R",
+            "-f",
+            "-v",
+            "-c",
+        },
+    },
+    "umask": {
+        "ov": set(),
+        "o": set(),
+    },
+    "export": {
+        "ov": set(),
+        "o": {"-p"},
+    },
+    "mkdir": {
+        "ov": set(),
+        "o": {
+            "-p",
+        },
+    },
+    "ldconfig": {
+        "ov": set(),
+        "o": set(),
+    },
+    "gunzip": {
+        "ov": set(),
+        "o": set(),
+    },
+    "apt": {
+        "sub_cmd": {"update", "install", "upgrade"},
+        "ov": set(),
+        "o": {"-y", "update", "install", "upgrade"},  # meh
+    },
+    "apt-get": {
+        "sub_cmd": {"update", "install", "upgrade"},
+        "ov": set(),
+        "o": {"-y", "update", "install", "upgrade"},  # meh
+    },
+    "yum": {
+        "sub_cmd": {"update", "install", "upgrade"},
+        "ov": set(),
+        "o": {"-y", "update", "install", "upgrade"},  # meh
+    },
+    "echo": {
+        "ov": set(),
+        "o": {
+            "-y",
+        },
+    },
+    "touch": {
+        "ov": set(),
+        "o": {"-a", "-c"},
+    },
+}
+
+
 class CommandVisitor(ast.nodevisitor):
     def __init__(self, parent):
         self.parent = parent
@@ -114,110 +285,12 @@ class CommandVisitor(ast.nodevisitor):
         return True
 
     def process_command(self):
-
-        specs = {
-            "cp": {
-                "ov": set(),
-                "o": {
-                    "-f", "-n",
-                },
-            },
-            "mv": {
-                "ov": set(),
-                "o": {
-                    "-r",
-                },
-            },
-            "ln": {
-                "ov": set(),
-                "o": {
-                    "-s",
-                },
-            },
-            "ssh": {
-                "ov": set(),
-                "o": set(),
-            },
-            "scp": {
-                "ov": {
-                    "-i",
-                    "-P",
-                },
-                "o": {
-                    "-r",
-                },
-            },
-            "chmod": {
-                "ov": set(),
-                "o": {
-                    "-R",
-                    "-f",
-                    "-v",
-                },
-            },
-            "chown": {
-                "ov": set(),
-                "o": {
-                    "-R",
-                    "-f",
-                    "-v",
-                    "-c",
-                },
-            },
-            "umask": {
-                "ov": set(),
-                "o": set(),
-            },
-            "export": {
-                "ov": set(),
-                "o": {"-p"},
-            },
-            "mkdir": {
-                "ov": set(),
-                "o": {
-                    "-p",
-                },
-            },
-            "ldconfig": {
-                "ov": set(),
-                "o": set(),
-            },
-            "gunzip": {
-                "ov": set(),
-                "o": set(),
-            },
-            "apt": {
-                "sub_cmd": {"update", "install", "upgrade"},
-                "ov": set(),
-                "o": {"-y", "update", "install", "upgrade"},  # meh
-            },
-            "apt-get": {
-                "sub_cmd": {"update", "install", "upgrade"},
-                "ov": set(),
-                "o": {"-y", "update", "install", "upgrade"},  # meh
-            },
-            "yum": {
-                "sub_cmd": {"update", "install", "upgrade"},
-                "ov": set(),
-                "o": {"-y", "update", "install", "upgrade"},  # meh
-            },
-            "echo": {
-                "ov": set(),
-                "o": {
-                    "-y",
-                },
-            },
-            "touch": {
-                "ov": set(),
-                "o": {"-a", "-c"},
-            },
-        }
         if self.is_command:
-            if self.cmd not in specs:
+            if self.cmd not in COMMAND_SPECS:
                 # breakpoint()
                 print(f" failed to find {self.cmd}")
             else:
-                spec = specs[self.cmd]
+                spec = COMMAND_SPECS[self.cmd]
                 self.process_args(spec)
             # print(f"---- finishing {self.cmd} ")
         else:
@@ -379,16 +452,101 @@ class ForVisitor(ast.nodevisitor):
         self.state = None
         self.for_var = None
         self.loop_vars = []
+        # the nodes of the body, commands or compound commands
         self.commands = []
 
     def visitreservedword(self, n, word):
         self.state = word
         if self.state == "done":
-            for loop_var in self.loop_vars:
-                context = {}
-                context[self.for_var] = loop_var
+            values = self.get_values()
+            if not values:
+                return
+            if self.loop_safe():
+                self.emit_loop(values)
+            else:
+                self.unroll(values)
+
+    def get_values(self):
+        """
+        the values looped over, the unquoted variables in a word split as
+        bash would: for h in $HOSTS splits, for h in "$HOSTS" doesn't
+        """
+        source = getattr(self.parent.parser, "source", None)
+        values = []
+        for node in self.loop_vars:
+            if source is None:
+                values += self.split_word([(node.word, None)])
+            else:
+                values += self.split_word(quoted_segments(source[node.pos[0]:node.pos[1]]))
+        return values
+
+    def split_word(self, segments):
+        """
+        the fields of a word's (text, quote) segments, quoted text joining
+        the field it is in and unquoted variables split on whitespace
+        """
+        fields = []
+        field = None
+        for text, quote in segments:
+            if quote == "'":
+                value = text
+            else:
+                value = self.parent.interpret_variable(text)
+            if quote is not None or "$" not in text:
+                # '' and "" still make a (empty) field
+                field = (field or "") + value
+                continue
+            words = value.split()
+            if field is not None and value[:1].isspace():
+                fields.append(field)
+                field = None
+            for word in words[:-1]:
+                fields.append((field or "") + word)
+                field = None
+            if words:
+                field = (field or "") + words[-1]
+            if field is not None and value[-1:].isspace():
+                fields.append(field)
+                field = None
+        if field is not None:
+            fields.append(field)
+        return fields
+
+    def loop_safe(self):
+        """
+        whether the body can be translated once, with the loop variable as
+        {{ item }}: it is made of commands known to template their args,
+        without the variable in what they parse, and changing no state
+        """
+        for command in self.commands:
+            if command.kind != "command" or any(part.kind == "assignment" for part in command.parts):
+                return False
+            words = [part for part in command.parts if part.kind == "word"]
+            fixed = LOOP_COMMANDS.get(words[0].word) if words else None
+            if fixed is None:
+                return False
+            args = [word for word in words[1:] if not word.word.startswith("-")]
+            if any(self.uses_loop_var(word) for word in [words[0]] + args[:fixed]):
+                return False
+        return True
+
+    def uses_loop_var(self, word):
+        return any(part.kind == "parameter" and part.value == self.for_var for part in word.parts)
+
+    def emit_loop(self, values):
+        container = self.parent.container
+        start = len(container.tasks)
+        with self.parent.scoped_variable(self.for_var, "{{ item }}"):
+            for command in self.commands:
+                self.parent.visit(command)
+        for task in container.tasks[start:]:
+            task["loop"] = list(values)
+
+    def unroll(self, values):
+        for value in values:
+            with self.parent.scoped_variable(self.for_var, value):
                 for command in self.commands:
-                    self.parent.visitcommand(command, command.parts, context=context)
+                    self.parent.visit(command)
 
     def visitlist(self, n, parts):
         for part in parts:
@@ -402,16 +560,48 @@ class ForVisitor(ast.nodevisitor):
             breakpoint()  # pragma: no cover
         return False
 
+    def visit_compound(self, n, *args):
+        """
+        a compound command (if, for...) in the body is kept whole,
+        the for node being visited is descended into
+        """
+        if self.state == "do":
+            self.commands.append(n)
+            return False
+        return True
+
+    visitif = visitfor = visitwhile = visituntil = visitcompound = visitpipeline = visit_compound
+
     def visitword(self, n, word):
         if self.state == "for":
             self.for_var = word
         elif self.state == "in":
-            self.loop_vars.append(word)
+            self.loop_vars.append(n)
         else:  # pragma: no cover
             breakpoint()
             pass
 
 
+# commands whose tasks take the loop variable as {{ item }}, with the number
+# of leading args (after options) which are parsed rather than templated, so
+# must not use it. Other commands are unrolled
+LOOP_COMMANDS = {
+    "mkdir": 0,
+    "touch": 0,
+    "ln": 0,
+    "cp": 0,
+    "mv": 0,
+    "ldconfig": 0,
+    "gunzip": 0,
+    "chown": 1,
+    "chmod": 0,
+    "apt": 1,
+    "apt-get": 1,
+    "yum": 1,
+    "echo": 0,
+}
+
+
 class BashScriptVisitor(ast.nodevisitor):
     # scp_options = cv.options
     split_host_pattern = re.compile(
@@ -428,6 +618,10 @@ class BashScriptVisitor(ast.nodevisitor):
         self.parser = parser
         self.last_register = None  # Track last registered result
         self.container = TaskContainer('hmm')
+        if parser is not None:
+            # as though the script began by assigning them
+            for var, value in parser.get_env().items():
+                self.set_variable(var, value)
 
     @staticmethod
     def split_host(target):
@@ -498,42 +692,48 @@ class BashScriptVisitor(ast.nodevisitor):
             value = self.interpret_variable(value)
             self.variables[var] = value
 
-    # def push_variable(self, var: str, value: str):
-    #     """
-    #     sets a scoped variable
-    #     """
-    #     self.stack_variables[var] = value
-
-    # def pop_variable(self, var: str):
-    #     """
-    #     deletes a scoped variable
-    #     """
-    #     if var in self.stack_variables:
-    #         del self.stack_variables[var]
-
-    def interpret_variable(self, stringy: str, type: str = "interpret") -> str:
-        def replace_var(match):
-            var = match.group("var")
-            raw = match.group(0)
-            return self.get_variable(var, raw)
-
-        def jinja_var(match):
-            var = match.group("var")
-            raw = match.group(0)
-            if var in self.static_variables:
-                return f"{{{{ {var} }}}}"
+    @contextmanager
+    def scoped_variable(self, var: str, value: str):
+        """
+        var is value within, as the variable of a for loop
+        """
+        previous = self.stack_variables.get(var)
+        self.stack_variables[var] = value
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self.stack_variables[var]
             else:
-                return self.get_variable(var, raw)
-        if type == "interpret":
-            replacer = replace_var
-        elif type == "jinja":
-            replacer = jinja_var
+                self.stack_variables[var] = previous
 
-        # Replace ${VAR} style
-        stringy = re.sub(r"\$\{(?P<var>[A-Za-z_][A-Za-z0-9_]*)\}", replacer, stringy)
+    def interpret_variable(self, stringy: str, type: str = "interpret") -> str:
+        """
+        render the variables in a word, in a single pass
+        type:
+          interpret: replace variables with their values
+          jinja: as interpret, but exported variables become jinja templates
+        unknown variables are left as written
+        """
+        segments = tokenize_variables(stringy)
+        if len(segments) == 1 and isinstance(segments[0], str):
+            return segments[0]
+        jinja = type == "jinja"
+        return "".join(
+            segment if isinstance(segment, str) else self.render_variable(segment, jinja)
+            for segment in segments
+        )
 
-        # Replace $VAR style (only if followed by non-word char or end-of-line)
-        return re.sub(r"\$(?P<var>\w+)\b", replacer, stringy)
+    def render_variable(self, segment: VariableSegment, jinja: bool) -> str:
+        if jinja and segment.var in self.static_variables:
+            return f"{{{{ {segment.var} }}}}"
+        if segment.op is None:
+            return self.get_variable(segment.var, segment.raw)
+        value = self.get_variable(segment.var)
+        # ${VAR-default} when unset, ${VAR:-default} when unset or empty
+        if value is None or (value == "" and segment.op == ":-"):
+            return self.interpret_variable(segment.default, type="jinja" if jinja else "interpret")
+        return value
 
     def visitassignment(self, n, parts):
         breakpoint()
@@ -546,259 +746,297 @@ class BashScriptVisitor(ast.nodevisitor):
         # scoped_vars = ScopedVariables(self, context)  # noqa: F841
         cv = CommandVisitor(self)
         cv.visit(n)
-        if "umask" == cv.cmd:
-            self.current_umask = self.interpret_variable(cv.args[0])
-            return False
-        elif "export" == cv.cmd:
-            # ['foo=wibble']
-            arg = cv.args[0]
-            if "=" in arg:
-                var, val = arg.split("=", 1)
-                self.set_variable(var, val, export=True)
-            else:
-                breakpoint()
-                pass
-        elif "mkdir" == cv.cmd:
-            arg_path = cv.args[0]
-            mode = self.umask_to_mode(is_dir=True)
-            path = self.interpret_variable(arg_path)
-            self.container.add_task(
-                {
-                    "name": f"Ensure directory {path} exists",
-                    "ansible.builtin.file": {
-                        "path": path,
-                        "state": "directory",
-                        "mode": mode,
-                    },
-                    "register": self.get_register_name("mkdir"),
-                }
-            )
-        elif "touch" == cv.cmd:
-            arg_path = cv.args[0]
-            mode = self.umask_to_mode(is_dir=False)
-            path = self.interpret_variable(arg_path, type='jinja')
-            self.container.add_task(
-                {
-                    "name": f"Ensure file {path} exists",
-                    "ansible.builtin.file": {
-                        "path": path,
-                        "state": "touch",
-                        "mode": mode,
-                    },
-                    "register": self.get_register_name("touch_file"),
-                }
-            )
-        elif "ln" == cv.cmd:
-            is_symlink = "-s" in cv.options
-            src = self.interpret_variable(cv.args[0])
-            dest = self.interpret_variable(cv.args[1])
-            # TODO directory?
-            mode = self.umask_to_mode(is_dir=False)
-            self.container.add_task(
-                {
-                    "name": f"Create {'symlink' if is_symlink else 'hard link'} {dest} → {src}",
-                    "ansible.builtin.file": {
-                        "src": src,
-                        "dest": dest,
-                        "state": "link" if is_symlink else "hard",
-                        "mode": mode,
-                    },
-                    "register": self.get_register_name("ln"),
-                }
-            )
-        elif "cp" == cv.cmd:
-            src = self.interpret_variable(cv.args[0])
-            dest = self.interpret_variable(cv.args[1])
+        handler = self.command_handlers.get(cv.cmd)
+        if handler is not None:
+            handler(self, cv)
+        return False
+
+    def command_umask(self, cv):
+        self.current_umask = self.interpret_variable(cv.args[0])
+
+    def command_export(self, cv):
+        # ['foo=wibble']
+        arg = cv.args[0]
+        if "=" in arg:
+            var, val = arg.split("=", 1)
+            self.set_variable(var, val, export=True)
+        else:
+            breakpoint()
+            pass
+
+    def command_mkdir(self, cv):
+        arg_path = cv.args[0]
+        mode = self.umask_to_mode(is_dir=True)
+        path = self.interpret_variable(arg_path)
+        self.container.add_task(
+            {
+                "name": f"Ensure directory {path} exists",
+                "ansible.builtin.file": {
+                    "path": path,
+                    "state": "directory",
+                    "mode": mode,
+                },
+                "register": self.get_register_name("mkdir"),
+            }
+        )
+
+    def command_touch(self, cv):
+        arg_path = cv.args[0]
+        mode = self.umask_to_mode(is_dir=False)
+        path = self.interpret_variable(arg_path, type='jinja')
+        self.container.add_task(
+            {
+                "name": f"Ensure file {path} exists",
+                "ansible.builtin.file": {
+                    "path": path,
+                    "state": "touch",
+                    "mode": mode,
+                },
+                "register": self.get_register_name("touch_file"),
+            }
+        )
+
+    def command_ln(self, cv):
+        is_symlink = "-s" in cv.options
+        src = self.interpret_variable(cv.args[0])
+        dest = self.interpret_variable(cv.args[1])
+        # TODO directory?
+        mode = self.umask_to_mode(is_dir=False)
+        self.container.add_task(
+            {
+                "name": f"Create {'symlink' if is_symlink else 'hard link'} {dest} → {src}",
+                "ansible.builtin.file": {
+                    "src": src,
+                    "dest": dest,
+                    "state": "link" if is_symlink else "hard",
+                    "mode": mode,
+                },
+                "register": self.get_register_name("ln"),
+            }
+        )
+
+    def command_cp(self, cv):
+        src = self.interpret_variable(cv.args[0])
+        dest = self.interpret_variable(cv.args[1])
+        self.container.add_task(
+            {
+                "name": f"Copy {src} to {dest}",
+                "ansible.builtin.copy": {
+                    "src": src,
+                    "dest": dest,
+                    "remote_src": False,
+                },
+                "register": self.get_register_name("copy_file"),
+            }
+        )
+
+    def command_scp(self, cv):
+        scp_src = self.split_host(cv.args[0])
+        # NOTE scp '-r'      Recursively copy entire directories.  Note that scp follows symbolic links encountered in the tree traversal.
+        # NOTE ansible.builtin.copy 'src'
+        # If path is a directory, it is copied recursively. In this case,
+        # if path ends with /, only inside contents of that directory are copied to
+        # destination. Otherwise, if it does not end with /, the directory itself
+        # with all contents is copied. This behavior is similar to the rsync command line tool.
+        scp_dest = self.split_host(cv.args[1])
+
+        # TODO compare and contrast:
+        # self.pull &&
+        # scp_src['remote_host']
+        # scp_dest['remote_host']
+        # and look at options
+        validate_request = {"op": "scp"}
+        if bool(scp_src.get("host")):
+            validate_request["src_host"] = True
+        if bool(scp_dest.get("host")):
+            validate_request["dest_host"] = True
+
+        validate_response = self.parser.validate_command(validate_request)
+        if "accept" == validate_response["status"]:
             self.container.add_task(
                 {
-                    "name": f"Copy {src} to {dest}",
+                    "name": f"Scp {scp_src['path']} to {scp_dest['path']}",
                     "ansible.builtin.copy": {
-                        "src": src,
-                        "dest": dest,
+                        "src": scp_src["path"],
+                        "dest": scp_dest["path"],
                         "remote_src": False,
                     },
-                    "register": self.get_register_name("copy_file"),
+                    "register": self.get_register_name(cv.cmd),
                 }
             )
-        elif "scp" == cv.cmd:
-            scp_src = self.split_host(cv.args[0])
-            # NOTE scp '-r'      Recursively copy entire directories.  Note that scp follows symbolic links encountered in the tree traversal.
-            # NOTE ansible.builtin.copy 'src'
-            # If path is a directory, it is copied recursively. In this case,
-            # if path ends with /, only inside contents of that directory are copied to
-            # destination. Otherwise, if it does not end with /, the directory itself
-            # with all contents is copied. This behavior is similar to the rsync command line tool.
-            scp_dest = self.split_host(cv.args[1])
-
-            # TODO compare and contrast:
-            # self.pull &&
-            # scp_src['remote_host']
-            # scp_dest['remote_host']
-            # and look at options
-            validate_request = {"op": "scp"}
-            if bool(scp_src.get("host")):
-                validate_request["src_host"] = True
-            if bool(scp_dest.get("host")):
-                validate_request["dest_host"] = True
-
-            validate_response = self.parser.validate_command(validate_request)
-            if "accept" == validate_response["status"]:
-                self.container.add_task(
-                    {
-                        "name": f"Scp {scp_src['path']} to {scp_dest['path']}",
-                        "ansible.builtin.copy": {
-                            "src": scp_src["path"],
-                            "dest": scp_dest["path"],
-                            "remote_src": False,
-                        },
-                        "register": self.get_register_name(cv.cmd),
-                    }
-                )
-            else:
-                print(f"scp skipping command {cv.cmd}")
-        elif "mv" == cv.cmd:
-            # breakpoint()
-            src = self.interpret_variable(cv.args[0])
-            dest = self.interpret_variable(cv.args[1])
-            command_str = f"mv {src} {dest}"
+        else:
+            print(f"scp skipping command {cv.cmd}")
+
+    def command_mv(self, cv):
+        # breakpoint()
+        src = self.interpret_variable(cv.args[0])
+        dest = self.interpret_variable(cv.args[1])
+        command_str = f"mv {src} {dest}"
+        self.container.add_task(
+            {
+                "name": f"Run shell command: {command_str}",
+                "shell": command_str,
+                "creates": dest,
+                "removes": src,
+                "register": self.get_register_name("mv"),
+            }
+        )
+
+    def command_ldconfig(self, cv):
+        reg_name = self.get_register_name("ldconfig")
+        self.container.add_task(
+            {
+                "name": "Run ldconfig",
+                "ansible.builtin.command": "ldconfig",
+                "register": reg_name,
+                "changed_when": f"'changed' in {reg_name}.stdout or 'updated' in {reg_name}.stdout",
+            }
+        )
+
+    def command_gunzip(self, cv):
+        path = self.interpret_variable(cv.args[0])
+        self.container.add_task(
+            {
+                "name": f"Extract GZ archive {path}",
+                "ansible.builtin.unarchive": {
+                    "src": path,
+                    "remote_src": False,
+                    "dest": "/tmp",
+                },
+                "register": self.get_register_name("extract_gz"),
+            }
+        )
+
+    def command_chown(self, cv):
+        (owner, group) = self.interpret_variable(cv.args[0]).split(":")
+        path = self.interpret_variable(cv.args[1])
+        recursive = "-R" in cv.options
+        task = {
+            "name": f"Set owner: group of {owner} :{group}"
+            + (" recursively" if recursive else ""),
+            "ansible.builtin.file": {"path": path, "owner": owner, "group": group},
+            "register": self.get_register_name(
+                "chown" + ("_recursive" if recursive else "")
+            ),
+        }
+        if recursive:
+            task["ansible.builtin.file"]["recurse"] = True
+        self.container.add_task(task)
+
+    def command_chmod(self, cv):
+        mode = self.interpret_variable(cv.args[0])
+        path = self.interpret_variable(cv.args[1])
+        # n_num = re.match(f"(?P<mode>\d+)", mode, )
+        # m_sym = re.match(r"(?P<mode>[ugoa]+[+-=][rwx]+)", mode, )
+        recursive = "-R" in cv.options
+        task = {
+            "name": f"Set permissions of {path} to {mode}"
+            + (" recursively" if recursive else ""),
+            "ansible.builtin.file": {"path": path, "mode": mode},
+            "register": self.get_register_name(
+                "file_permissions" + ("_recursive" if recursive else "")
+            ),
+        }
+        if recursive:
+            task["ansible.builtin.file"]["recurse"] = True
+        self.container.add_task(task)
+
+    def command_package(self, cv):
+        """
+        apt, apt-get and yum
+        """
+        ans_builtin = "yum" if cv.cmd == "yum" else "apt"
+        sub_command = cv.sub_cmd
+        if sub_command == "update":
             self.container.add_task(
                 {
-                    "name": f"Run shell command: {command_str}",
-                    "shell": command_str,
-                    "creates": dest,
-                    "removes": src,
-                    "register": self.get_register_name("mv"),
+                    "name": "Update APT package cache",
+                    f"ansible.builtin.{ans_builtin}": {"update_cache": True},
+                    "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
                 }
             )
-        elif "ldconfig" == cv.cmd:
-            reg_name = self.get_register_name("ldconfig")
+        elif sub_command == "upgrade":
             self.container.add_task(
                 {
-                    "name": "Run ldconfig",
-                    "ansible.builtin.command": "ldconfig",
-                    "register": reg_name,
-                    "changed_when": f"'changed' in {reg_name}.stdout or 'updated' in {reg_name}.stdout",
+                    "name": "Upgrade all packages",
+                    f"ansible.builtin.{ans_builtin}": {"upgrade": "dist"},
+                    "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
                 }
             )
-        elif "gunzip" == cv.cmd:
-            path = self.interpret_variable(cv.args[0])
+        elif sub_command == "install":
+            packages = " ".join(self.interpret_variable(arg) for arg in cv.args)
             self.container.add_task(
                 {
-                    "name": f"Extract GZ archive {path}",
-                    "ansible.builtin.unarchive": {
-                        "src": path,
-                        "remote_src": False,
-                        "dest": "/tmp",
+                    "name": f"Install packages: {packages}",
+                    f"ansible.builtin.{ans_builtin}": {
+                        "name": packages,
+                        "state": "present",
+                        "update_cache": True,
                     },
-                    "register": self.get_register_name("extract_gz"),
+                    "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
                 }
             )
-        elif "chown" == cv.cmd:
-            (owner, group) = cv.args[0].split(":")
-            path = self.interpret_variable(cv.args[1])
-            recursive = "-R" in cv.options
-            task = {
-                "name": f"Set owner: group of {owner} :{group}"
-                + (" recursively" if recursive else ""),
-                "ansible.builtin.file": {"path": path, "owner": owner, "group": group},
-                "register": self.get_register_name(
-                    "chown" + ("_recursive" if recursive else "")
-                ),
-            }
-            if recursive:
-                task["ansible.builtin.file"]["recurse"] = True
-            self.container.add_task(task)
-        elif "chmod" == cv.cmd:
-            mode = self.interpret_variable(cv.args[0])
-            path = self.interpret_variable(cv.args[1])
-            # n_num = re.match(f"(?P<mode>\d+)", mode, )
-            # m_sym = re.match(r"(?P<mode>[ugoa]+[+-=][rwx]+)", mode, )
-            recursive = "-R" in cv.options
-            task = {
-                "name": f"Set permissions of {path} to {mode}"
-                + (" recursively" if recursive else ""),
-                "ansible.builtin.file": {"path": path, "mode": mode},
-                "register": self.get_register_name(
-                    "file_permissions" + ("_recursive" if recursive else "")
-                ),
-            }
-            if recursive:
-                task["ansible.builtin.file"]["recurse"] = True
-            self.container.add_task(task)
-        elif cv.cmd in ("apt", "apt-get", "yum"):
-            ans_builtin = "yum" if cv.cmd == "yum" else "apt"
-            sub_command = cv.sub_cmd
-            if sub_command == "update":
-                self.container.add_task(
-                    {
-                        "name": "Update APT package cache",
-                        f"ansible.builtin.{ans_builtin}": {"update_cache": True},
-                        "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
-                    }
-                )
-            elif sub_command == "upgrade":
-                self.container.add_task(
-                    {
-                        "name": "Upgrade all packages",
-                        f"ansible.builtin.{ans_builtin}": {"upgrade": "dist"},
-                        "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
-                    }
-                )
-            elif sub_command == "install":
-                packages = " ".join(cv.args)
+
+    def command_echo(self, cv):
+        text = self.interpret_variable(cv.args[0])
+        if cv.redir_type in (">", ">>"):
+            redir_type = cv.redir_type
+            redir_file = self.interpret_variable(cv.redir_file)
+            if redir_type == ">":
                 self.container.add_task(
                     {
-                        "name": f"Install packages: {packages}",
-                        f"ansible.builtin.{ans_builtin}": {
-                            "name": packages,
-                            "state": "present",
-                            "update_cache": True,
+                        "name": f"Write text to {redir_file}",
+                        "ansible.builtin.copy": {
+                            "dest": redir_file,
+                            "content": text,
                         },
-                        "register": self.get_register_name(f"{cv.cmd}_{sub_command}"),
+                        "register": self.get_register_name("echo_redirect"),
                     }
                 )
-        elif "echo" == cv.cmd:
-            text = cv.args[0]
-            if cv.redir_type in (">", ">>"):
-                redir_type = cv.redir_type
-                redir_file = self.interpret_variable(cv.redir_file)
-                if redir_type == ">":
-                    self.container.add_task(
-                        {
-                            "name": f"Write text to {redir_file}",
-                            "ansible.builtin.copy": {
-                                "dest": redir_file,
-                                "content": text,
-                            },
-                            "register": self.get_register_name("echo_redirect"),
-                        }
-                    )
-                else:  # >>
-                    mode = self.umask_to_mode(is_dir=False)
-                    self.container.add_task(
-                        {
-                            "name": self.interpret_variable(
-                                f"Append text to {redir_file}"
-                            ),
-                            "ansible.builtin.lineinfile": {
-                                "path": redir_file,
-                                "line": text,
-                                "create": True,
-                                "insertafter": "EOF",
-                                "mode": mode,
-                            },
-                            "register": self.get_register_name("echo_redirect_append"),
-                        }
-                    )
-            else:
-                text = self.interpret_variable(text)
+            else:  # >>
+                mode = self.umask_to_mode(is_dir=False)
                 self.container.add_task(
                     {
-                        "name": f"Echo text: {text}",
-                        "ansible.builtin.debug": {"msg": text},
+                        "name": self.interpret_variable(
+                            f"Append text to {redir_file}"
+                        ),
+                        "ansible.builtin.lineinfile": {
+                            "path": redir_file,
+                            "line": text,
+                            "create": True,
+                            "insertafter": "EOF",
+                            "mode": mode,
+                        },
+                        "register": self.get_register_name("echo_redirect_append"),
                     }
                 )
-        return False
+        else:
+            self.container.add_task(
+                {
+                    "name": f"Echo text: {text}",
+                    "ansible.builtin.debug": {"msg": text},
+                }
+            )
+
+    # command name -> handler(visitor, cv), extend with register_command()
+    command_handlers = {
+        "umask": command_umask,
+        "export": command_export,
+        "mkdir": command_mkdir,
+        "touch": command_touch,
+        "ln": command_ln,
+        "cp": command_cp,
+        "scp": command_scp,
+        "mv": command_mv,
+        "ldconfig": command_ldconfig,
+        "gunzip": command_gunzip,
+        "chown": command_chown,
+        "chmod": command_chmod,
+        "apt": command_package,
+        "apt-get": command_package,
+        "yum": command_package,
+        "echo": command_echo,
+    }
 
     def visitif(self, n, parts):
         # Only support two forms:
@@ -847,6 +1085,39 @@ class BashScriptVisitor(ast.nodevisitor):
     def visitfor(self, n, parts):
         for_visitor = ForVisitor(self)
         for_visitor.visit(n)
+        return False
+
+
+def register_command(name, handler=None, spec=None):
+    """
+    Register a handler translating the bash command 'name' into tasks.
+
+    handler(visitor, cv) is called with the BashScriptVisitor and the
+    CommandVisitor holding the parsed cmd, sub_cmd, args and options.
+    spec is the argument spec (see COMMAND_SPECS), defaulting to no options.
+
+    Usable as a decorator:
+
+        @register_command("rm", spec={"ov": set(), "o": {"-r", "-f"}})
+        def command_rm(visitor, cv):
+            ...
+    """
+    if handler is None:
+        return lambda handler: register_command(name, handler, spec)
+    COMMAND_SPECS[name] = spec if spec is not None else {"ov": set(), "o": set()}
+    BashScriptVisitor.command_handlers[name] = handler
+    return handler
+
+
+# the first line which isn't blank or a comment
+COMMAND_LINE_PATTERN = re.compile(r"^[ \t]*[^\s#]", re.MULTILINE)
+
+
+def is_blank(source):
+    """
+    nothing but blank lines and comments
+    """
+    return COMMAND_LINE_PATTERN.search(source) is None
 
 
 class BashLexParser(Parser):
@@ -854,23 +1125,56 @@ class BashLexParser(Parser):
         super().__init__(
             file_path=file_path, config=config, script_string=script_string
         )
+        # the script last parsed, which node positions index
+        self.source = None
 
-    def parse(self):
+    @profiled("bash_lex", size=script_size)
+    def parse_trees(self):
         """
         https://github.com/idank/bashlex/blob/master/examples/commandsubstitution-remover.py
+        The script is parsed as written, so node positions are those in
+        the file, the environment is seeded into the visitor
         """
-        tasks = []
-        source = ''
-        for k, v in self.get_env().items():
-            source += f'{k}="{v}"\n'
         if self.file_path:
             with open(self.file_path, "r") as file:
-                source += file.read()
+                source = file.read()
         else:
-            source += self.script_string
-        trees = parser.parse(source)
-
+            source = self.script_string
+        self.source = source
+        if is_blank(source):
+            # bashlex can't parse a script without a command
+            return []
+        cache = ParseTreeCache.from_config(self.config)
+        if cache is None:
+            return parser.parse(source)
+        return cache.parse(source, parser.parse)
+
+    @profiled("parse_bash", size=script_size)
+    def parse(self):
+        tasks = []
         visitor = BashScriptVisitor(tasks, self)
-        for tree in trees:
+        for tree in self.parse_trees():
             visitor.visit(tree)
         return visitor.container
+
+    @profiled("parse_bash", size=script_size)
+    def stream(self):
+        """
+        the script is lexed up front, but each top level command is only
+        visited, and its tasks produced, as the container is written
+        """
+        trees = self.parse_trees()
+        visitor = BashScriptVisitor([], self)
+        task_container = TaskContainer(visitor.container.name)
+        # exported variables are added as the commands are visited
+        task_container.variables = visitor.container.variables
+        task_container.stream(self.iter_tasks(visitor, trees))
+        return task_container
+
+    @staticmethod
+    def iter_tasks(visitor, trees):
+        for tree in trees:
+            visitor.visit(tree)
+            tasks = visitor.container.tasks
+            visitor.container.clear_tasks()
+            yield from tasks
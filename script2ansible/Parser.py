@@ -19,6 +19,14 @@ class Parser:
             "Subclasses should implement this method to parse the script."
         )
 
+    def stream(self):
+        """
+        As parse(), but the returned TaskContainer may produce its tasks
+        lazily as they are written (see TaskContainer.stream).
+        Parsers which can translate incrementally override this
+        """
+        return self.parse()
+
     def get_register_name(self, name):
         """Generate a unique register name for Ansible."""
         if "role_name" in self.config:
@@ -3,12 +3,15 @@ import json
 import os
 import subprocess
 import sys
+import tempfile
 import yaml
 import re
 from pathlib import Path
 import logging
 from .Parser import Parser
 from .utility import TaskContainer
+from .profiling import profiled, script_size
+from .workers import get_pool
 
 
 class PerlParser(Parser):
@@ -20,14 +23,28 @@ use Env;
 use JSON;
 use IO::File;
 
-my @OPS;
+# ops are written as JSON lines, as they happen, to the fd
+# given in S2A_OPS_FD, or else STDOUT
+our $OPS_FH;
+BEGIN {
+    if (defined $ENV{S2A_OPS_FD}) {
+        CORE::open($OPS_FH, '>&=', delete $ENV{S2A_OPS_FD})
+            or die "Cannot open ops fd: $!";
+    } else {
+        CORE::open($OPS_FH, '>&', \*STDOUT) or die "Cannot dup STDOUT: $!";
+    }
+}
+sub record_op {
+    my ($op) = @_;
+    print $OPS_FH encode_json($op), "\n";
+}
 sub log_task {
     my ($type, $refdata) = @_;
-        push @OPS, { type => $type, data => $refdata };
+        record_op({ type => $type, data => $refdata });
 }
 sub log_op {
     my ($type, %data) = @_;
-        push @OPS, { type => $type, %data };
+        record_op({ type => $type, %data });
 }
 
 # Wrap file operations
@@ -161,12 +178,51 @@ BEGIN {
         #return $res;
     };
 }
-
-END {
-    my $json = encode_json(\@OPS);
-    my $fh = IO::File->new("/tmp/ops_log.json", "w");
-    print $fh $json;
-    $fh->close;
+"""
+    # appended to the instrumentation in place of a script, see workers.py
+    WORKER_CODE = r"""
+# ---------- worker loop ----------
+# Each request is a JSON line on STDIN: {name, code, env}. The script is
+# run in a forked child, which streams its ops, warnings and any error
+# back as JSON lines; the worker then adds a done record with the status.
+# The overridden builtins are avoided here, hence CORE::open
+{
+    # started without S2A_OPS_FD, so ops already go to the real STDOUT
+    my $PROTO = $OPS_FH;
+    CORE::open(STDOUT, '>', '/dev/null') or die "Cannot reopen STDOUT: $!";
+    $PROTO->autoflush(1);
+    print $PROTO encode_json({ ready => 1 }), "\n";
+    while (my $line = <STDIN>) {
+        my $request = decode_json($line);
+        my $pid = fork();
+        die "Cannot fork: $!" unless defined $pid;
+        if (!$pid) {
+            # closing resets $., which would otherwise be quoted in die messages
+            CORE::close(STDIN);
+            CORE::open(STDIN, '<', '/dev/null');
+            CORE::open(STDERR, '>', '/dev/null');
+            $PROTO->autoflush(0);
+            # the one-shot script sees bytes, so this should too
+            my $code = $request->{code};
+            utf8::encode($code);
+            my %env = %{ $request->{env} };
+            utf8::encode($_) for values %env;
+            %ENV = %env;
+            $0 = $request->{name};
+            $SIG{__WARN__} = sub { print $PROTO encode_json({ warning => $_[0] }), "\n" };
+            eval "package main;\n#line 1 \"$request->{name}\"\n$code\n";
+            if ($@) {
+                # the exit status die would have given
+                my $status = ($! + 0) || ($? >> 8) || 255;
+                print $PROTO encode_json({ error => "$@" }), "\n";
+                exit $status;
+            }
+            exit 0;
+        }
+        waitpid($pid, 0);
+        my $status = $? & 127 ? 128 + ($? & 127) : $? >> 8;
+        print $PROTO encode_json({ done => 1, status => $status }), "\n";
+    }
 }
 """
 
@@ -174,25 +230,27 @@ END {
         super().__init__(
             file_path=file_path, config=config, script_string=script_string
         )
-        if self.file_path:
-            original = Path(self.file_path)
-            self.instrumented_path = original.parent / "instrumented.pl"
-        else:
-            self.instrumented_path = Path("/tmp/instrumented.pl")
-        # self.log_path = original.parent / "ops_log.json"
-        self.log_path = "/tmp/ops_log.json"
+        # a uniquely named instrumented.pl is written for each run
+        self.instrumented_path = None
         self.INSTRUMENTATION_CODE_CUSTOM = config.get("perl_custom", "")
         self.process_instrumentation()
 
-    def parse(self):
-        logging.info("Generating instrumented Perl script...")
-        self.generate_instrumented_perl()
-        logging.info(f"Running instrumented Perl script {self.instrumented_path}... ")
-        output_lines = self.run_instrumented()
-
-        logging.info("Perl script output:")
+    def run(self):
+        """
+        run the instrumented script, yielding its ops as they are logged
+        """
+        perl_workers = self.config.get("perl_workers", 0)
+        if perl_workers:
+            status, stderr = yield from self.run_in_worker(perl_workers)
+        else:
+            status, stderr = yield from self.run_instrumented()
+        if 0 != status:
+            logging.error(f" failed with {status} {stderr}")
+            raise RuntimeError(f" failed with {status} {stderr}")
 
-        ops = self.load_ops_log()
+    @profiled("parse_perl", size=script_size)
+    def parse(self):
+        ops = self.run()
         taskcontainer = TaskContainer('hmmmmm2')
         taskcontainer.tasks = self.ops_to_ansible_tasks(ops)
         logging.info(f"Parsed {len(taskcontainer.tasks)} Ansible tasks from Perl ops log.")
@@ -203,6 +261,16 @@ END {
         # with open("ansible_tasks.yml", "w") as f:
         #     yaml.safe_dump(self.tasks, f, sort_keys=False)
 
+    @profiled("parse_perl", size=script_size)
+    def stream(self):
+        """
+        as parse(), but ops are mapped to tasks as the container is written
+        """
+        ops = self.run()
+        taskcontainer = TaskContainer('hmmmmm2')
+        taskcontainer.stream(self.iter_ansible_tasks(ops))
+        return taskcontainer
+
     def process_instrumentation(self):
         # find all package declarations in instrumentation_code
         self.instrumentation_code = (
@@ -237,44 +305,89 @@ END {
         preprocessed_code = "\n".join(commented_lines)
         return preprocessed_code
 
-    # ---------- Step 1: Generate instrumented.pl ----------
-    def generate_instrumented_perl(self):
-
+    def read_code(self):
         if self.file_path:
             with open(self.file_path, "r") as file:
                 original_code = file.read()
         else:
             original_code = self.script_string
 
-        preprocessed_code = self.preprocess_code(original_code)
+        return self.preprocess_code(original_code)
+
+    # ---------- Step 1: Generate instrumented.pl ----------
+    def generate_instrumented_perl(self):
+        preprocessed_code = self.read_code()
 
         self.instrumented_code = self.instrumentation_code + "\n" + preprocessed_code
 
-        with open(self.instrumented_path, "w") as f:
+        # next to the script, named so concurrent conversions don't collide
+        script_dir = Path(self.file_path).parent if self.file_path else None
+        fd, self.instrumented_path = tempfile.mkstemp(
+            prefix="instrumented_", suffix=".pl", dir=script_dir
+        )
+        with os.fdopen(fd, "w") as f:
             f.write(self.instrumented_code)
 
-    # ---------- Step 2: Run instrumented.pl and capture output ----------
+    # ---------- Step 2: Run instrumented.pl, reading its ops ----------
     def run_instrumented(self):
+        """
+        yields the ops read from a pipe, as the script logs them,
+        returns (exit status, stderr)
+        stdout and stderr go to files, so a chatty script can't block
+        """
+        logging.info("Generating instrumented Perl script...")
+        self.generate_instrumented_perl()
+        logging.info(f"Running instrumented Perl script {self.instrumented_path}... ")
         cmd = ["perl", self.instrumented_path]
-        env = os.environ | self.get_env()
+        read_fd, write_fd = os.pipe()
+        env = self.get_env() | {"S2A_OPS_FD": str(write_fd)}
+        process = None
+        try:
+            with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+                try:
+                    process = subprocess.Popen(
+                        cmd, stdout=stdout, stderr=stderr, env=env, pass_fds=(write_fd,)
+                    )
+                finally:
+                    os.close(write_fd)
+                with open(read_fd, "r") as ops_log:
+                    for line in ops_log:
+                        yield json.loads(line)
+                returncode = process.wait()
+                stdout.seek(0)
+                logging.debug(f"Perl script output: {stdout.read().decode(errors='replace')}")
+                stderr.seek(0)
+                return returncode, stderr.read().decode(errors="replace")
+        finally:
+            if process is None:
+                os.close(read_fd)
+            elif process.poll() is None:
+                # abandoned part way through
+                process.kill()
+                process.wait()
+            os.remove(self.instrumented_path)
+
+    def run_in_worker(self, perl_workers):
+        """
+        as run_instrumented(), but in a persistent worker, which has
+        already compiled the instrumentation, rather than a fresh perl
+        """
         env = self.get_env()
-        result = subprocess.run(cmd, capture_output=True, text=True, env=env)
-        stdout_lines = result.stdout.splitlines()
-        if 0 != result.returncode:
-            logging.error(f" failed with {result.returncode} {result.stderr}")
-            raise RuntimeError(f" failed with {result.returncode} {result.stderr}")
-        return stdout_lines
-
-    # ---------- Step 3: Load JSON log ----------
-    def load_ops_log(self):
-        if not os.path.exists(self.log_path):
-            raise FileNotFoundError(f"Log file {self.log_path} not found")
-        with open(self.log_path, "r") as f:
-            return json.load(f)
-
-    # ---------- Step 4: Map ops to Ansible tasks ----------
+        pool = get_pool(
+            self.instrumentation_code + "\n" + self.WORKER_CODE, env, perl_workers
+        )
+        name = str(self.file_path) if self.file_path else "-"
+        logging.info(f"Running {name} in a Perl worker... ")
+        return (yield from pool.run(name, self.read_code(), env))
+
+    # ---------- Step 3: Map ops to Ansible tasks ----------
     def ops_to_ansible_tasks(self, ops):
-        tasks = []
+        return list(self.iter_ansible_tasks(ops))
+
+    def iter_ansible_tasks(self, ops):
+        """
+        yield the tasks for each op in turn
+        """
         for op in ops:
             t = op.get("type")
             d = op
@@ -282,59 +395,49 @@ END {
             if t == "file_open":
                 mode = "".join(str(m) for m in d.get("mode", []))
                 if any(m in mode for m in ["w", "a", "+"]):
-                    tasks.append(
-                        {
-                            "name": f"Ensure file {d.get('file')} exists",
-                            "ansible.builtin.file": {
-                                "path": d.get("file"),
-                                "state": "touch",
-                            },
-                        }
-                    )
-
-            elif t == "mkdir":
-                tasks.append(
-                    {
-                        "name": f"Create directory {d.get('dir')}",
+                    yield {
+                        "name": f"Ensure file {d.get('file')} exists",
                         "ansible.builtin.file": {
-                            "path": d.get("dir"),
-                            "state": "directory",
-                            **({"mode": str(oct(d["mode"]))} if d.get("mode") else {}),
+                            "path": d.get("file"),
+                            "state": "touch",
                         },
                     }
-                )
+
+            elif t == "mkdir":
+                yield {
+                    "name": f"Create directory {d.get('dir')}",
+                    "ansible.builtin.file": {
+                        "path": d.get("dir"),
+                        "state": "directory",
+                        **({"mode": str(oct(d["mode"]))} if d.get("mode") else {}),
+                    },
+                }
 
             elif t == "rmdir":
-                tasks.append(
-                    {
-                        "name": f"Remove directory {d.get('dir')}",
-                        "ansible.builtin.file": {
-                            "path": d.get("dir"),
-                            "state": "absent",
-                        },
-                    }
-                )
+                yield {
+                    "name": f"Remove directory {d.get('dir')}",
+                    "ansible.builtin.file": {
+                        "path": d.get("dir"),
+                        "state": "absent",
+                    },
+                }
 
             elif t == "file_delete":
                 for f in d.get("files", []):
-                    tasks.append(
-                        {
-                            "name": f"Delete file {f}",
-                            "ansible.builtin.file": {"path": f, "state": "absent"},
-                        }
-                    )
+                    yield {
+                        "name": f"Delete file {f}",
+                        "ansible.builtin.file": {"path": f, "state": "absent"},
+                    }
 
             elif t == "file_rename":
-                tasks.append(
-                    {
-                        "name": f"Rename {d.get('from')} to {d.get('to')}",
-                        "ansible.builtin.command": f"mv {d.get('from')} {d.get('to')}",
-                        "args": {
-                            "creates": d.get("to"),
-                            "removes": d.get("from"),
-                        },
-                    }
-                )
+                yield {
+                    "name": f"Rename {d.get('from')} to {d.get('to')}",
+                    "ansible.builtin.command": f"mv {d.get('from')} {d.get('to')}",
+                    "args": {
+                        "creates": d.get("to"),
+                        "removes": d.get("from"),
+                    },
+                }
 
             elif t in ("system_call", "exec_call"):
                 args_raw = d.get("args")
@@ -346,43 +449,35 @@ END {
                 cmd_str = " ".join(str(a) for a in args)
 
                 if cmd == "mkdir" and len(args) > 1:
-                    tasks.append(
-                        {
-                            "name": f"Create directory {args[1]}",
-                            "ansible.builtin.file": {
-                                "path": args[1],
-                                "state": "directory",
-                            },
-                        }
-                    )
+                    yield {
+                        "name": f"Create directory {args[1]}",
+                        "ansible.builtin.file": {
+                            "path": args[1],
+                            "state": "directory",
+                        },
+                    }
                 elif cmd == "rm" and len(args) > 1:
-                    tasks.append(
-                        {
-                            "name": f"Delete file {args[1]}",
-                            "ansible.builtin.file": {
-                                "path": args[1],
-                                "state": "absent",
-                            },
-                        }
-                    )
+                    yield {
+                        "name": f"Delete file {args[1]}",
+                        "ansible.builtin.file": {
+                            "path": args[1],
+                            "state": "absent",
+                        },
+                    }
                 elif cmd == "mv" and len(args) > 2:
-                    tasks.append(
-                        {
-                            "name": f"Rename {args[1]} to {args[2]}",
-                            "ansible.builtin.command": f"mv {args[1]} {args[2]}",
-                            "args": {
-                                "creates": args[2],
-                                "removes": args[1],
-                            },
-                        }
-                    )
+                    yield {
+                        "name": f"Rename {args[1]} to {args[2]}",
+                        "ansible.builtin.command": f"mv {args[1]} {args[2]}",
+                        "args": {
+                            "creates": args[2],
+                            "removes": args[1],
+                        },
+                    }
                 else:
-                    tasks.append(
-                        {
-                            "name": f"Run command: {cmd_str}",
-                            "ansible.builtin.command": cmd_str,
-                        }
-                    )
+                    yield {
+                        "name": f"Run command: {cmd_str}",
+                        "ansible.builtin.command": cmd_str,
+                    }
 
             elif t == "external_call":
                 mod = d.get("module")
@@ -390,47 +485,39 @@ END {
                 if mod == "File::Copy" and meth == "copy":
                     src, dst = d.get("args", [None, None])[:2]
                     if src and dst:
-                        tasks.append(
-                            {
-                                "name": f"Copy {src} to {dst}",
-                                "ansible.builtin.copy": {
-                                    "src": src,
-                                    "dest": dst,
-                                    "mode": "preserve",
-                                },
-                            }
-                        )
+                        yield {
+                            "name": f"Copy {src} to {dst}",
+                            "ansible.builtin.copy": {
+                                "src": src,
+                                "dest": dst,
+                                "mode": "preserve",
+                            },
+                        }
                 elif mod == "File::Path" and meth == "make_path":
                     for dir_path in d.get("args", []):
-                        tasks.append(
-                            {
-                                "name": f"Create directory {dir_path}",
-                                "ansible.builtin.file": {
-                                    "path": dir_path,
-                                    "state": "directory",
-                                },
-                            }
-                        )
+                        yield {
+                            "name": f"Create directory {dir_path}",
+                            "ansible.builtin.file": {
+                                "path": dir_path,
+                                "state": "directory",
+                            },
+                        }
                 elif mod == "File::Path" and meth == "remove_tree":
                     for dir_path in d.get("args", []):
-                        tasks.append(
-                            {
-                                "name": f"Remove directory {dir_path}",
-                                "ansible.builtin.file": {
-                                    "path": dir_path,
-                                    "state": "absent",
-                                },
-                            }
-                        )
-                else:
-                    tasks.append(
-                        {
-                            "name": f"Call Perl method {meth} in {mod}",
-                            "debug": {
-                                "msg": f"{mod}::{meth} called with args {d.get('args', [])}"
+                        yield {
+                            "name": f"Remove directory {dir_path}",
+                            "ansible.builtin.file": {
+                                "path": dir_path,
+                                "state": "absent",
                             },
                         }
-                    )
+                else:
+                    yield {
+                        "name": f"Call Perl method {meth} in {mod}",
+                        "debug": {
+                            "msg": f"{mod}::{meth} called with args {d.get('args', [])}"
+                        },
+                    }
             elif t == "custom":
                 # breakpoint()  # For debugging custom operations
                 """
@@ -447,8 +534,7 @@ END {
                 }
                 task[task_type] = task_params
                 task = task | params
-                tasks.append(task)
-        return tasks
+                yield task
 
 
 # ---------- Main ----------
@@ -458,19 +544,8 @@ if __name__ == "__main__":  # pragma: no cover
         logging.error("Usage: process_perl.py <perl_script> [args...]")
         sys.exit(1)
 
-    original = Path(sys.argv[1])
-    instrumented = original.parent / "instrumented.pl"
-    log_file = original.parent / "ops_log.json"
-    perl_parser = PerlParser(original, {})
-    perl_parser.generate_instrumented_perl(instrumented)
-    output_lines = perl_parser.run_instrumented(instrumented, sys.argv[2:])
-
-    logging.info("Perl script output:")
-    for line in output_lines:
-        logging.debug(line)
-
-    ops = perl_parser.load_ops_log(log_file)
-    tasks = perl_parser.ops_to_ansible_tasks(ops)
+    perl_parser = PerlParser(file_path=sys.argv[1], config={})
+    tasks = perl_parser.ops_to_ansible_tasks(perl_parser.run())
 
     # Save JSON and YAML
     with open("ansible_tasks.json", "w") as f:
@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+from importlib import metadata
+
+from . import __version__
+from .utility import TaskContainer, to_plain
+
+# bump whenever what a script translates to changes, so entries cached
+# before the change aren't served. Part of every cache key, with the tool
+# version, which isn't bumped that often
+TRANSLATION_VERSION = 2
+
+
+class ConversionCache:
+    """
+    On-disk cache of converted scripts.
+    Entries are keyed on the script bytes, the config keys which change
+    how a script is translated, the parser and the tool version, so an
+    unchanged script need not be re-parsed
+    """
+
+    # verbose feeds the VERBOSE environment variable, so it matters too
+    CONFIG_KEYS = ("pull", "push", "root", "stage", "hostname", "verbose", "role_name", "perl_custom")
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        cache_dir = config.get("cache_dir")
+        if not cache_dir:
+            return None
+        return cls(cache_dir)
+
+    @staticmethod
+    def read_source(parser):
+        if parser.file_path:
+            with open(parser.file_path, "rb") as f:
+                return f.read()
+        return parser.script_string.encode()
+
+    def key(self, parser):
+        digest = hashlib.sha256()
+        settings = {k: parser.config.get(k) for k in self.CONFIG_KEYS}
+        digest.update(
+            json.dumps(
+                [__version__, TRANSLATION_VERSION, type(parser).__name__, settings], sort_keys=True
+            ).encode()
+        )
+        digest.update(b"\0")
+        digest.update(self.read_source(parser))
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        task_container = TaskContainer(entry["name"])
+        task_container.tasks = entry["tasks"]
+        task_container.variables = entry["variables"]
+        return task_container
+
+    def put(self, key, task_container):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            "name": task_container.name,
+            "tasks": task_container.tasks,
+            "variables": task_container.variables,
+        }
+        # write then rename, so concurrent conversions never see half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, default=to_plain)
+        os.replace(tmp_path, path)
+
+    def record(self, key, task_container):
+        """
+        put task_container, a streamed one once its tasks have all been
+        pulled through, each being written as it passes rather than held
+        """
+        if not task_container.pipe(
+            lambda held, source: self.recording(key, task_container, held, source)
+        ):
+            self.put(key, task_container)
+
+    def recording(self, key, task_container, held, source):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(f'{{"name": {json.dumps(task_container.name)}, "tasks": [')
+                separator = ""
+                for task in held:
+                    f.write(separator + json.dumps(task, default=to_plain))
+                    separator = ", "
+                for task in source:
+                    f.write(separator + json.dumps(task, default=to_plain))
+                    separator = ", "
+                    yield task
+                # streamed parsers only know all their variables once done
+                f.write(f'], "variables": {json.dumps(task_container.variables, default=to_plain)}}}')
+        except BaseException:
+            # not pulled through, or failed, so there's no entry
+            os.unlink(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+
+def bashlex_version():
+    try:
+        return metadata.version("bashlex")
+    except metadata.PackageNotFoundError:  # pragma: no cover
+        return "unknown"
+
+
+class ParseTreeCache:
+    """
+    bashlex parse trees keyed on the sha256 of the source, so scripts
+    copied between roles are only lexed once per run. At most size
+    trees are held, least recently used going first.
+
+    With a cache_dir the trees are also pickled to cache_dir/trees,
+    shared by --jobs workers and later runs. Unlike the ConversionCache,
+    the key doesn't depend on the role, so identical scripts in other
+    roles are hits too.
+
+    The trees are shared, the visitors only read them
+    """
+
+    def __init__(self, size=128, cache_dir=None):
+        self.size = size
+        self.cache_dir = cache_dir
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        the cache of this process for the configured size and cache_dir,
+        None when parse_cache_size is 0
+        """
+        size = config.get("parse_cache_size", 128)
+        if not size:
+            return None
+        key = (size, config.get("cache_dir"))
+        cache = _tree_caches.get(key)
+        if cache is None:
+            cache = _tree_caches[key] = cls(*key)
+        return cache
+
+    @staticmethod
+    def key(source):
+        digest = hashlib.sha256(f"{__version__}\0{TRANSLATION_VERSION}\0{bashlex_version()}\0".encode())
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, "trees", key[:2], f"{key}.pickle")
+
+    def parse(self, source, parse):
+        """
+        the trees of source, from the cache or parse(source)
+        """
+        key = self.key(source)
+        trees = self.trees.get(key)
+        if trees is not None:
+            self.trees.move_to_end(key)
+            self.hits += 1
+            return trees
+        trees = self.load(key) if self.cache_dir else None
+        if trees is None:
+            self.misses += 1
+            trees = parse(source)
+            if self.cache_dir:
+                self.store(key, trees)
+        else:
+            self.hits += 1
+        self.trees[key] = trees
+        if len(self.trees) > self.size:
+            self.trees.popitem(last=False)
+        return trees
+
+    def load(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable parse tree cache entry {path}: {e}")
+            return None
+
+    def store(self, key, trees):
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(trees, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+
+# (size, cache_dir) -> the ParseTreeCache of this process
+_tree_caches = {}
@@ -1,11 +1,16 @@
 import argparse
 import os
+import sys
 import logging
 from .config import load_config
-from .processors import ScriptProcessor, SlackRoleProcessor
+from .optimise import PASS_NAMES, PASSES
+from .processors import ScriptProcessor, SlackRoleProcessor, SlackRolesProcessor
+from .profiling import StageProfiler, in_role, profile_hooks
+from .staging import STAGE_MODES
+from .watch import Watcher
 
 
-if __name__ == "__main__":
+def main():
     parser = argparse.ArgumentParser(
         description="Translate Perl or Bash scripts into an Ansible playbook."
     )
@@ -37,6 +42,120 @@ if __name__ == "__main__":
         help="ansible role name - overrides implied or defines when missing ",
     )
 
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of slack roles to convert in parallel (0 for one per cpu)",
+    )
+
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        help="cache converted scripts in DIR, unchanged scripts are not re-parsed",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write tasks as they are translated, rather than holding whole scripts in memory",
+    )
+
+    parser.add_argument(
+        "--perl-workers",
+        type=int,
+        metavar="N",
+        help="run Perl scripts in up to N persistent perl processes, rather than one perl per script",
+    )
+
+    parser.add_argument(
+        "--stage-mode",
+        choices=STAGE_MODES,
+        help="how slack files are staged into the ansible role, falling back to copy",
+    )
+
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="compare staged files by content, rather than size and mtime",
+    )
+
+    parser.add_argument(
+        "--copy-workers",
+        type=int,
+        metavar="N",
+        help="stage files on N threads (0 for one per cpu)",
+    )
+
+    parser.add_argument(
+        "--copy-tasks",
+        choices=SlackRoleProcessor.COPY_TASKS,
+        help="a copy task per subrole directory, or one looped copy or synchronize task per subrole",
+    )
+
+    parser.add_argument(
+        "--manifests",
+        action="store_true",
+        help="write a checksum manifest of each subrole, only copying it when the target's differs",
+    )
+
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="drop tasks repeating an idempotent task earlier in the role, when nothing in between could undo it",
+    )
+
+    parser.add_argument(
+        "--merge-packages",
+        action="store_true",
+        help="merge adjacent apt/yum installs into one install of all their packages, updating the cache once",
+    )
+
+    parser.add_argument(
+        "--optimise",
+        action="store_true",
+        help=f"run every optimisation pass over the tasks: {', '.join(PASS_NAMES)}",
+    )
+
+    parser.add_argument(
+        "--disable-pass",
+        action="append",
+        choices=PASS_NAMES,
+        metavar="PASS",
+        help=f"don't run this optimisation pass, one of {', '.join(PASS_NAMES)}. May be repeated",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, re-converting whatever the changed inputs feed. "
+        "Roles are converted one at a time while watching, --jobs is ignored",
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report the time, calls and bytes of each conversion stage, and the slowest roles",
+    )
+
+    parser.add_argument(
+        "--profile-output",
+        metavar="FILE",
+        help="write the profile as JSON to FILE, implies --profile",
+    )
+
+    parser.add_argument(
+        "--cprofile",
+        metavar="OUT",
+        help="write cProfile stats of the conversion to OUT, OUT.<role> for each of a roles/ directory",
+    )
+
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="log the peak memory of the conversion and its top allocation sites",
+    )
+
     parser.add_argument("--debug", action="store_true", help="Enable debug logging")
 
     args = parser.parse_args()
@@ -63,6 +182,63 @@ if __name__ == "__main__":
 
     config["pull"] = args.pull
     config["push"] = args.push
+    config["jobs"] = args.jobs
+    if args.cache:
+        config["cache_dir"] = args.cache
+    if args.stream:
+        config["stream"] = True
+    if args.stage_mode:
+        config["stage_mode"] = args.stage_mode
+    if args.checksum:
+        config["stage_checksum"] = True
+    if args.copy_workers is not None:
+        config["copy_workers"] = args.copy_workers
+    if args.copy_tasks:
+        config["copy_tasks"] = args.copy_tasks
+    if args.manifests:
+        config["copy_manifests"] = True
+    if args.dedupe:
+        config["dedupe_tasks"] = True
+    if args.merge_packages:
+        config["merge_packages"] = True
+    if args.optimise:
+        for task_pass in PASSES:
+            config[task_pass.config_key] = True
+    if args.disable_pass:
+        config["disabled_passes"] = args.disable_pass
+    if args.perl_workers is not None:
+        config["perl_workers"] = args.perl_workers
+    if args.watch:
+        # watching regenerates from the tasks held by each processor
+        config["stream"] = False
+    if args.cprofile:
+        config["cprofile"] = args.cprofile
+    if args.tracemalloc:
+        config["tracemalloc"] = True
+    if args.profile:
+        config["profile"] = True
+    if args.profile_output:
+        config["profile_output"] = args.profile_output
+    if not (config.get("profile") or config.get("profile_output")):
+        convert(args, config)
+        return
+    # profile_output alone turns profiling on, for the --jobs workers too
+    config["profile"] = True
+    profiler = StageProfiler()
+    try:
+        with profiler.activate():
+            convert(args, config)
+    finally:
+        top = config.get("profile_top", 10)
+        print(profiler.report(top))
+        if config.get("profile_output"):
+            profiler.write(config["profile_output"], top)
+
+
+def convert(args, config):
+    """
+    convert the input, as configured
+    """
     if args.type == "slack":
         if os.path.isdir(config["input"]):
             dir_name = os.path.basename(config["input"])
@@ -75,15 +251,13 @@ if __name__ == "__main__":
                 else:
                     # assume we need to add the ansible roles dir
                     output_root = os.path.join(config["output"], "roles")
-                for role_name in os.listdir(config["input"]):
-                    config["role_name"] = role_name
-                    output_dir = os.path.join(output_root, role_name)
-                    logging.info(f"Processing Slack role from directory: {role_name}")
-                    role_dir = os.path.join(config["input"], role_name)
-                    if not os.path.isdir(role_dir):
-                        continue
-                    processor = SlackRoleProcessor(role_dir, output_dir, config)
-                    processor.process()
+                processor = SlackRolesProcessor(config["input"], output_root, config)
+                if args.watch:
+                    Watcher(config, roles=processor).run()
+                    return
+                processor.process()
+                if processor.failures():
+                    sys.exit(1)
             else:
                 # assume we are processing a single slack role
                 if output_dir_name == "roles":
@@ -96,7 +270,8 @@ if __name__ == "__main__":
                 # if not set!!!!
                 config["role_name"] = role_name
                 processor = SlackRoleProcessor(args.input, output_dir, config)
-                processor.process()
+                with in_role(role_name), profile_hooks(config):
+                    processor.process()
         else:
             raise ValueError(
                 f"Input path {args.input} is not a directory for Slack role processing."
@@ -104,10 +279,19 @@ if __name__ == "__main__":
     elif args.type == "script":
         if os.path.isfile(config["input"]):
             processor = ScriptProcessor(config["input"], config)
-            processor.process()
+            with in_role(os.path.basename(config["input"])), profile_hooks(config):
+                processor.process()
         else:
             raise ValueError(
                 f"Input path {args.input} is not a file for Bash processing."
             )
     else:
         raise ValueError(f"Unknown type: {args.type}")
+    if args.watch:
+        watcher = Watcher(config)
+        watcher.add(processor)
+        watcher.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,30 @@ DEFAULT_CONFIG = {
     "verbose": False,
     "strict": False,
     "perl_custom": "",
+    "jobs": 1,
+    "cache_dir": None,
+    "parse_cache_size": 128,  # bashlex parse trees held, 0 for none
+    "watch_interval": 0.5,
+    "watch_inotify": True,  # on linux, else polls every input
+    "stream": False,
+    "perl_workers": 0,
+    "stage_mode": "copy",  # or hardlink, reflink, symlink
+    "stage_checksum": False,
+    "copy_workers": 4,
+    "copy_tasks": "per_dir",  # or loop, synchronize
+    "copy_manifests": False,
+    "dedupe_tasks": False,
+    "merge_packages": False,
+    "collapse_file_tasks": False,
+    "drop_touch_tasks": False,
+    "disabled_passes": [],  # optimisation passes not to run, though configured
+    "manifest_dir": "/var/lib/script2ansible",
+    "profile": False,
+    "profile_output": None,
+    "profile_top": 10,
+    "cprofile": None,
+    "tracemalloc": False,
+    "tracemalloc_top": 10,
 }
 
 
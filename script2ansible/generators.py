@@ -1,7 +1,12 @@
+import itertools
 import json
+import textwrap
 import yaml
 import os
 
+from .profiling import profiled, output_size
+from .utility import Task, to_plain
+
 
 class IndenterDumper(yaml.Dumper):
     """Custom YAML dumper to handle indentation correctly.
@@ -12,6 +17,137 @@ class IndenterDumper(yaml.Dumper):
         return super(IndenterDumper, self).increase_indent(flow, False)
 
 
+# libyaml's emitter is much faster, but it can't be told to indent
+# sequences nested in mappings, and escapes or folds some strings
+# differently. It is only used for data it emits just as IndenterDumper would
+CDumper = getattr(yaml, "CDumper", None)
+
+
+def represent_task(dumper, task):
+    # as the plain dict, without building it
+    return dumper.represent_dict(task.items())
+
+
+IndenterDumper.add_representer(Task, represent_task)
+if CDumper is not None:
+    # a subclass, leaving yaml's own CDumper alone
+    CDumper = type("CDumper", (CDumper,), {})
+    CDumper.add_representer(Task, represent_task)
+
+
+def emits_identically(data):
+    """
+    True when CDumper output for data is the same as IndenterDumper's:
+    a top level sequence of mappings, holding no sequences, with all
+    strings printable ascii
+    """
+    if isinstance(data, list):
+        return all(map(plain_node, data))
+    return plain_node(data)
+
+
+def plain_node(data):
+    if isinstance(data, str):
+        return data.isascii() and data.isprintable()
+    if isinstance(data, (dict, Task)):
+        return all(
+            plain_node(key) and plain_node(value) for key, value in data.items()
+        )
+    return data is None or isinstance(data, (bool, int, float))
+
+
+def select_dumper(data):
+    if CDumper is not None and emits_identically(data):
+        return CDumper
+    return IndenterDumper
+
+
+def dump_yaml(data, stream=None):
+    return yaml.dump(
+        data,
+        stream,
+        sort_keys=False,
+        Dumper=select_dumper(data),
+        default_flow_style=False,
+    )
+
+
+def peek(tasks):
+    """
+    (first task or None, iterator over all the tasks)
+    """
+    tasks = iter(tasks)
+    first = next(tasks, None)
+    if first is None:
+        return None, iter(())
+    return first, itertools.chain([first], tasks)
+
+
+def write_tasks(f, tasks, output_format="yaml"):
+    """
+    Write a list of tasks to f one task at a time, rather than building
+    the whole document in memory first. The output is the same as
+    dumping the list in one go
+    """
+    if output_format == "json":
+        separator = "\n"
+        f.write("[")
+        for task in tasks:
+            f.write(separator)
+            f.write(textwrap.indent(json.dumps(task, indent=2, default=to_plain), "  "))
+            separator = ",\n"
+        f.write("]" if separator == "\n" else "\n]")
+        return
+    # a top level block sequence can be emitted item by item
+    empty = True
+    for task in tasks:
+        dump_yaml([task], f)
+        empty = False
+    if empty:
+        dump_yaml([], f)
+
+
+class YamlEventWriter:
+    """
+    Emits a YAML document piecemeal through a single IndenterDumper, so
+    a task list nested inside a playbook can still be written one task
+    at a time, with the same output as dumping the whole document
+    """
+
+    def __init__(self, f):
+        self.dumper = IndenterDumper(f, sort_keys=False, default_flow_style=False)
+        self.dumper.open()
+        self.dumper.emit(yaml.DocumentStartEvent(explicit=False))
+
+    def start_sequence(self):
+        self.dumper.emit(yaml.SequenceStartEvent(None, None, True, flow_style=False))
+
+    def end_sequence(self):
+        self.dumper.emit(yaml.SequenceEndEvent())
+
+    def start_mapping(self):
+        self.dumper.emit(yaml.MappingStartEvent(None, None, True, flow_style=False))
+
+    def end_mapping(self):
+        self.dumper.emit(yaml.MappingEndEvent())
+
+    def data(self, data):
+        dumper = self.dumper
+        node = dumper.represent_data(data)
+        dumper.represented_objects = {}
+        dumper.object_keeper = []
+        dumper.alias_key = None
+        dumper.anchor_node(node)
+        dumper.serialize_node(node, None, None)
+        dumper.serialized_nodes = {}
+        dumper.anchors = {}
+
+    def close(self):
+        self.dumper.emit(yaml.DocumentEndEvent(explicit=False))
+        self.dumper.close()
+        self.dumper.dispose()
+
+
 class GeneratorRole:
     def __init__(self, processor, output_format="yaml"):
         self.processor = processor
@@ -39,7 +175,12 @@ class GeneratorRole:
                 with open(stub_file, "w") as f:
                     f.write(stub_content)
 
-    def generate(self):
+    @profiled("generate_role", size=output_size)
+    def generate(self, only=None):
+        """
+        only: names of the task files to (re)write, main.yml and
+              vars are always written. None writes them all
+        """
         task_containers = self.processor.get_tasks()
         self.create_role_structure()
 
@@ -48,36 +189,27 @@ class GeneratorRole:
         main_tasks = []
         variables = []
         for task_container in task_containers:
-            if not task_container.get_tasks():
-                continue
-            variables += task_container.variables
             tasks_name = task_container.name
-            tasks = task_container.get_tasks()
-            output = (
-                json.dumps(tasks, indent=2)
-                if self.output_format == "json"
-                else yaml.dump(
-                    tasks,
-                    sort_keys=False,
-                    Dumper=IndenterDumper,
-                    default_flow_style=False,
-                )
-            )
+            if only is not None and tasks_name not in only:
+                if task_container.get_tasks():
+                    variables += task_container.variables
+                    main_tasks.append({'include_tasks': f"{tasks_name}.yml"})
+                continue
+            first, tasks = peek(task_container.iter_tasks())
+            if first is None:
+                continue
             ofile_name = os.path.join(
                 self.processor.get_output_dir(), "tasks", f"{tasks_name}.yml"
             )
             with open(ofile_name, "w") as f:
-                f.write(output)
+                write_tasks(f, tasks, self.output_format)
+            # streamed parsers only know all their variables once done
+            variables += task_container.variables
             main_tasks.append({'include_tasks': f"{tasks_name}.yml"})
         output = (
                 json.dumps(main_tasks, indent=2)
                 if self.output_format == "json"
-                else yaml.dump(
-                    main_tasks,
-                    sort_keys=False,
-                    Dumper=IndenterDumper,
-                    default_flow_style=False,
-                )
+                else dump_yaml(main_tasks)
         )
         ofile_name = os.path.join(
             self.processor.get_output_dir(), "tasks", "main.yml"
@@ -94,24 +226,15 @@ class GeneratorRoleTasks:
         self.processor = processor
         self.output_format = output_format
 
-    def generate(self):
+    @profiled("generate_role_tasks", size=output_size)
+    def generate(self, only=None):
         task_containers = self.processor.get_tasks()
         for task_container in task_containers:
-            if not task_container.get_tasks():
+            first, tasks = peek(task_container.iter_tasks())
+            if first is None:
                 continue
-            tasks = task_container.get_tasks()
-            output = (
-                json.dumps(tasks, indent=2)
-                if self.output_format == "json"
-                else yaml.dump(
-                    tasks,
-                    sort_keys=False,
-                    Dumper=IndenterDumper,
-                    default_flow_style=False,
-                )
-            )
             with open(self.processor.output_file, "w") as f:
-                f.write(output)
+                write_tasks(f, tasks, self.output_format)
 
 
 class GeneratorPlaybook:
@@ -119,28 +242,58 @@ class GeneratorPlaybook:
         self.processor = processor
         self.output_format = output_format
 
-    def generate(self):
+    @profiled("generate_playbook", size=output_size)
+    def generate(self, only=None):
         task_containers = self.processor.get_tasks()
-        playbook = [
-            {
-                "name": "Execute translated shell commands",
-                "hosts": "all",
-                "become": True,
-                "tasks": task_containers[0].get_tasks() if task_containers else [],
-            }
-        ]
-        output = (
-            json.dumps(playbook, indent=2)
-            if self.output_format == "json"
-            else yaml.dump(
-                playbook,
-                sort_keys=False,
-                Dumper=IndenterDumper,
-                default_flow_style=False,
-            )
-        )
+        play = {
+            "name": "Execute translated shell commands",
+            "hosts": "all",
+            "become": True,
+        }
+        tasks = task_containers[0].iter_tasks() if task_containers else iter(())
         with open(self.processor.output_file, "w") as f:
-            f.write(output)
+            if self.output_format == "json":
+                self.write_json(f, play, tasks)
+            else:
+                self.write_yaml(f, play, tasks)
+
+    @staticmethod
+    def write_json(f, play, tasks):
+        # json.dumps([{**play, "tasks": [...]}], indent=2), a task at a time
+        header = json.dumps([{**play, "tasks": None}], indent=2)
+        prefix = header[:header.rindex("null")]
+        first, tasks = peek(tasks)
+        if first is None:
+            f.write(prefix + "[]" + header[header.rindex("null") + 4:])
+            return
+        f.write(prefix + "[")
+        separator = "\n"
+        for task in tasks:
+            f.write(separator)
+            f.write(textwrap.indent(json.dumps(task, indent=2, default=to_plain), " " * 6))
+            separator = ",\n"
+        f.write("\n    ]" + header[header.rindex("null") + 4:])
+
+    @staticmethod
+    def write_yaml(f, play, tasks):
+        writer = YamlEventWriter(f)
+        writer.start_sequence()
+        writer.start_mapping()
+        for key, value in play.items():
+            writer.data(key)
+            writer.data(value)
+        writer.data("tasks")
+        first, tasks = peek(tasks)
+        if first is None:
+            writer.data([])
+        else:
+            writer.start_sequence()
+            for task in tasks:
+                writer.data(task)
+            writer.end_sequence()
+        writer.end_mapping()
+        writer.end_sequence()
+        writer.close()
 
 
 class GeneratorFactory:
@@ -0,0 +1,65 @@
+import os
+
+
+class RoleInventory:
+    """
+    The parts of a slack role: its files* subroles, with the top level
+    directories of each, and its scripts.
+
+    Found by a single os.scandir pass over the role, its subroles and
+    scripts/, using the type information scandir already has rather
+    than a stat per entry. Entries come in scandir order, and hidden
+    ones are skipped, as with glob
+    """
+
+    SCRIPT_NAMES = ("fixfiles", "preinstall", "postinstall")
+
+    def __init__(self, role_dir):
+        self.role_dir = role_dir
+        # files, files.wibble -> [top level directory paths]
+        self.subroles = {}
+        # preinstall etc -> path
+        self.scripts = {}
+        self.scan()
+
+    def scan(self):
+        with os.scandir(self.role_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("files") and entry.is_dir():
+                    self.subroles[entry.name] = [
+                        sub_entry.path
+                        for sub_entry in scan_visible(entry.path)
+                        if sub_entry.is_dir()
+                    ]
+                elif entry.name == "scripts" and entry.is_dir():
+                    for sub_entry in scan_visible(entry.path):
+                        if sub_entry.name in self.SCRIPT_NAMES and sub_entry.is_file():
+                            self.scripts[sub_entry.name] = sub_entry.path
+
+    def subrole_dirs(self):
+        """
+        the files* directories
+        """
+        return [os.path.join(self.role_dir, name) for name in self.subroles]
+
+    def top_dirs(self, subrole_name):
+        """
+        the directories of a subrole, which are staged to the same path on the target
+        """
+        return self.subroles.get(subrole_name, [])
+
+    def watch_paths(self):
+        return self.subrole_dirs() + [os.path.join(self.role_dir, "scripts")]
+
+
+def scan_visible(path):
+    with os.scandir(path) as entries:
+        return [entry for entry in entries if not entry.name.startswith(".")]
+
+
+def scan_roles(roles_dir):
+    """
+    (role name, role directory) for each slack role in roles_dir
+    """
+    with os.scandir(roles_dir) as entries:
+        return [(entry.name, entry.path) for entry in entries if entry.is_dir()]
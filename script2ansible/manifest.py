@@ -0,0 +1,50 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .staging import file_digest
+
+
+def build_manifest(files_dir, top_dirs, copies, workers=1):
+    """
+    path, size and sha256 of every file staged under the top_dirs of
+    files_dir, with the copies ((src, dest) pairs) made from them, so
+    changing either changes the manifest
+    """
+    paths = []
+    for top_dir in top_dirs:
+        for dir_path, dir_names, file_names in os.walk(
+            os.path.join(files_dir, top_dir), followlinks=True
+        ):
+            for file_name in file_names:
+                paths.append(os.path.join(dir_path, file_name))
+    paths.sort()
+
+    def entry(path):
+        return {
+            "path": os.path.relpath(path, files_dir),
+            "size": os.stat(path).st_size,
+            "sha256": file_digest(path),
+        }
+
+    if workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            files = list(executor.map(entry, paths))
+    else:
+        files = [entry(path) for path in paths]
+    return {
+        "copies": [{"src": src, "dest": dest} for src, dest in copies],
+        "files": files,
+    }
+
+
+def write_manifest(path, manifest):
+    """
+    write the manifest, returning the sha256 of what was written
+    """
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode() + b"\n"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,481 @@
+import json
+import logging
+import posixpath
+import re
+import time
+
+from . import profiling
+from .utility import to_plain
+
+FILE_MODULES = frozenset(("ansible.builtin.file", "file"))
+PACKAGE_MODULES = frozenset(
+    (
+        "ansible.builtin.apt", "apt",
+        "ansible.builtin.yum", "yum",
+        "ansible.builtin.dnf", "dnf",
+        "ansible.builtin.package", "package",
+    )
+)
+# change files, but only at their dest
+COPY_MODULES = frozenset(("ansible.builtin.copy", "copy", "ansible.builtin.template", "template"))
+# change nothing on the host
+INERT_MODULES = frozenset(("ansible.builtin.debug", "debug"))
+
+# file states which running again leaves as they were, touch updates times
+IDEMPOTENT_FILE_STATES = frozenset((None, "file", "directory", "absent", "link", "hard"))
+IDEMPOTENT_PACKAGE_STATES = frozenset((None, "present", "installed", "absent", "removed"))
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_]\w*")
+# registers are prefixed with the role or command name, which may be hyphenated
+HYPHENATED_PATTERN = re.compile(r"[A-Za-z_][\w-]*")
+
+
+def canonical(task):
+    """
+    what a task does, regardless of its name and register
+    """
+    return json.dumps(
+        {key: value for key, value in task.items() if key not in ("name", "register")},
+        sort_keys=True,
+        default=to_plain,
+    )
+
+
+def task_module(task):
+    module = getattr(task, "module", None)
+    if module is not None and isinstance(module, str):
+        return module
+    for key in task:
+        if key not in ("name", "register", "when", "loop", "args"):
+            return key
+    return None
+
+
+def resources(task):
+    """
+    ("path", path) or ("package", name) for each thing a task changes,
+    None when that can't be told, so it might change anything
+    """
+    module = task_module(task)
+    args = task.get(module)
+    if module in INERT_MODULES:
+        return []
+    if not isinstance(args, dict) or "loop" in task:
+        return None
+    if module in FILE_MODULES or module in COPY_MODULES:
+        path = args.get("path") or args.get("dest")
+        return [("path", path)] if path else None
+    if module in PACKAGE_MODULES:
+        names = args.get("name")
+        if names is None:
+            # an update or upgrade, which touches every package
+            return [("package", None)]
+        return [("package", name) for name in package_names(names)]
+    return None
+
+
+def is_idempotent(task):
+    """
+    running the task again straight after changes nothing: file states
+    and package installs or removals
+    """
+    module = task_module(task)
+    args = task.get(module)
+    if not isinstance(args, dict):
+        return False
+    if module in FILE_MODULES:
+        return args.get("state") in IDEMPOTENT_FILE_STATES
+    if module in PACKAGE_MODULES:
+        return "name" in args and args.get("state") in IDEMPOTENT_PACKAGE_STATES
+    return False
+
+
+def related(resource, other):
+    kind, name = resource
+    other_kind, other_name = other
+    if kind != other_kind:
+        return False
+    if name is None or other_name is None:
+        return True
+    if kind == "package":
+        return name == other_name
+    if "{{" in name or "{{" in other_name:
+        # templated, could be anywhere
+        return True
+    name, other_name = posixpath.normpath(name), posixpath.normpath(other_name)
+    return (
+        name == other_name
+        or other_name.startswith(name.rstrip("/") + "/")
+        or name.startswith(other_name.rstrip("/") + "/")
+    )
+
+
+def referenced_names(tasks):
+    """
+    the identifiers in the tasks, besides what they register, so a
+    register which is used somewhere is kept
+    """
+    names = set()
+    for task in tasks:
+        for key, value in task.items():
+            if key != "register":
+                text = json.dumps(value, default=to_plain)
+                names.update(IDENTIFIER_PATTERN.findall(text))
+                names.update(HYPHENATED_PATTERN.findall(text))
+    return names
+
+
+def dedupe_tasks(task_containers):
+    """
+    drop tasks repeating an idempotent task earlier in the containers,
+    in the order they run, when nothing run in between could have
+    undone it: no task changes the same path or package, and no command
+    or other task which might change anything. Tasks whose register is
+    used are kept.
+    Returns the (container name, task name) dropped
+    """
+    all_tasks = [task for task_container in task_containers for task in task_container.tasks]
+    referenced = referenced_names(all_tasks)
+    # canonical form -> resources, of the idempotent tasks in force
+    seen = {}
+    dropped = []
+    for task_container in task_containers:
+        kept = []
+        for task in task_container.tasks:
+            key = canonical(task) if is_idempotent(task) else None
+            if key is not None and key in seen and task.get("register") not in referenced:
+                dropped.append((task_container.name, task.get("name")))
+                logging.debug(f"Dropping duplicate task '{task.get('name')}' from {task_container.name}")
+                continue
+            kept.append(task)
+            changes = resources(task)
+            if changes is None:
+                seen.clear()
+                continue
+            for seen_key, seen_changes in list(seen.items()):
+                if any(related(change, seen_change) for change in changes for seen_change in seen_changes):
+                    del seen[seen_key]
+            if key is not None:
+                seen[key] = changes
+        if len(kept) != len(task_container.tasks):
+            task_container.tasks = kept
+    if dropped:
+        logging.info(
+            f"Dropped {len(dropped)} duplicate tasks: "
+            + ", ".join(f"{name} ({container})" for container, name in dropped)
+        )
+    return dropped
+
+
+def package_step(task, referenced):
+    """
+    ("update" or "install", module, when, options) for a task which can
+    join a package transaction, None for any other
+    """
+    module = task_module(task)
+    if module not in PACKAGE_MODULES or set(task) - {"name", module, "register", "when"}:
+        return None
+    if task.get("register") in referenced:
+        return None
+    args = task[module]
+    if not isinstance(args, dict):
+        return None
+    when = json.dumps(task.get("when"), default=to_plain)
+    if args.get("update_cache") and set(args) <= {"update_cache", "cache_valid_time"}:
+        return "update", module, when, None
+    if "name" in args and args.get("state", "present") in ("present", "installed"):
+        options = {key: value for key, value in args.items() if key not in ("name", "state", "update_cache")}
+        return "install", module, when, json.dumps(options, sort_keys=True)
+    return None
+
+
+def package_names(names):
+    if isinstance(names, str):
+        return names.replace(",", " ").split()
+    return list(names)
+
+
+def merge_package_run(run):
+    """
+    one task for a run of adjacent package tasks: the installs with
+    all their packages, updating the cache once if any of them did
+    """
+    installs = [task for step, task in run if step[0] == "install"]
+    if not installs:
+        return [run[0][1]]
+    first = installs[0]
+    module = task_module(first)
+    names = []
+    update_cache = False
+    for step, task in run:
+        args = task[module]
+        update_cache = update_cache or bool(args.get("update_cache"))
+        if step[0] == "install":
+            names += [name for name in package_names(args["name"]) if name not in names]
+    args = {"name": names, "state": "present"}
+    args.update({key: value for key, value in first[module].items() if key not in ("name", "state", "update_cache")})
+    if update_cache:
+        args["update_cache"] = True
+    merged = {"name": f"Install packages: {' '.join(names)}", module: args}
+    if "register" in first:
+        merged["register"] = first["register"]
+    if "when" in first:
+        merged["when"] = first["when"]
+    return [merged]
+
+
+def merge_package_tasks(task_containers):
+    """
+    merge each run of adjacent apt/yum installs, and cache updates, with
+    the same module, conditions and options into one install of all
+    their packages, updating the cache once. Tasks whose register is
+    used elsewhere are left alone.
+    Returns the number of tasks merged away
+    """
+    referenced = referenced_names(
+        task for task_container in task_containers for task in task_container.tasks
+    )
+    merged_away = 0
+    for task_container in task_containers:
+        tasks = []
+        run = []
+
+        def flush():
+            tasks.extend(merge_package_run(run) if len(run) > 1 else [task for step, task in run])
+            run.clear()
+
+        for task in task_container.tasks:
+            step = package_step(task, referenced)
+            if step is None:
+                flush()
+                tasks.append(task)
+                continue
+            if run:
+                kind, module, when, options = step
+                installs = [other for other, _ in run if other[0] == "install"]
+                if (module, when) != run[0][0][1:3] or (
+                    kind == "install" and installs and options != installs[0][3]
+                ):
+                    flush()
+            run.append((step, task))
+        flush()
+        if len(tasks) != len(task_container.tasks):
+            merged_away += len(task_container.tasks) - len(tasks)
+            task_container.tasks = tasks
+    if merged_away:
+        logging.info(f"Merged away {merged_away} package tasks")
+    return merged_away
+
+
+# file states another file task on the same path can be folded into
+COLLAPSIBLE_FILE_STATES = frozenset((None, "file", "directory", "touch"))
+
+
+def file_step(task, referenced):
+    """
+    (path, when, state) of a file task which can be folded together
+    with others on its path, None for any other
+    """
+    module = task_module(task)
+    if module not in FILE_MODULES or set(task) - {"name", module, "register", "when"}:
+        return None
+    if task.get("register") in referenced:
+        return None
+    args = task[module]
+    if not isinstance(args, dict) or args.get("recurse") or "src" in args:
+        return None
+    path = args.get("path") or args.get("dest")
+    if not path or args.get("state") not in COLLAPSIBLE_FILE_STATES:
+        return None
+    return posixpath.normpath(path), json.dumps(task.get("when"), default=to_plain), args.get("state")
+
+
+def collapse_file_tasks(task_containers):
+    """
+    fold each file task into the one before it on the same path, under
+    the same conditions, as mkdir then chmod then chown set one after
+    another: later arguments win, and the first task's state (and name
+    and register) is kept. Tasks whose register is used are left alone.
+    Returns the number of tasks folded away
+    """
+    referenced = referenced_names(
+        task for task_container in task_containers for task in task_container.tasks
+    )
+    folded = 0
+    for task_container in task_containers:
+        tasks = []
+        previous = None
+        for task in task_container.tasks:
+            step = file_step(task, referenced)
+            if (
+                step is not None
+                and previous is not None
+                and step[:2] == previous[:2]
+                and step[2] in (None, previous[2])
+            ):
+                module = task_module(tasks[-1])
+                merged = dict(tasks[-1])
+                merged["name"] = f"{tasks[-1]['name']}; {task['name']}"
+                merged[module] = dict(tasks[-1][module])
+                merged[module].update(
+                    (key, value) for key, value in task[task_module(task)].items() if key not in ("path", "dest")
+                )
+                tasks[-1] = merged
+                continue
+            tasks.append(task)
+            previous = step
+        if len(tasks) != len(task_container.tasks):
+            folded += len(task_container.tasks) - len(tasks)
+            task_container.tasks = tasks
+    if folded:
+        logging.info(f"Folded away {folded} file tasks")
+    return folded
+
+
+def drop_touch_tasks(task_containers):
+    """
+    drop a touch straight before a copy (or template) to the same path,
+    which creates the file anyway, handing the touch's mode, owner and
+    group to the copy when it doesn't set them. Not when the copy won't
+    overwrite (force: false), or the touch's register is used.
+    Returns the number of tasks dropped
+    """
+    referenced = referenced_names(
+        task for task_container in task_containers for task in task_container.tasks
+    )
+    dropped = 0
+    for task_container in task_containers:
+        tasks = []
+        for task in task_container.tasks:
+            touch = tasks[-1] if tasks else None
+            module = task_module(task)
+            if touch is not None and module in COPY_MODULES and touches(touch, task, referenced):
+                copy = dict(task)
+                copy[module] = dict(task[module])
+                for key, value in touch[task_module(touch)].items():
+                    if key in ("mode", "owner", "group"):
+                        copy[module].setdefault(key, value)
+                tasks[-1] = copy
+                continue
+            tasks.append(task)
+        if len(tasks) != len(task_container.tasks):
+            dropped += len(task_container.tasks) - len(tasks)
+            task_container.tasks = tasks
+    if dropped:
+        logging.info(f"Dropped {dropped} touch tasks followed by a copy")
+    return dropped
+
+
+def touches(touch, copy, referenced):
+    """
+    touch only creates the file copy then writes
+    """
+    module = task_module(touch)
+    args = touch.get(module)
+    copy_args = copy.get(task_module(copy))
+    if module not in FILE_MODULES or not isinstance(args, dict) or not isinstance(copy_args, dict):
+        return False
+    if args.get("state") != "touch" or set(args) - {"path", "dest", "state", "mode", "owner", "group"}:
+        return False
+    if set(touch) - {"name", module, "register", "when"} or touch.get("register") in referenced:
+        return False
+    if "loop" in copy or touch.get("when") != copy.get("when") or copy_args.get("force") is False:
+        return False
+    path = args.get("path") or args.get("dest")
+    dest = copy_args.get("dest")
+    if not path or not dest or dest.endswith("/") or "{{" in path:
+        return False
+    return posixpath.normpath(path) == posixpath.normpath(dest)
+
+
+class TaskPass:
+    """
+    A rewrite of the tasks of a role (or script) between parsing and
+    generating, run when config[config_key] is set.
+    A pass spanning containers looks across a role's task files, so it
+    can't be re-run on one of them alone
+    """
+
+    def __init__(self, name, run, config_key, spans_containers=False):
+        self.name = name
+        self.run = run
+        self.config_key = config_key
+        self.spans_containers = spans_containers
+
+
+# in the order they run
+PASSES = (
+    TaskPass("dedupe", dedupe_tasks, "dedupe_tasks", spans_containers=True),
+    TaskPass("collapse_files", collapse_file_tasks, "collapse_file_tasks"),
+    TaskPass("drop_touch", drop_touch_tasks, "drop_touch_tasks"),
+    TaskPass("merge_packages", merge_package_tasks, "merge_packages"),
+)
+PASS_NAMES = tuple(task_pass.name for task_pass in PASSES)
+
+
+class PassManager:
+    """
+    Runs the configured passes in order over task containers, keeping
+    the tasks in and out, and the time taken, of each pass
+    """
+
+    def __init__(self, passes):
+        self.passes = list(passes)
+        # pass -> {"runs", "tasks_in", "tasks_out", "seconds"}
+        self.stats = {
+            task_pass.name: {"runs": 0, "tasks_in": 0, "tasks_out": 0, "seconds": 0.0}
+            for task_pass in self.passes
+        }
+
+    @classmethod
+    def from_config(cls, config):
+        disabled = set(config.get("disabled_passes") or ())
+        unknown = disabled.difference(PASS_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown optimisation passes: {', '.join(sorted(unknown))}")
+        return cls(
+            task_pass
+            for task_pass in PASSES
+            if config.get(task_pass.config_key) and task_pass.name not in disabled
+        )
+
+    @property
+    def spans_containers(self):
+        return any(task_pass.spans_containers for task_pass in self.passes)
+
+    def run(self, task_containers):
+        """
+        run the passes over task_containers, pulling in streamed tasks
+        when there are any passes to run
+        """
+        for task_pass in self.passes:
+            tasks_in = sum(len(task_container.tasks) for task_container in task_containers)
+            start = time.perf_counter()
+            task_pass.run(task_containers)
+            seconds = time.perf_counter() - start
+            tasks_out = sum(len(task_container.tasks) for task_container in task_containers)
+            stats = self.stats[task_pass.name]
+            stats["runs"] += 1
+            stats["tasks_in"] += tasks_in
+            stats["tasks_out"] += tasks_out
+            stats["seconds"] += seconds
+            profiler = profiling.active
+            if profiler is not None:
+                profiler.record(f"pass_{task_pass.name}", seconds)
+            logging.debug(f"Pass {task_pass.name}: {tasks_in} -> {tasks_out} tasks in {seconds:.3f}s")
+        return self.stats
+
+    def report(self):
+        lines = [f"{'pass':16} {'runs':>6} {'tasks in':>9} {'tasks out':>10} {'seconds':>10}"]
+        for name, stats in self.stats.items():
+            lines.append(
+                f"{name:16} {stats['runs']:6} {stats['tasks_in']:9} {stats['tasks_out']:10} {stats['seconds']:10.3f}"
+            )
+        return "\n".join(lines)
+
+    def log_report(self, label):
+        """
+        log the statistics of each pass, when there were any passes
+        """
+        if self.passes:
+            logging.info(f"Optimisation passes over {label}:\n{self.report()}")
@@ -1,6 +1,7 @@
 import logging
 
 from .PerlParser import PerlParser
+from .profiling import profiled
 
 # from .BashParser import BashParser
 from .BashLexParser import BashLexParser as BashParser
@@ -8,6 +9,7 @@ from .BashLexParser import BashLexParser as BashParser
 
 class ParserFactory:
     @staticmethod
+    @profiled("get_parser")
     def get_parser(file_path=None, script_string=None, config=None):
         first_line = ""
         if file_path:
@@ -1,11 +1,19 @@
 import os
+import re
 import sys
-import glob
 from .parsers import ParserFactory
 from .generators import GeneratorFactory
 from .utility import TaskContainer
-import shutil
+from .cache import ConversionCache
+from .config import DEFAULT_CONFIG
+from .staging import Stager
+from .manifest import build_manifest, write_manifest
+from .optimise import PassManager
+from .inventory import RoleInventory, scan_roles
+from . import profiling
+from .profiling import profiled, profile_hooks, role_profile
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 
 class Processor:
@@ -13,6 +21,7 @@ class Processor:
     def __init__(self, config):
         self.config = config
         self.task_containers = []
+        self.cache = ConversionCache.from_config(config)
 
     def process(self):
         raise NotImplementedError(
@@ -22,6 +31,35 @@ class Processor:
     def get_tasks(self):
         return self.task_containers
 
+    def parse_script(self, file_path):
+        """
+        parse a script, via the conversion cache when one is configured.
+        When streaming, a script missing from the cache is stored as its
+        tasks are written
+        """
+        parser = ParserFactory.get_parser(file_path=file_path, config=self.config)
+        cache = self.cache
+        if cache is not None:
+            key = cache.key(parser)
+            task_container = cache.get(key)
+            if task_container is not None:
+                logging.info(f"{file_path} unchanged, using cached tasks")
+                return task_container
+        if self.config.get("stream"):
+            # tasks are produced as the generator writes them
+            task_container = parser.stream()
+        else:
+            task_container = parser.parse()
+        if cache is not None:
+            cache.record(key, task_container)
+        return task_container
+
+    def log_cache(self):
+        if self.cache is not None:
+            logging.info(
+                f"Conversion cache: {self.cache.hits} hits, {self.cache.misses} misses"
+            )
+
     def get_output_dir(self):
         raise NotImplementedError(
             "Subclasses should implement this method to return tasks."
@@ -38,6 +76,8 @@ class Processor:
 
 class SlackRoleProcessor(Processor):
 
+    SCRIPT_NAMES = RoleInventory.SCRIPT_NAMES
+
     def __init__(self, role_dir, role_output_dir, config, **kwargs):
         super().__init__(config)
         self.role_dir = role_dir
@@ -52,15 +92,21 @@ class SlackRoleProcessor(Processor):
 
         logging.info(f"Processing Slack role: {self.role_name}")
         self.ansible_role_dir = os.path.join(config["output"], "roles", self.role_name)
+        self.stager = Stager.from_config(config)
+        self.inventory = None
 
     @staticmethod
     def build_ansible_copy(src, dest, **kwargs):
+        """
+        copy the contents of the src directory into dest, files/etc/x
+        landing at /etc/x rather than /etc/etc/x
+        """
         logging.debug(f"build_ansible_copy {src}  to {dest}")
 
         task = {
             "name": f"Copy {src} to {dest}",
             "ansible.builtin.copy": {
-                "src": src,
+                "src": os.path.join(src, ""),
                 "dest": dest,
                 "mode": "preserve",
             },
@@ -69,6 +115,105 @@ class SlackRoleProcessor(Processor):
             task['when'] = kwargs.get('when')
         return task
 
+    COPY_TASKS = ("per_dir", "loop", "synchronize")
+
+    def build_copy_tasks(self, name, items, when=None):
+        """
+        the tasks copying a subrole's (src, dest) directories, by copy_tasks:
+        per_dir:     a copy task each
+        loop:        one copy task looping over them
+        synchronize: one ansible.posix.synchronize task looping over them
+        Each copies the contents of src into dest, so the three lay out
+        the same tree on the target
+        """
+        copy_tasks = self.config.get("copy_tasks") or "per_dir"
+        if copy_tasks not in self.COPY_TASKS:
+            raise ValueError(f"Unknown copy_tasks: {copy_tasks}")
+        if copy_tasks == "per_dir" or (copy_tasks == "loop" and len(items) == 1):
+            return [self.build_ansible_copy(src, dest, when=when) for src, dest in items]
+        if not items:
+            return []
+        if name == "files":
+            name = self.role_name
+        if copy_tasks == "loop":
+            task = {
+                "name": f"Copy {name} files",
+                "ansible.builtin.copy": {
+                    "src": "{{ item.src }}/",
+                    "dest": "{{ item.dest }}",
+                    "mode": "preserve",
+                },
+            }
+        else:
+            task = {
+                "name": f"Synchronize {name} files",
+                "ansible.posix.synchronize": {
+                    "src": "{{ item.src }}/",
+                    "dest": "{{ item.dest }}",
+                },
+            }
+        if when:
+            task["when"] = when
+        task["loop"] = [{"src": src, "dest": dest} for src, dest in items]
+        return [task]
+
+    def build_manifest_tasks(self, name, files_dir, top_dirs, items, when=None):
+        """
+        write the manifest of a staged subrole, and wrap its copy tasks so
+        they only run when the manifest recorded on the target differs:
+        a stat of one small file rather than comparing every file copied
+        """
+        if name == "files":
+            name = self.role_name
+        # hashed on as many threads as the files were staged on
+        manifest = build_manifest(files_dir, top_dirs, items, self.stager.workers)
+        checksum = write_manifest(
+            os.path.join(self.ansible_role_dir, "manifests", f"{name}.json"), manifest
+        )
+        manifest_dir = self.config.get("manifest_dir") or DEFAULT_CONFIG["manifest_dir"]
+        target_dir = os.path.join(manifest_dir, self.role_name)
+        target = os.path.join(target_dir, f"{name}.json")
+        register = re.sub(r"\W", "_", f"{name}_manifest")
+        changed = f"({register}.stat.checksum | default('')) != '{checksum}'"
+        if when:
+            changed = [when, changed]
+        tasks = [
+            {
+                "name": f"Check the {name} files manifest",
+                "ansible.builtin.stat": {
+                    "path": target,
+                    "checksum_algorithm": "sha256",
+                },
+                "register": register,
+            }
+        ]
+        if when:
+            tasks[0]["when"] = when
+        tasks.extend(self.build_copy_tasks(name, items, when=changed))
+        tasks.append(
+            {
+                "name": f"Create the {self.role_name} manifest directory",
+                "ansible.builtin.file": {
+                    "path": target_dir,
+                    "state": "directory",
+                    "mode": "0755",
+                },
+                "when": changed,
+            }
+        )
+        tasks.append(
+            {
+                "name": f"Record the {name} files manifest",
+                "ansible.builtin.copy": {
+                    "src": "{{ role_path }}/manifests/" + f"{name}.json",
+                    "dest": target,
+                    "mode": "0644",
+                },
+                "when": changed,
+            }
+        )
+        return tasks
+
     def get_output_dir(self):
         return self.role_output_dir
 
@@ -79,6 +224,7 @@ class SlackRoleProcessor(Processor):
     def move_to_start_using_list_comprehension(self, my_list, element):
         return [item for item in my_list if item == element] + [item for item in my_list if item != element]
 
+    @profiled("stage_files", size=lambda self: self.stager.bytes)
     def process_files(self):
         """
         See issues.md for dicsussion
@@ -90,82 +236,195 @@ class SlackRoleProcessor(Processor):
         logging.debug(f"files_dir {files_dir}")
         logging.debug(f"self.role_dir {self.role_dir}")
 
-        role_file_dirs = glob.glob(f"{self.role_dir}/files*", recursive=False)
+        role_file_dirs = self.inventory.subrole_dirs()
         role_file_dirs = self.move_to_start_using_list_comprehension(role_file_dirs, ' files')
-        # for role_file_dir in glob.glob(f"{self.role_dir}/files*", recursive=False):
+        # fresh counts for each run
+        self.stager = Stager.from_config(self.config)
         for role_file_dir in role_file_dirs:
-            logging.debug(f"role_file_dir {role_file_dir}")
-
-            # files.wibble
-            # files
-            subrole_name = os.path.basename(role_file_dir)
-            logging.debug(f"  subrole_name  {subrole_name}")
-            if subrole_name == 'files':
-                # files
-                ans_files_dir_name = subrole_name
-                # /tmp/roles/foo/files
-                ans_sub_role_files_path = os.path.join(self.ansible_role_dir, "files")
-                when = None
-            else:
-                # NOTE: this is the mapping from slack subrole files dir to
-                #       ansible files dir
-                # foo.wibble
-                ans_files_dir_name = subrole_name.replace('files', self.role_name)
-
-                # /tmp/roles/foo/files/files.wibble
-                ans_sub_role_files_path = os.path.join(self.ansible_role_dir, "files", ans_files_dir_name)
-                when = f"sub_role is '{ans_files_dir_name}'"
-
-            task_container = TaskContainer(ans_files_dir_name)
-            self.task_containers.append(task_container)
-            logging.debug(f"  ans_files_dir_name {ans_files_dir_name}")
-            logging.debug(f"  ans_sub_role_files_path {ans_sub_role_files_path}")
-            # examples/slack/roles/foo/files.wibble/etc
-            for file_name in glob.glob(f"{role_file_dir}/*", recursive=False):
-                if os.path.isdir(file_name):
-                    logging.debug(f"    file_name {file_name} found dir , processing...")
-                    # etc
-                    relative_path = os.path.relpath(file_name, role_file_dir)
-                    logging.debug(f"    relative_path {relative_path}")
-                    # where we need to copy it to now
-                    build_dest_path = os.path.join(
-                        ans_sub_role_files_path, relative_path
-                    )
-                    logging.debug(f"    build_dest_path {build_dest_path}")
-                    shutil.copytree(file_name, build_dest_path, dirs_exist_ok=True, ignore_dangling_symlinks=True)
-                    # foo.wibble/etc
-                    task_src_path = os.path.join(ans_files_dir_name, relative_path)
-                    logging.debug(f"    task_src_path  {task_src_path}")
-                    # /etc
-                    task_dest_path = os.path.join("/", relative_path)
-                    logging.debug(f"    task_dest_path {task_dest_path}")
-                    copy_task = self.build_ansible_copy(task_src_path, task_dest_path, when=when)
-                    task_container.add_task(
-                        copy_task
-                    )
+            self.task_containers.append(self.process_subrole_files(role_file_dir))
+        logging.info(f"Staged files of Slack role {self.role_name}: {self.stager.counts()}")
         return True
 
+    def get_subrole_task_name(self, subrole_name):
+        """
+        files       -> files
+        files.wibble -> foo.wibble
+        """
+        if subrole_name == 'files':
+            return subrole_name
+        # NOTE: this is the mapping from slack subrole files dir to
+        #       ansible files dir
+        return subrole_name.replace('files', self.role_name)
+
+    def process_subrole_files(self, role_file_dir):
+        """
+        stage the files of one slack subrole, and build its copy tasks
+        """
+        logging.debug(f"role_file_dir {role_file_dir}")
+
+        # files.wibble
+        # files
+        subrole_name = os.path.basename(role_file_dir)
+        logging.debug(f"  subrole_name  {subrole_name}")
+        # foo.wibble
+        ans_files_dir_name = self.get_subrole_task_name(subrole_name)
+        if subrole_name == 'files':
+            # /tmp/roles/foo/files
+            ans_sub_role_files_path = os.path.join(self.ansible_role_dir, "files")
+            when = None
+        else:
+            # /tmp/roles/foo/files/files.wibble
+            ans_sub_role_files_path = os.path.join(self.ansible_role_dir, "files", ans_files_dir_name)
+            when = f"sub_role is '{ans_files_dir_name}'"
+
+        task_container = TaskContainer(ans_files_dir_name)
+        logging.debug(f"  ans_files_dir_name {ans_files_dir_name}")
+        logging.debug(f"  ans_sub_role_files_path {ans_sub_role_files_path}")
+        staged = set()
+        trees = []
+        items = []
+        # examples/slack/roles/foo/files.wibble/etc
+        for file_name in self.inventory.top_dirs(subrole_name):
+            logging.debug(f"    file_name {file_name} found dir , processing...")
+            # etc
+            relative_path = os.path.relpath(file_name, role_file_dir)
+            logging.debug(f"    relative_path {relative_path}")
+            # where we need to copy it to now
+            build_dest_path = os.path.join(
+                ans_sub_role_files_path, relative_path
+            )
+            logging.debug(f"    build_dest_path {build_dest_path}")
+            trees.append((file_name, build_dest_path))
+            staged.add(relative_path)
+            # foo.wibble/etc
+            task_src_path = os.path.join(ans_files_dir_name, relative_path)
+            logging.debug(f"    task_src_path  {task_src_path}")
+            # /etc
+            task_dest_path = os.path.join("/", relative_path)
+            logging.debug(f"    task_dest_path {task_dest_path}")
+            items.append((task_src_path, task_dest_path))
+        self.stager.sync_trees(trees)
+        self.prune_subrole_files(subrole_name, ans_sub_role_files_path, staged)
+        if self.config.get("copy_manifests") and items:
+            copy_tasks = self.build_manifest_tasks(
+                ans_files_dir_name, ans_sub_role_files_path, sorted(staged), items, when=when
+            )
+        else:
+            copy_tasks = self.build_copy_tasks(ans_files_dir_name, items, when=when)
+        for copy_task in copy_tasks:
+            task_container.add_task(
+                copy_task
+            )
+        return task_container
+
+    def prune_subrole_files(self, subrole_name, ans_sub_role_files_path, staged):
+        """
+        remove top level directories no longer in the slack subrole.
+        The other subroles are staged within files/, so are kept
+        """
+        if not os.path.isdir(ans_sub_role_files_path):
+            return
+        keep = set(staged)
+        if subrole_name == "files":
+            keep |= {
+                name
+                for name in os.listdir(ans_sub_role_files_path)
+                if name.startswith(f"{self.role_name}.")
+            }
+        self.stager.prune(ans_sub_role_files_path, keep)
+
+    def process_script(self, fname):
+        """
+        convert one of the role scripts, None if the role does not have it
+        """
+        script_name = self.inventory.scripts.get(fname)
+        if script_name is None:
+            return None
+        logging.info(f"{script_name} found, processing...")
+        task_container = self.parse_script(script_name)
+        task_container.name = fname
+        return task_container
+
+    def build_generator(self):
+        return GeneratorFactory.build_generator(
+            self.config["generator"], self, self.config.get("output_format", "yaml")
+        )
+
+    def scan(self):
+        self.inventory = RoleInventory(self.role_dir)
+        return self.inventory
+
     def process(self):
         self.task_containers = []
+        self.scan()
         self.process_files()
 
-        script_dir = os.path.join(self.role_dir, "scripts")
-
-        for fname in ("fixfiles", "preinstall", "postinstall"):
-            script_name = os.path.join(script_dir, fname)
-            if os.path.isfile(script_name):
-                # task_container = TaskContainer(fname)
-                logging.info(f"{script_name} found, processing...")
-                parser = ParserFactory.get_parser(
-                    file_path=script_name, config=self.config
-                )
-                task_container = parser.parse()
-                task_container.name = fname
+        for fname in self.SCRIPT_NAMES:
+            task_container = self.process_script(fname)
+            if task_container is not None:
                 self.task_containers.append(task_container)
-        generator = GeneratorFactory.build_generator(
-            self.config["generator"], self, self.config.get("output_format", "yaml")
-        )
-        generator.generate()
+        self.passes = PassManager.from_config(self.config)
+        self.passes.run(self.task_containers)
+        self.passes.log_report(self.role_name)
+        self.build_generator().generate()
+        self.log_cache()
+
+    def get_watch_paths(self):
+        """
+        the slack inputs of this role: its files* subroles and scripts
+        """
+        return RoleInventory(self.role_dir).watch_paths()
+
+    def get_task_source(self, path):
+        """
+        the task container (tasks/<name>.yml) fed by an input path,
+        and the subrole directory or script it is built from
+        """
+        parts = os.path.relpath(path, self.role_dir).split(os.sep)
+        if parts[0] == "scripts" and len(parts) == 2 and parts[1] in self.SCRIPT_NAMES:
+            return parts[1], path
+        if parts[0].startswith("files"):
+            return self.get_subrole_task_name(parts[0]), os.path.join(self.role_dir, parts[0])
+        return None, None
+
+    def update(self, changed_paths):
+        """
+        re-convert only the subroles and scripts fed by changed_paths,
+        falling back to a full conversion when subroles or scripts
+        come or go
+        """
+        sources = {}
+        for path in changed_paths:
+            name, source = self.get_task_source(path)
+            if name is not None:
+                sources[name] = source
+        if not sources:
+            return set()
+        self.scan()
+        existing = {task_container.name for task_container in self.task_containers}
+        if any(name not in existing or not os.path.exists(source) for name, source in sources.items()):
+            logging.info(f"Slack role {self.role_name} changed shape, re-processing")
+            self.process()
+            return set(sources)
+        if PassManager.from_config(self.config).spans_containers:
+            # a duplicate dropped from one task file may no longer be one
+            logging.info(f"Slack role {self.role_name} changed, re-processing to optimise across its tasks")
+            self.process()
+            return set(sources)
+        for index, task_container in enumerate(self.task_containers):
+            source = sources.get(task_container.name)
+            if source is None:
+                continue
+            if os.path.isdir(source):
+                self.task_containers[index] = self.process_subrole_files(source)
+            else:
+                self.task_containers[index] = self.process_script(task_container.name)
+            self.passes.run([self.task_containers[index]])
+        self.passes.log_report(self.role_name)
+        logging.info(f"Slack role {self.role_name}: regenerating {', '.join(sorted(sources))}")
+        self.build_generator().generate(only=set(sources))
+        self.log_cache()
+        return set(sources)
 
 
 class ScriptProcessor(Processor):
@@ -183,11 +442,98 @@ class ScriptProcessor(Processor):
         self.task_containers = []
         # self.tasks = []
         # task_container = TaskContainer("bash_script")
-        parser = ParserFactory.get_parser(file_path=self.file_name, config=self.config)
-        task_container = parser.parse()
+        task_container = self.parse_script(self.file_name)
         task_container.name = "bash_script"
         self.task_containers.append(task_container)
+        self.passes = PassManager.from_config(self.config)
+        self.passes.run(self.task_containers)
+        self.passes.log_report(self.file_name)
         generator = GeneratorFactory.build_generator(
             self.config["generator"], self, self.config.get("output_format", "yaml")
         )
         generator.generate()
+        self.log_cache()
+
+    def get_watch_paths(self):
+        return [self.file_name]
+
+    def update(self, changed_paths):
+        """
+        a script is a single input, so any change re-converts it
+        """
+        if not os.path.isfile(self.file_name):
+            return set()
+        logging.info(f"{self.file_name} changed, re-processing")
+        self.process()
+        return {self.output_file}
+
+
+def process_slack_role(role_dir, output_dir, config):
+    """
+    Convert a single slack role and summarise the outcome.
+    Lives at module level so it can be handed to a process pool.
+    """
+    role_name = config["role_name"]
+    logging.info(f"Processing Slack role from directory: {role_name}")
+    with role_profile(config, role_name) as profiler, profile_hooks(config, role_name):
+        try:
+            processor = SlackRoleProcessor(role_dir, output_dir, config)
+            processor.process()
+        except Exception as e:
+            logging.error(f"Failed to process Slack role {role_name}: {e}")
+            result = {"role": role_name, "status": "failed", "error": str(e)}
+        else:
+            tasks = sum(task_container.size() for task_container in processor.get_tasks())
+            result = {"role": role_name, "status": "ok", "tasks": tasks}
+    if profiler is not None:
+        result["profile"] = profiler.as_dict()
+    return result
+
+
+class SlackRolesProcessor:
+    """
+    A slack roles/ directory, each role is converted independently
+    so they can be spread across a pool of processes
+    """
+
+    def __init__(self, roles_dir, output_root, config):
+        self.roles_dir = roles_dir
+        self.output_root = output_root
+        self.config = config
+        self.jobs = config.get("jobs", 1) or os.cpu_count()
+        self.results = []
+
+    def get_roles(self):
+        roles = []
+        for role_name, role_dir in scan_roles(self.roles_dir):
+            output_dir = os.path.join(self.output_root, role_name)
+            roles.append((role_dir, output_dir, {**self.config, "role_name": role_name}))
+        return roles
+
+    def process(self):
+        roles = self.get_roles()
+        if self.jobs > 1 and len(roles) > 1:
+            logging.info(f"Processing {len(roles)} Slack roles with {self.jobs} jobs")
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(process_slack_role, *role) for role in roles]
+                self.results = [future.result() for future in futures]
+        else:
+            self.results = [process_slack_role(*role) for role in roles]
+        if profiling.active is not None:
+            for result in self.results:
+                if "profile" in result:
+                    profiling.active.merge(result.pop("profile"))
+        self.summary()
+        return self.results
+
+    def failures(self):
+        return [result for result in self.results if result["status"] != "ok"]
+
+    def summary(self):
+        failures = self.failures()
+        tasks = sum(result.get("tasks", 0) for result in self.results)
+        logging.info(
+            f"Processed {len(self.results)} Slack roles, {tasks} tasks, {len(failures)} failed"
+        )
+        for failure in failures:
+            logging.error(f"  {failure['role']}: {failure['error']}")
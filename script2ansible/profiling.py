@@ -0,0 +1,247 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# the profiler recording, if any. Checked by every profiled call, so
+# profiling costs one global lookup when it is off
+active = None
+
+
+class StageProfiler:
+    """
+    Wall time, calls and bytes processed for each stage of a conversion
+    (parsing, staging files, generating...) in total and per role, with
+    the wall time of each role as a whole.
+
+    Stages nest, a parse includes its lexing, so stage times are
+    inclusive and don't add up to the role's time. Parsers which stream
+    only do their work as the generator writes their tasks, so that
+    counts towards the generator
+    """
+
+    def __init__(self):
+        # stage -> {"seconds", "calls", "bytes"}
+        self.stages = {}
+        # role -> {"seconds", "stages": {stage -> {...}}}
+        self.roles = {}
+        self.role_name = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def add(stages, stage, seconds, calls, nbytes):
+        totals = stages.setdefault(stage, {"seconds": 0.0, "calls": 0, "bytes": 0})
+        totals["seconds"] += seconds
+        totals["calls"] += calls
+        totals["bytes"] += nbytes
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            self.add(self.stages, stage, seconds, 1, nbytes)
+            if self.role_name is not None:
+                role = self.roles[self.role_name]
+                self.add(role["stages"], stage, seconds, 1, nbytes)
+
+    @contextmanager
+    def role(self, role_name):
+        """
+        attribute the stages recorded within to role_name
+        """
+        previous, self.role_name = self.role_name, role_name
+        self.roles.setdefault(role_name, {"seconds": 0.0, "stages": {}})
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.roles[role_name]["seconds"] += time.perf_counter() - start
+            self.role_name = previous
+
+    @contextmanager
+    def activate(self):
+        """
+        record the profiled calls made within
+        """
+        global active
+        previous, active = active, self
+        try:
+            yield self
+        finally:
+            active = previous
+
+    def as_dict(self):
+        return {"stages": self.stages, "roles": self.roles}
+
+    def merge(self, profile):
+        """
+        add the as_dict() of another profiler, one from a --jobs worker
+        """
+        with self.lock:
+            for stage, totals in profile["stages"].items():
+                self.add(self.stages, stage, totals["seconds"], totals["calls"], totals["bytes"])
+            for role_name, role_profile in profile["roles"].items():
+                role = self.roles.setdefault(role_name, {"seconds": 0.0, "stages": {}})
+                role["seconds"] += role_profile["seconds"]
+                for stage, totals in role_profile["stages"].items():
+                    self.add(role["stages"], stage, totals["seconds"], totals["calls"], totals["bytes"])
+
+    def slowest_roles(self, top=10):
+        return sorted(self.roles.items(), key=lambda item: item[1]["seconds"], reverse=True)[:top]
+
+    def report(self, top=10):
+        lines = [f"{'stage':24} {'seconds':>10} {'calls':>8} {'bytes':>12}"]
+        for stage, totals in sorted(self.stages.items(), key=lambda item: item[1]["seconds"], reverse=True):
+            lines.append(
+                f"{stage:24} {totals['seconds']:10.3f} {totals['calls']:8} {totals['bytes']:12}"
+            )
+        roles = self.slowest_roles(top)
+        if roles:
+            lines.append(f"slowest {len(roles)} of {len(self.roles)} roles:")
+            for role_name, role in roles:
+                stages = ", ".join(
+                    f"{stage} {totals['seconds']:.3f}s"
+                    for stage, totals in sorted(
+                        role["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True
+                    )
+                )
+                lines.append(f"  {role_name:22} {role['seconds']:10.3f}  {stages}")
+        return "\n".join(lines)
+
+    def write(self, path, top=10):
+        profile = self.as_dict()
+        profile["slowest_roles"] = [role_name for role_name, role in self.slowest_roles(top)]
+        with open(path, "w") as f:
+            json.dump(profile, f, indent=2)
+        logging.info(f"Wrote profile to {path}")
+
+
+def profiled(stage, size=None):
+    """
+    decorator recording each call as stage, when a profiler is active.
+    size(*args, **kwargs) gives the bytes the call processed, once it's done
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = active
+            if profiler is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                try:
+                    nbytes = size(*args, **kwargs) if size else 0
+                except OSError:
+                    nbytes = 0
+                profiler.record(stage, seconds, nbytes)
+        return wrapper
+    return decorator
+
+
+def script_size(parser, *args, **kwargs):
+    if parser.file_path:
+        return os.path.getsize(parser.file_path)
+    return len((parser.script_string or "").encode())
+
+
+def output_size(generator, *args, **kwargs):
+    """
+    bytes written by a generator, its task files or output file
+    """
+    output_file = getattr(generator.processor, "output_file", None)
+    if output_file:
+        return os.path.getsize(output_file)
+    tasks_dir = os.path.join(generator.processor.get_output_dir(), "tasks")
+    with os.scandir(tasks_dir) as entries:
+        return sum(entry.stat().st_size for entry in entries if entry.is_file())
+
+
+@contextmanager
+def in_role(role_name):
+    """
+    attribute what is recorded within to role_name, when profiling
+    """
+    if active is None:
+        yield
+        return
+    with active.role(role_name):
+        yield
+
+
+@contextmanager
+def role_profile(config, role_name):
+    """
+    a fresh profiler, active for a role when profiling is configured,
+    so a --jobs worker can hand back its profile. Else None
+    """
+    if not config.get("profile"):
+        yield None
+        return
+    profiler = StageProfiler()
+    with profiler.activate(), profiler.role(role_name):
+        yield profiler
+
+
+def suffixed(path, suffix):
+    """
+    out.pstats, foo -> out.foo.pstats
+    """
+    if not suffix:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{suffix}{ext}"
+
+
+@contextmanager
+def profile_hooks(config, suffix=None):
+    """
+    cProfile and tracemalloc around a conversion, as configured:
+    cprofile:     write pstats to this path, with suffix (the role) added
+                  when converting many roles
+    tracemalloc:  log the peak and the top allocation sites
+                  (tracemalloc_top of them)
+    """
+    cprofile = config.get("cprofile")
+    trace = config.get("tracemalloc") and not tracemalloc.is_tracing()
+    profile = None
+    if trace:
+        tracemalloc.start()
+    if cprofile:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.disable()
+        if trace:
+            # before the stats are dumped, which allocate too
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            log_allocations(snapshot, peak, config.get("tracemalloc_top", 10), suffix)
+        if profile is not None:
+            path = suffixed(cprofile, suffix)
+            profile.dump_stats(path)
+            logging.info(f"Wrote cProfile stats to {path}")
+
+
+def log_allocations(snapshot, peak, top=10, suffix=None):
+    snapshot = snapshot.filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+    )
+    statistics = snapshot.statistics("lineno")
+    label = f" of {suffix}" if suffix else ""
+    logging.info(f"Peak traced memory{label}: {peak / 1024 / 1024:.1f}MB, top {top} allocation sites still held:")
+    for statistic in statistics[:top]:
+        logging.info(f"  {statistic}")
@@ -0,0 +1,242 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import DEFAULT_CONFIG
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+# from linux/fs.h, only in fcntl itself from python 3.12
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+STAGE_MODES = ("copy", "hardlink", "reflink", "symlink")
+
+# the filesystem can't do it, rather than something being wrong
+UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EMLINK,
+}
+
+
+class Stager:
+    """
+    Stages a file from the slack role into the ansible role, as a copy_function
+    for shutil.copytree.
+
+    copy:     a plain copy
+    hardlink: os.link, when both are on the one filesystem
+    reflink:  a copy-on-write clone (FICLONE) on btrfs, xfs etc,
+              else copy_file_range, which the kernel may do without
+              reading the data through user space
+    symlink:  a link back to the slack file
+
+    Whatever the filesystem won't do falls back to a plain copy, and
+    isn't tried again by this Stager
+
+    sync_trees() only stages the files which changed, rsync like,
+    spread over workers threads
+    """
+
+    def __init__(self, mode="copy", checksum=False, workers=1):
+        if mode not in STAGE_MODES:
+            raise ValueError(f"Unknown stage mode: {mode}")
+        self.mode = mode
+        self.checksum = checksum
+        self.workers = workers or os.cpu_count()
+        self.lock = threading.Lock()
+        self.fallbacks = 0
+        self.copied = 0
+        self.skipped = 0
+        self.removed = 0
+        # of the files staged
+        self.bytes = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config.get("stage_mode") or "copy",
+            config.get("stage_checksum", False),
+            config.get("copy_workers", DEFAULT_CONFIG["copy_workers"]),
+        )
+
+    def counts(self):
+        return f"{self.copied} copied, {self.skipped} unchanged, {self.removed} removed"
+
+    def sync_tree(self, src, dst):
+        return self.sync_trees([(src, dst)])
+
+    def sync_trees(self, trees):
+        """
+        for each (src, dst), as shutil.copytree(src, dst, copy_function=self,
+        dirs_exist_ok=True, ignore_dangling_symlinks=True), but files which
+        are unchanged are left alone, and whatever is no longer in src
+        is removed from dst.
+        The trees are walked once, then the files are synced on the
+        worker threads
+        """
+        dirs = []
+        files = []
+        for src, dst in trees:
+            self.plan(src, dst, dirs, files)
+        if self.workers > 1 and len(files) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                copied = list(executor.map(self.sync_file, files))
+        else:
+            copied = [self.sync_file(file) for file in files]
+        self.copied += sum(copied)
+        self.skipped += len(copied) - sum(copied)
+        self.bytes += sum(file[2].st_size for file, was_copied in zip(files, copied) if was_copied)
+        # as copytree, directories get their permissions once filled
+        for src_dir, dst_dir in reversed(dirs):
+            shutil.copystat(src_dir, dst_dir)
+
+    def plan(self, src, dst, dirs, files):
+        """
+        walk src, making the directories of dst and removing whatever is
+        no longer in src. Adds the (src, dst) directories, parents first,
+        to dirs and the (src, dst, src stat) files to files
+        """
+        pending = [(src, dst)]
+        while pending:
+            src_dir, dst_dir = pending.pop()
+            os.makedirs(dst_dir, exist_ok=True)
+            dirs.append((src_dir, dst_dir))
+            names = set()
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    dst_path = os.path.join(dst_dir, entry.name)
+                    # like copytree, symlinks are followed
+                    if entry.is_dir():
+                        names.add(entry.name)
+                        if os.path.islink(dst_path) or os.path.isfile(dst_path):
+                            os.unlink(dst_path)
+                        pending.append((entry.path, dst_path))
+                        continue
+                    try:
+                        src_stat = os.stat(entry.path)
+                    except FileNotFoundError:
+                        # dangling symlink
+                        continue
+                    names.add(entry.name)
+                    if os.path.isdir(dst_path) and not os.path.islink(dst_path):
+                        self.remove(dst_path)
+                    files.append((entry.path, dst_path, src_stat))
+            self.prune(dst_dir, names)
+
+    def sync_file(self, file):
+        """
+        stage one planned file, True when it needed it
+        """
+        src, dst, src_stat = file
+        if self.unchanged(src, src_stat, dst):
+            return False
+        self(src, dst)
+        return True
+
+    def unchanged(self, src, src_stat, dst):
+        """
+        dst is already what staging src would make it, going on size,
+        permissions and mtime, or content when checksumming
+        """
+        try:
+            dst_stat = os.lstat(dst)
+        except FileNotFoundError:
+            return False
+        if stat.S_ISLNK(dst_stat.st_mode):
+            return self.mode == "symlink" and os.readlink(dst) == os.path.abspath(src)
+        if self.mode == "symlink":
+            return False
+        if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+            return True
+        if (
+            dst_stat.st_size != src_stat.st_size
+            or stat.S_IMODE(dst_stat.st_mode) != stat.S_IMODE(src_stat.st_mode)
+        ):
+            return False
+        if self.checksum:
+            return file_digest(src) == file_digest(dst)
+        return dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+
+    def prune(self, dst, keep):
+        """
+        remove everything in dst but the names in keep
+        """
+        with os.scandir(dst) as entries:
+            for entry in entries:
+                if entry.name not in keep:
+                    self.remove(entry.path)
+
+    def remove(self, path):
+        logging.debug(f"removing {path}, no longer in the slack role")
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                self.removed += len(file_names)
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+            self.removed += 1
+
+    def __call__(self, src, dst):
+        if os.path.lexists(dst):
+            # never write through an earlier hard or sym link into the source
+            os.unlink(dst)
+        try:
+            if self.mode == "hardlink":
+                os.link(src, dst)
+            elif self.mode == "symlink":
+                os.symlink(os.path.abspath(src), dst)
+            elif self.mode == "reflink":
+                reflink(src, dst)
+            else:
+                shutil.copy2(src, dst)
+        except OSError as e:
+            if self.mode == "copy" or e.errno not in UNSUPPORTED:
+                raise
+            with self.lock:
+                if self.mode != "copy":
+                    logging.info(f"Cannot {self.mode} {src} ({e.strerror}), copying instead")
+                    self.mode = "copy"
+                self.fallbacks += 1
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            shutil.copy2(src, dst)
+        return dst
+
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            if fcntl is None:
+                raise OSError(errno.ENOSYS, "no fcntl")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in UNSUPPORTED or not hasattr(os, "copy_file_range"):
+                raise
+            copy_file_range(fsrc.fileno(), fdst.fileno())
+    shutil.copystat(src, dst)
+
+
+def copy_file_range(fd_src, fd_dst):
+    while os.copy_file_range(fd_src, fd_dst, 1 << 30):
+        pass
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,3 +1,123 @@
+import sys
+from collections.abc import Mapping, MutableMapping
+
+# a task keyword which isn't set
+UNSET = object()
+
+
+class Task(MutableMapping):
+    """
+    An ansible task, as a mapping of its keywords, but held in slots
+    rather than a dict of its own, with the module name interned:
+        {"name": .., "ansible.builtin.file": {..}, "register": ..}
+    The module is the first key which isn't a task keyword, anything
+    else is kept in extras.
+    Keys come out as name, module, register, extras, when, loop.
+    as_dict() is the plain dict, for serialising
+    """
+
+    __slots__ = ("name", "module", "args", "register", "when", "loop", "extras")
+
+    SLOTS = ("name", "register", "when", "loop")
+    # task keywords, which are never the module
+    KEYWORDS = frozenset(
+        (
+            "name", "register", "when", "loop", "args", "become", "become_user",
+            "changed_when", "failed_when", "ignore_errors", "notify", "tags",
+            "vars", "environment", "delegate_to", "run_once", "no_log",
+            "loop_control", "with_items", "until", "retries", "delay",
+            "check_mode", "diff", "listen", "timeout", "throttle",
+        )
+    )
+
+    def __init__(self, task=()):
+        self.name = self.module = self.args = UNSET
+        self.register = self.when = self.loop = UNSET
+        self.extras = None
+        for key, value in task.items() if isinstance(task, Mapping) else task:
+            self[key] = value
+
+    @classmethod
+    def of(cls, task):
+        """
+        task as a Task, without copying it when it already is one
+        """
+        return task if isinstance(task, cls) else cls(task)
+
+    def __getitem__(self, key):
+        if key in self.SLOTS:
+            value = getattr(self, key)
+        elif key == self.module:
+            value = self.args
+        elif self.extras is not None:
+            value = self.extras.get(key, UNSET)
+        else:
+            value = UNSET
+        if value is UNSET:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.SLOTS:
+            setattr(self, key, value)
+        elif key == self.module:
+            self.args = value
+        elif self.module is UNSET and key not in self.KEYWORDS:
+            self.module = sys.intern(key)
+            self.args = value
+        else:
+            if self.extras is None:
+                self.extras = {}
+            self.extras[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        if key in self.SLOTS:
+            setattr(self, key, UNSET)
+        elif key == self.module:
+            self.module = self.args = UNSET
+        else:
+            del self.extras[key]
+            if not self.extras:
+                self.extras = None
+
+    def __iter__(self):
+        if self.name is not UNSET:
+            yield "name"
+        if self.module is not UNSET:
+            yield self.module
+        if self.register is not UNSET:
+            yield "register"
+        if self.extras is not None:
+            yield from self.extras
+        if self.when is not UNSET:
+            yield "when"
+        if self.loop is not UNSET:
+            yield "loop"
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Task({self.as_dict()!r})"
+
+    def __reduce__(self):
+        # UNSET is only UNSET within this process
+        return Task, (self.as_dict(),)
+
+    def as_dict(self):
+        return {key: self[key] for key in self}
+
+
+def to_plain(obj):
+    """
+    json default=, serialising Tasks as plain dicts
+    """
+    if isinstance(obj, Task):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
 class TaskContainer:
     """
     could be a playbook, could be a role task file
@@ -6,6 +126,9 @@ class TaskContainer:
         self.name = name
         self._tasks = []
         self._variables = []
+        # tasks still to be produced, see stream()
+        self._source = None
+        self.streamed = 0
 
     def add_variable(self, key, value):
         self._variables.append({key: value})
@@ -20,17 +143,63 @@ class TaskContainer:
 
     @property
     def tasks(self):
+        self.materialise()
         return self._tasks
     
     @tasks.setter
     def tasks(self,tusks):
-         self._tasks = tusks
+         self._tasks = [Task.of(task) for task in tusks]
+         self._source = None
+
+    def get_tasks(self):
+        return self.tasks
+
+    def stream(self, source):
+        """
+        Tasks are to be pulled from the iterable source as they are
+        written, rather than held in the container.
+        Accessing tasks pulls them all in
+        """
+        self._source = source
+
+    def pipe(self, fn):
+        """
+        pass the tasks still to be streamed through fn(held, source), a
+        generator given the tasks already held and the source, which
+        yields the source's tasks. False when nothing is streamed
+        """
+        if self._source is None:
+            return False
+        self._source = fn(list(self._tasks), self._source)
+        return True
+
+    def materialise(self):
+        if self._source is not None:
+            source, self._source = self._source, None
+            self._tasks.extend(map(Task.of, source))
+
+    def iter_tasks(self):
+        """
+        yield the tasks, pulling streamed tasks through without keeping them
+        """
+        yield from self._tasks
+        if self._source is not None:
+            source, self._source = self._source, None
+            for task in source:
+                self.streamed += 1
+                yield task
+
+    def size(self):
+        """
+        number of tasks held, or already streamed through
+        """
+        return len(self._tasks) + self.streamed
 
     def add_task(self, task):
-        self._tasks.append(task)
+        self._tasks.append(Task.of(task))
 
     def clear_tasks(self):
         self._tasks = []
 
     def empty(self):
-        return len(self._tasks) == 0
+        return len(self.tasks) == 0
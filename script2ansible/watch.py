@@ -0,0 +1,317 @@
+import os
+import struct
+import time
+import logging
+
+from .processors import SlackRoleProcessor
+
+try:
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):  # pragma: no cover
+    # not linux
+    libc = None
+
+# from sys/inotify.h
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+# struct inotify_event, followed by len bytes of name
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def snapshot(paths):
+    """
+    mtime and size of every file under paths, keyed on file path
+    """
+    state = {}
+    for path in paths:
+        if os.path.isfile(path):
+            st = os.stat(path)
+            state[path] = (st.st_mtime_ns, st.st_size)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    # dangling symlink, or removed since the walk
+                    continue
+                state[file_path] = (st.st_mtime_ns, st.st_size)
+    return state
+
+
+def restat(state, path):
+    """
+    bring the entries of a snapshot for path, a file or a directory, up
+    to date, returning the files whose entries changed
+    """
+    old = {}
+    if path in state:
+        old[path] = state.pop(path)
+    elif not os.path.isfile(path):
+        # a directory, or gone: whatever was held under it
+        prefix = os.path.join(path, "")
+        for file_path in [file_path for file_path in state if file_path.startswith(prefix)]:
+            old[file_path] = state.pop(file_path)
+    new = snapshot([path]) if os.path.exists(path) else {}
+    state.update(new)
+    return {file_path for file_path in old.keys() | new.keys() if old.get(file_path) != new.get(file_path)}
+
+
+class TreeEvents:
+    """
+    The paths changed under some directories and files, read from
+    inotify, so finding them costs the events rather than a walk and a
+    stat of every file.
+
+    Files (and paths which don't exist yet) are watched through their
+    directory, so are seen when replaced by a rename.
+    changed() is None when what changed can't be told: events were
+    dropped, or a watched directory went or appeared
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> directory
+        self.dirs = {}
+        # the watch descriptors of directories within the watched trees
+        self.tree_wds = set()
+        self.roots = set()
+        self.files = set()
+        self.lost = False
+        for path in self.paths:
+            if os.path.isdir(path):
+                self.roots.add(path)
+                self.watch_tree(path)
+            else:
+                self.files.add(path)
+                self.watch(os.path.dirname(path))
+
+    def watch(self, dir_path):
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            # gone already, its parent's event says so
+            return None
+        self.dirs[wd] = dir_path
+        return wd
+
+    def watch_tree(self, path):
+        for dir_path, dir_names, file_names in os.walk(path):
+            wd = self.watch(dir_path)
+            if wd is not None:
+                self.tree_wds.add(wd)
+
+    def read(self):
+        """
+        the events pending, as (watch descriptor, mask, name)
+        """
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                yield wd, mask, os.fsdecode(name)
+
+    def changed(self):
+        changed = set()
+        for wd, mask, name in self.read():
+            if mask & IN_Q_OVERFLOW:
+                self.lost = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                self.tree_wds.discard(wd)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory in self.roots:
+                    self.lost = True
+                continue
+            if not name:
+                # the directory itself, what it holds is reported by name
+                continue
+            path = os.path.join(directory, name)
+            if wd in self.tree_wds:
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(path)
+                changed.add(path)
+            elif path in self.files:
+                if os.path.isdir(path):
+                    # a watched path which didn't exist became a tree
+                    self.lost = True
+                changed.add(path)
+        return None if self.lost else changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def changed_paths(before, after):
+    return {
+        path
+        for path in before.keys() | after.keys()
+        if before.get(path) != after.get(path)
+    }
+
+
+class Watcher:
+    """
+    Polls the inputs of processors, and has each re-convert only what
+    its changed inputs feed.
+
+    A processor provides get_watch_paths() and update(changed_paths)
+
+    On linux the inputs are watched with inotify (unless watch_inotify
+    is false), so a poll only stats what the events name. Otherwise,
+    and when the watched paths change or events are lost, every input
+    is stat'ed and compared
+
+    When watching a slack roles/ directory, roles which appear are
+    converted and watched as well
+    """
+
+    def __init__(self, config, roles=None):
+        self.config = config
+        self.interval = config.get("watch_interval", 0.5)
+        self.roles = roles
+        self.role_processors = {}
+        self.processors = []
+        self.snapshots = {}
+        # processor -> TreeEvents
+        self.events = {}
+        self.inotify = libc is not None and config.get("watch_inotify", True)
+
+    def add(self, processor):
+        self.processors.append(processor)
+        self.snapshots[processor] = self.watch(processor, processor.get_watch_paths())
+
+    def remove(self, processor):
+        self.processors.remove(processor)
+        del self.snapshots[processor]
+        events = self.events.pop(processor, None)
+        if events is not None:
+            events.close()
+
+    def watch(self, processor, paths):
+        """
+        a snapshot of paths, the inputs of processor, which inotify
+        watches from then on when it can
+        """
+        events = self.events.pop(processor, None)
+        if events is not None:
+            events.close()
+        if self.inotify:
+            try:
+                # before the snapshot, so nothing is missed in between
+                self.events[processor] = TreeEvents(paths)
+            except OSError as e:
+                logging.warning(f"Can't watch with inotify, polling instead: {e}")
+                self.inotify = False
+        return snapshot(paths)
+
+    def changes(self, processor):
+        """
+        the input files of processor changed since the last call
+        """
+        before = self.snapshots[processor]
+        paths = processor.get_watch_paths()
+        events = self.events.get(processor)
+        touched = events.changed() if events is not None and events.paths == paths else None
+        if touched is None:
+            after = self.snapshots[processor] = self.watch(processor, paths)
+            return changed_paths(before, after)
+        changed = set()
+        for path in touched:
+            changed |= restat(before, path)
+        return changed
+
+    def add_roles(self):
+        """
+        convert and watch any slack roles not yet seen, one at a time
+        whatever --jobs says
+        """
+        role_dirs = set()
+        for role_dir, output_dir, config in self.roles.get_roles():
+            role_dirs.add(role_dir)
+            if role_dir in self.role_processors:
+                continue
+            try:
+                processor = SlackRoleProcessor(role_dir, output_dir, config)
+            except SystemExit:
+                # the role was removed since the roles were listed
+                continue
+            try:
+                processor.process()
+            except Exception as e:
+                logging.error(f"Failed to process Slack role {config['role_name']}: {e}")
+            self.role_processors[role_dir] = processor
+            self.add(processor)
+        for role_dir in list(self.role_processors):
+            if role_dir not in role_dirs:
+                logging.info(f"Slack role {role_dir} removed, no longer watching")
+                self.remove(self.role_processors.pop(role_dir))
+
+    def start(self):
+        if self.roles is not None:
+            self.add_roles()
+
+    def poll(self):
+        """
+        one pass over all the watched inputs,
+        returns the outputs which were regenerated
+        """
+        if self.roles is not None:
+            self.add_roles()
+        regenerated = set()
+        for processor in self.processors:
+            changed = self.changes(processor)
+            if not changed:
+                continue
+            logging.debug(f"changed: {sorted(changed)}")
+            try:
+                regenerated |= processor.update(changed)
+            except Exception as e:
+                logging.error(f"Failed to update from {sorted(changed)}: {e}")
+        return regenerated
+
+    def run(self):
+        self.start()
+        logging.info(f"Watching for changes every {self.interval}s, Ctrl-C to stop")
+        try:
+            while True:
+                time.sleep(self.interval)
+                self.poll()
+        except KeyboardInterrupt:
+            logging.info("Stopped watching")
@@ -0,0 +1,160 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+
+
+class PerlWorker:
+    """
+    A long lived perl process with the instrumentation compiled once.
+    Scripts are sent to it one at a time, and run in a forked child,
+    see PerlParser.WORKER_CODE
+    """
+
+    def __init__(self, program, env):
+        fd, self.program_path = tempfile.mkstemp(prefix="s2a_worker_", suffix=".pl")
+        with os.fdopen(fd, "w") as f:
+            f.write(program)
+        try:
+            self.process = subprocess.Popen(
+                ["perl", self.program_path],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                env=env,
+                text=True,
+            )
+            ready = self.process.stdout.readline()
+        finally:
+            # perl has compiled the lot by the time it reports ready
+            os.remove(self.program_path)
+        if not ready:
+            self.close()
+            raise RuntimeError("Perl worker failed to start")
+        self.busy = False
+        logging.debug(f"Started perl worker {self.process.pid}")
+
+    def run(self, name, code, env):
+        """
+        run a script, yielding its ops as they arrive,
+        returns (exit status, stderr)
+        """
+        request = {"name": name, "code": code, "env": env}
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+        self.busy = True
+        stderr = []
+        try:
+            for record in self.records():
+                if "done" in record:
+                    return record["status"], "".join(stderr)
+                if "warning" in record:
+                    stderr.append(record["warning"])
+                elif "error" in record:
+                    stderr.append(record["error"])
+                else:
+                    yield record
+        finally:
+            if self.busy:
+                # abandoned part way, skip to the end of this script
+                for record in self.records():
+                    pass
+        raise RuntimeError(f"Perl worker {self.process.pid} died running {name}")
+
+    def records(self):
+        for line in self.process.stdout:
+            record = json.loads(line)
+            if "done" in record:
+                self.busy = False
+            yield record
+            if not self.busy:
+                return
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class PerlWorkerPool:
+    """
+    Up to size PerlWorkers sharing the one program, started as needed.
+    Callers on several threads each get a worker to themselves
+    """
+
+    def __init__(self, program, env, size):
+        self.program = program
+        self.env = env
+        self.size = size
+        self.workers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.workers) < self.size:
+                worker = PerlWorker(self.program, self.env)
+                self.workers.append(worker)
+                return worker
+        return self.idle.get()
+
+    def run(self, name, code, env):
+        """
+        as PerlWorker.run(), the worker is held until the ops are read
+        """
+        worker = self.acquire()
+        try:
+            return (yield from worker.run(name, code, env))
+        finally:
+            if worker.busy:
+                # it died mid script
+                with self.lock:
+                    self.workers.remove(worker)
+                worker.close()
+            else:
+                self.idle.put(worker)
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.close()
+
+
+# pools are per process, a forked child must not share its parent's workers
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(program, env, size):
+    """
+    the pool running program. Env's tied variables are made when
+    the instrumentation loads, so workers start with the same
+    variable names a script will be given
+    """
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        key = (program, tuple(sorted(env)))
+        if key not in _pools:
+            _pools[key] = PerlWorkerPool(program, env, size)
+        return _pools[key]
+
+
+@atexit.register
+def close_pools():
+    if _pools_pid == os.getpid():
+        for pool in _pools.values():
+            pool.close()
+    _pools.clear()
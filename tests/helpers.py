@@ -0,0 +1,27 @@
+"""
+fixtures shared by the tests
+"""
+import os
+import shutil
+import tempfile
+
+EXAMPLE_ROLES = os.path.join(os.path.dirname(__file__), "..", "examples", "slack", "roles")
+EXAMPLE_ROLE = os.path.join(EXAMPLE_ROLES, "foo")
+
+
+def temp_dir(test):
+    """
+    a temporary directory, removed when test finishes
+    """
+    tmp_dir = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp_dir)
+    return tmp_dir
+
+
+def copy_role(roles_dir, role_name="foo"):
+    """
+    a copy of the example role, as role_name in roles_dir
+    """
+    role_dir = os.path.join(roles_dir, role_name)
+    shutil.copytree(EXAMPLE_ROLE, role_dir)
+    return role_dir
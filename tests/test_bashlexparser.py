@@ -1,6 +1,12 @@
 import unittest
 import os
-from script2ansible.BashLexParser import BashLexParser, BashScriptVisitor
+from script2ansible.BashLexParser import (
+    BashLexParser,
+    BashScriptVisitor,
+    COMMAND_SPECS,
+    register_command,
+    tokenize_variables,
+)
 
 
 class TestBashLexParser(unittest.TestCase):
@@ -259,6 +265,97 @@ done
         # The 'when' should reference MYVAR == 'wibble'
         # self.assertTrue(any("MYVAR" in str(t.get("when", "")) and "wibble" in str(t.get("when", "")) for t in echo_tasks))
 
+    def test_for_loop(self):
+        parser = BashLexParser(
+            script_string="""
+for s in server1 server2
+do
+    cp /tmp/${s}.txt /tmp/bar_${s}
+    mkdir -p /opt/$s
+done
+""",
+            config={},
+        )
+        tasks = [task.as_dict() for task in parser.parse().tasks]
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0]["ansible.builtin.copy"]["src"], "/tmp/{{ item }}.txt")
+        self.assertEqual(tasks[1]["ansible.builtin.file"]["path"], "/opt/{{ item }}")
+        self.assertEqual([task["loop"] for task in tasks], [["server1", "server2"]] * 2)
+
+    def test_for_loop_templated(self):
+        script = """
+for p in vim git; do apt install $p; done
+for p in a b; do
+  echo x$p > /tmp/$p
+  echo $p >> /tmp/list
+done
+"""
+        tasks = BashLexParser(script_string=script, config={}).parse().tasks
+        self.assertEqual(
+            [(task.module, task.args, task.loop) for task in tasks],
+            [
+                ("ansible.builtin.apt", {"name": "{{ item }}", "state": "present", "update_cache": True}, ["vim", "git"]),
+                ("ansible.builtin.copy", {"dest": "/tmp/{{ item }}", "content": "x{{ item }}"}, ["a", "b"]),
+                (
+                    "ansible.builtin.lineinfile",
+                    {"path": "/tmp/list", "line": "{{ item }}", "create": True, "insertafter": "EOF", "mode": "0644"},
+                    ["a", "b"],
+                ),
+            ],
+        )
+
+    def test_for_loop_unrolled(self):
+        cases = {
+            # the loop variable is parsed, not templated
+            "owner": ("for s in a b; do chown $s:grp /x; done", ["a", "b"]),
+            # a compound command in the body
+            "if": ("for s in a b; do\n  if [ $? -eq 0 ]; then\n    chown $s:grp /x\n  fi\ndone", ["a", "b"]),
+            # a command not known to be loop safe
+            "scp": ("for s in a b; do scp /x $s:/y; done\nchown root:root /x", ["root"]),
+        }
+        for case, (script, owners) in cases.items():
+            with self.subTest(case=case):
+                tasks = BashLexParser(script_string=script, config={"push": True}).parse().tasks
+                self.assertEqual(
+                    [task["ansible.builtin.file"]["owner"] for task in tasks if "ansible.builtin.file" in task],
+                    owners,
+                )
+                self.assertFalse(any("loop" in task for task in tasks))
+
+    def test_for_loop_values(self):
+        script = """
+HOSTS="h1 h2"
+for h in $HOSTS x; do
+  for n in 1 2; do
+    mkdir /opt/$h/$n
+  done
+done
+for h in; do mkdir /opt/$h; done
+"""
+        tasks = BashLexParser(script_string=script, config={}).parse().tasks
+        self.assertEqual(
+            [(task["ansible.builtin.file"]["path"], task["loop"]) for task in tasks],
+            [("/opt/h1/{{ item }}", ["1", "2"]), ("/opt/h2/{{ item }}", ["1", "2"]), ("/opt/x/{{ item }}", ["1", "2"])],
+        )
+        # the loop variable is only set within the loop
+        parser = BashLexParser(script_string=script, config={})
+        visitor = BashScriptVisitor([], parser)
+        for tree in parser.parse_trees():
+            visitor.visit(tree)
+        self.assertIsNone(visitor.get_variable("h"))
+        self.assertEqual(len(visitor.container.tasks), 3)
+
+    def test_for_loop_quoted_values(self):
+        script = """
+HOSTS="h1 h2"
+for h in "$HOSTS" $HOSTS '$HOSTS' pre$HOSTS"-post" ""; do
+  mkdir "/opt/$h"
+done
+"""
+        (task,) = BashLexParser(script_string=script, config={}).parse().tasks
+        # only the unquoted expansions are split
+        self.assertEqual(task["loop"], ["h1 h2", "h1", "h2", "$HOSTS", "preh1", "h2-post", ""])
+
     def test_scp_simple_push_and_pull(self):
         config = {
             "pull": True,
@@ -469,6 +566,86 @@ touch /tmp/bar_groob.txt
         # all non-exported variables are non-jinja
         # self.assertEqual(rendered,"flannel_{{ FOO }}","rendered BAR")
 
+    def test_default_expansion(self):
+        parser = BashLexParser(
+            script_string="""
+EMPTY=
+SET=given
+export EXPORTED=wibble
+mkdir -p ${UNSET:-/opt/default}
+mkdir -p ${EMPTY:-/opt/empty}
+mkdir -p ${EMPTY-/opt/not_used}
+mkdir -p ${SET:-/opt/not_used}/${UNSET:-$SET}
+touch /tmp/${EXPORTED:-nope}.txt
+""",
+            config={},
+        )
+        taskcontainer = parser.parse()
+        paths = [t["ansible.builtin.file"]["path"] for t in taskcontainer.tasks]
+        self.assertEqual(
+            paths,
+            ["/opt/default", "/opt/empty", "", "given/given", "/tmp/{{ EXPORTED }}.txt"],
+        )
+
+    def test_tokenize_variables(self):
+        segments = tokenize_variables("/tmp/${FOO}_$BAR.txt")
+        self.assertEqual(segments[0], "/tmp/")
+        self.assertEqual((segments[1].var, segments[1].raw), ("FOO", "${FOO}"))
+        self.assertEqual(segments[2], "_")
+        self.assertEqual((segments[3].var, segments[3].raw), ("BAR", "$BAR"))
+        self.assertEqual(segments[4], ".txt")
+        self.assertIs(segments, tokenize_variables("/tmp/${FOO}_$BAR.txt"))
+        self.assertEqual(tokenize_variables("plain"), ("plain",))
+
+    def test_register_command(self):
+        @register_command("rm", spec={"ov": set(), "o": {"-r", "-f"}})
+        def command_rm(visitor, cv):
+            visitor.container.add_task(
+                {
+                    "name": f"Remove {cv.args[0]}",
+                    "ansible.builtin.file": {
+                        "path": visitor.interpret_variable(cv.args[0]),
+                        "state": "absent",
+                        "recurse": "-r" in cv.options,
+                    },
+                }
+            )
+
+        self.addCleanup(COMMAND_SPECS.pop, "rm")
+        self.addCleanup(BashScriptVisitor.command_handlers.pop, "rm")
+        parser = BashLexParser(
+            script_string="""
+DIR=/tmp/wibble
+rm -r -f $DIR
+touch /tmp/foo.txt
+""",
+            config={},
+        )
+        taskcontainer = parser.parse()
+        self.assertEqual(len(taskcontainer.tasks), 2)
+        self.assertEqual(
+            taskcontainer.tasks[0]["ansible.builtin.file"],
+            {"path": "/tmp/wibble", "state": "absent", "recurse": True},
+        )
+
+    def test_environment(self):
+        parser = BashLexParser(
+            script_string="mkdir -p $STAGE/$HOSTNAME\n", config={"stage": "/srv/stage", "hostname": "web1"}
+        )
+        (tree,) = parser.parse_trees()
+        # positions are those of the script as written
+        self.assertEqual(tree.pos, (0, 25))
+        (task,) = parser.parse().tasks
+        self.assertEqual(task["ansible.builtin.file"]["path"], "/srv/stage/web1")
+        # as before, the script can assign over them
+        (task,) = BashLexParser(script_string="STAGE=/elsewhere\nmkdir $STAGE\n", config={}).parse().tasks
+        self.assertEqual(task["ansible.builtin.file"]["path"], "/elsewhere")
+
+    def test_blank(self):
+        for script in ("", "\n", "#!/bin/bash\n", "# nothing\n  \n    # to do\n"):
+            with self.subTest(script=script):
+                self.assertEqual(BashLexParser(script_string=script, config={}).parse().tasks, [])
+
 
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover
@@ -0,0 +1,30 @@
+import unittest
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+import bench  # noqa: E402
+import synthetic  # noqa: E402
+from script2ansible.BashLexParser import BashLexParser  # noqa: E402
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_bash(self):
+        script = synthetic.bash_script(100, variables=4, nesting=3)
+        self.assertEqual(script, synthetic.bash_script(100, variables=4, nesting=3))
+        self.assertEqual(script.count("if ["), script.count("fi\n"))
+        self.assertEqual(script.count("for item"), script.count("done\n"))
+        tasks = BashLexParser(script_string=script, config={}).parse().tasks
+        self.assertGreaterEqual(len(tasks), 100)
+
+    def test_quick_cases(self):
+        for name in bench.CASES:
+            with self.subTest(name=name):
+                result = bench.run_case(name, quick=True, repeat=1)
+                self.assertGreater(result["tasks"], 0)
+                self.assertGreater(result["peak_rss_kb"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
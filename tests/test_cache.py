@@ -0,0 +1,155 @@
+import unittest
+import os
+import shutil
+from unittest import mock
+from bashlex import parser as bashlex_parser
+from script2ansible.BashLexParser import BashLexParser
+from script2ansible import cache
+from script2ansible.cache import ConversionCache, ParseTreeCache
+from script2ansible.processors import ScriptProcessor
+from helpers import temp_dir
+
+
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.script_path = os.path.join(self.tmp_dir, "script.sh")
+        with open(self.script_path, "w") as f:
+            f.write("export FOO=wibble\nmkdir -p /tmp/$FOO\ntouch /tmp/bar.txt\n")
+        self.config = {
+            "input": self.script_path,
+            "output": os.path.join(self.tmp_dir, "playbook.yml"),
+            "generator": "playbook",
+            "cache_dir": self.cache_dir,
+        }
+
+    def test_round_trip(self):
+        cache = ConversionCache(self.cache_dir)
+        parser = BashLexParser(file_path=self.script_path, config=self.config)
+        key = cache.key(parser)
+        self.assertIsNone(cache.get(key))
+        task_container = parser.parse()
+        cache.put(key, task_container)
+        cached = cache.get(key)
+        self.assertEqual(cached.tasks, task_container.tasks)
+        self.assertEqual(cached.variables, [{"FOO": "wibble"}])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_key_tracks_content_and_config(self):
+        cache = ConversionCache(self.cache_dir)
+        key = cache.key(BashLexParser(file_path=self.script_path, config=self.config))
+        self.assertEqual(
+            key, cache.key(BashLexParser(file_path=self.script_path, config=self.config))
+        )
+        pushing = {**self.config, "push": True}
+        self.assertNotEqual(
+            key, cache.key(BashLexParser(file_path=self.script_path, config=pushing))
+        )
+        with mock.patch("script2ansible.cache.TRANSLATION_VERSION", -1):
+            self.assertNotEqual(
+                key, cache.key(BashLexParser(file_path=self.script_path, config=self.config))
+            )
+        with open(self.script_path, "a") as f:
+            f.write("touch /tmp/baz.txt\n")
+        self.assertNotEqual(
+            key, cache.key(BashLexParser(file_path=self.script_path, config=self.config))
+        )
+
+    def test_hit_skips_parse(self):
+        ScriptProcessor(self.script_path, self.config).process()
+        with open(self.config["output"]) as f:
+            first = f.read()
+        with mock.patch.object(BashLexParser, "parse") as parse:
+            ScriptProcessor(self.script_path, self.config).process()
+            parse.assert_not_called()
+        with open(self.config["output"]) as f:
+            self.assertEqual(f.read(), first)
+
+    def test_stream_fills_cache(self):
+        ScriptProcessor(self.script_path, self.config).process()
+        with open(self.config["output"]) as f:
+            parsed = f.read()
+        shutil.rmtree(self.cache_dir)
+        streaming = {**self.config, "stream": True}
+        with mock.patch.object(BashLexParser, "parse") as parse, self.assertLogs(level="INFO") as logs:
+            processor = ScriptProcessor(self.script_path, streaming)
+            processor.process()
+            parse.assert_not_called()
+        self.assertIn("INFO:root:Conversion cache: 0 hits, 1 misses", logs.output)
+        with mock.patch.object(BashLexParser, "stream") as stream:
+            ScriptProcessor(self.script_path, streaming).process()
+            stream.assert_not_called()
+        with open(self.config["output"]) as f:
+            self.assertEqual(f.read(), parsed)
+
+    def test_unfinished_stream_not_cached(self):
+        cache = ConversionCache(self.cache_dir)
+        parser = BashLexParser(file_path=self.script_path, config=self.config)
+        key = cache.key(parser)
+        task_container = parser.stream()
+        cache.record(key, task_container)
+        tasks = task_container.iter_tasks()
+        next(tasks)
+        tasks.close()
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(os.listdir(os.path.dirname(cache.entry_path(key))), [])
+
+
+class TestParseTreeCache(unittest.TestCase):
+    SCRIPT = "export FOO=wibble\nfor d in a b; do mkdir -p /tmp/$FOO/$d; done\n"
+
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.addCleanup(cache._tree_caches.clear)
+        self.parsed = []
+
+    def parse(self, source):
+        self.parsed.append(source)
+        return [source.upper()]
+
+    def test_lru(self):
+        trees = ParseTreeCache(size=2)
+        self.assertEqual(trees.parse("a", self.parse), ["A"])
+        trees.parse("b", self.parse)
+        trees.parse("a", self.parse)
+        # b is the least recently used
+        trees.parse("c", self.parse)
+        trees.parse("a", self.parse)
+        trees.parse("b", self.parse)
+        self.assertEqual(self.parsed, ["a", "b", "c", "b"])
+        self.assertEqual((trees.hits, trees.misses), (2, 4))
+
+    def test_disk(self):
+        ParseTreeCache(cache_dir=self.tmp_dir).parse("a", self.parse)
+        trees = ParseTreeCache(cache_dir=self.tmp_dir)
+        self.assertEqual(trees.parse("a", self.parse), ["A"])
+        self.assertEqual(self.parsed, ["a"])
+        self.assertEqual(trees.hits, 1)
+        # a broken entry is parsed again
+        with open(trees.entry_path(trees.key("a")), "w") as f:
+            f.write("not a pickle")
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(ParseTreeCache(cache_dir=self.tmp_dir).parse("a", self.parse), ["A"])
+        self.assertEqual(self.parsed, ["a", "a"])
+
+    def test_from_config(self):
+        self.assertIsNone(ParseTreeCache.from_config({"parse_cache_size": 0}))
+        shared = ParseTreeCache.from_config({})
+        self.assertIs(ParseTreeCache.from_config({"role_name": "other"}), shared)
+        self.assertIsNot(ParseTreeCache.from_config({"cache_dir": self.tmp_dir}), shared)
+
+    def test_parser(self):
+        uncached = BashLexParser(script_string=self.SCRIPT, config={"parse_cache_size": 0}).parse()
+        for config in ({}, {"cache_dir": self.tmp_dir}, {"cache_dir": self.tmp_dir}):
+            with mock.patch("script2ansible.BashLexParser.parser.parse", wraps=bashlex_parser.parse) as parse:
+                tasks = BashLexParser(script_string=self.SCRIPT, config=config).parse().tasks
+                again = BashLexParser(script_string=self.SCRIPT, config=config).parse().tasks
+            self.assertEqual(tasks, uncached.tasks)
+            self.assertEqual(again, uncached.tasks)
+            self.assertLessEqual(parse.call_count, 1)
+            cache._tree_caches.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,123 @@
+import unittest
+import glob
+import io
+import json
+import os
+import yaml
+from script2ansible.generators import (
+    CDumper,
+    GeneratorPlaybook,
+    IndenterDumper,
+    dump_yaml,
+    emits_identically,
+    write_tasks,
+)
+from script2ansible.BashLexParser import BashLexParser
+from script2ansible.utility import Task, to_plain
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), "..", "examples")
+
+SCRIPT = """
+export FOO=wibble
+umask 0077
+mkdir -p /opt/$FOO
+ln -s /usr/bin/python /opt/python-link
+ldconfig
+apt install -y foo bar
+echo "hello" >> /tmp/hello.txt
+if [ $? -eq 0 ]; then
+   echo "the echo succeeded" >> /tmp/ok.txt
+fi
+chmod -R 755 /opt
+"""
+
+
+def dump(data):
+    return yaml.dump(
+        data, sort_keys=False, Dumper=IndenterDumper, default_flow_style=False
+    )
+
+
+class TestGenerators(unittest.TestCase):
+    def setUp(self):
+        self.tasks = BashLexParser(script_string=SCRIPT, config={}).parse().tasks
+        self.play = {
+            "name": "Execute translated shell commands",
+            "hosts": "all",
+            "become": True,
+        }
+
+    def test_write_tasks_yaml(self):
+        f = io.StringIO()
+        write_tasks(f, iter(self.tasks))
+        self.assertEqual(f.getvalue(), dump(self.tasks))
+
+    def test_write_tasks_json(self):
+        f = io.StringIO()
+        write_tasks(f, iter(self.tasks), "json")
+        self.assertEqual(f.getvalue(), json.dumps(self.tasks, indent=2, default=to_plain))
+        f = io.StringIO()
+        write_tasks(f, iter([]), "json")
+        self.assertEqual(f.getvalue(), "[]")
+
+    def test_write_playbook(self):
+        for tasks in (self.tasks, []):
+            playbook = [{**self.play, "tasks": tasks}]
+            f = io.StringIO()
+            GeneratorPlaybook.write_yaml(f, self.play, iter(tasks))
+            self.assertEqual(f.getvalue(), dump(playbook))
+            f = io.StringIO()
+            GeneratorPlaybook.write_json(f, self.play, iter(tasks))
+            self.assertEqual(f.getvalue(), json.dumps(playbook, indent=2, default=to_plain))
+
+    def test_streamed_parse(self):
+        parser = BashLexParser(script_string=SCRIPT, config={})
+        task_container = parser.stream()
+        self.assertEqual(task_container.variables, [])
+        f = io.StringIO()
+        write_tasks(f, task_container.iter_tasks())
+        self.assertEqual(f.getvalue(), dump(self.tasks))
+        self.assertEqual(task_container.size(), len(self.tasks))
+        self.assertEqual(task_container.variables, [{"FOO": "wibble"}])
+
+    @unittest.skipUnless(yaml.__with_libyaml__, "libyaml not available")
+    def test_cdumper_matches_examples(self):
+        scripts = glob.glob(os.path.join(EXAMPLES, "bash", "*.sh")) + glob.glob(
+            os.path.join(EXAMPLES, "slack", "roles", "*", "scripts", "*")
+        )
+        tasks = [self.play]
+        for script in scripts:
+            with open(script) as f:
+                source = f.read()
+            if "perl" in source.partition("\n")[0]:
+                continue
+            tasks += BashLexParser(script_string=source, config={}).parse().tasks
+        fast = [task for task in tasks if emits_identically([task])]
+        self.assertTrue(fast)
+        for task in tasks:
+            python = dump([task])
+            self.assertEqual(dump_yaml([task]), python)
+            if task in fast:
+                self.assertEqual(
+                    yaml.dump(
+                        [task],
+                        sort_keys=False,
+                        Dumper=CDumper,
+                        default_flow_style=False,
+                    ),
+                    python,
+                )
+
+    def test_cdumper_fallback(self):
+        self.assertTrue(emits_identically([{"name": "ok", "file": {"mode": "0644"}}]))
+        self.assertFalse(emits_identically([{"name": "a \u2192 b"}]))
+        self.assertFalse(emits_identically([{"name": "a\tb"}]))
+        self.assertFalse(emits_identically([{"when": ["a", "b"]}]))
+        self.assertTrue(emits_identically([Task({"name": "ok", "file": {"mode": "0644"}})]))
+        self.assertFalse(emits_identically([Task({"name": "ok", "when": ["a"]})]))
+        for data in ([{"name": "a \u2192 b", "when": ["a"]}], [{"a": "x\ny " * 40}]):
+            self.assertEqual(dump_yaml(data), dump(data))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
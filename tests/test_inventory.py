@@ -0,0 +1,64 @@
+import unittest
+import os
+from unittest import mock
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.inventory import RoleInventory, scan_roles
+from script2ansible.processors import SlackRoleProcessor
+from helpers import EXAMPLE_ROLES, copy_role, temp_dir
+
+
+class TestRoleInventory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.role_dir = copy_role(self.tmp_dir)
+
+    def test_inventory(self):
+        os.makedirs(os.path.join(self.role_dir, "files", ".git"))
+        with open(os.path.join(self.role_dir, "files.txt"), "w") as f:
+            f.write("not a subrole\n")
+        with open(os.path.join(self.role_dir, "scripts", "README"), "w") as f:
+            f.write("not a script\n")
+        inventory = RoleInventory(self.role_dir)
+        self.assertEqual(sorted(inventory.subroles), ["files", "files.wibble", "files.wobble"])
+        self.assertEqual(
+            inventory.top_dirs("files.wibble"),
+            [os.path.join(self.role_dir, "files.wibble", "etc")],
+        )
+        self.assertEqual(inventory.top_dirs("files.missing"), [])
+        self.assertEqual(
+            inventory.scripts,
+            {"preinstall": os.path.join(self.role_dir, "scripts", "preinstall")},
+        )
+        self.assertIn(os.path.join(self.role_dir, "scripts"), inventory.watch_paths())
+
+    def test_scan_roles(self):
+        self.assertEqual(
+            sorted(name for name, path in scan_roles(EXAMPLE_ROLES)), ["bar", "foo"]
+        )
+
+    def test_processor_scans_once(self):
+        output = os.path.join(self.tmp_dir, "ansible")
+        config = {
+            **DEFAULT_CONFIG,
+            "input": self.role_dir,
+            "output": output,
+            "generator": "role",
+            "role_name": "foo",
+        }
+        processor = SlackRoleProcessor(self.role_dir, os.path.join(output, "roles", "foo"), config)
+        with mock.patch("os.scandir", side_effect=os.scandir) as scandir:
+            processor.process()
+        # the role, its three subroles and scripts/, then the staging walk
+        role_scans = [
+            call.args[0] for call in scandir.call_args_list
+            if os.path.dirname(call.args[0]) == self.role_dir or call.args[0] == self.role_dir
+        ]
+        self.assertEqual(len(role_scans), 5)
+        with open(os.path.join(output, "roles", "foo", "tasks", "main.yml")) as f:
+            main = f.read()
+        for name in ("files", "foo.wibble", "foo.wobble", "preinstall"):
+            self.assertIn(f"{name}.yml", main)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
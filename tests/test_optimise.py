@@ -0,0 +1,365 @@
+import unittest
+import os
+from unittest import mock
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.optimise import (
+    PassManager,
+    collapse_file_tasks,
+    dedupe_tasks,
+    drop_touch_tasks,
+    merge_package_tasks,
+    related,
+)
+from script2ansible.processors import ScriptProcessor, SlackRoleProcessor
+from script2ansible.utility import TaskContainer
+from helpers import copy_role, temp_dir
+
+
+def mkdir(path, register):
+    return {
+        "name": f"Ensure directory {path} exists",
+        "ansible.builtin.file": {"path": path, "state": "directory", "mode": "0755"},
+        "register": register,
+    }
+
+
+def install(packages, register):
+    return {
+        "name": f"Install packages: {packages}",
+        "ansible.builtin.apt": {"name": packages, "state": "present", "update_cache": True},
+        "register": register,
+    }
+
+
+def container(name, *tasks):
+    task_container = TaskContainer(name)
+    for task in tasks:
+        task_container.add_task(task)
+    return task_container
+
+
+class TestDedupe(unittest.TestCase):
+    def test_duplicates(self):
+        containers = [
+            container("preinstall", mkdir("/opt/a", "mkdir_1"), install("foo bar", "apt_install_1")),
+            container(
+                "postinstall",
+                mkdir("/opt/a", "mkdir_2"),
+                {"name": "Create directory /opt/a", "ansible.builtin.file": {"path": "/opt/a", "state": "directory", "mode": "0755"}},
+                install("foo bar", "apt_install_2"),
+                mkdir("/opt/b", "mkdir_3"),
+            ),
+        ]
+        dropped = dedupe_tasks(containers)
+        self.assertEqual([name for container_name, name in dropped], [
+            "Ensure directory /opt/a exists", "Create directory /opt/a", "Install packages: foo bar",
+        ])
+        self.assertEqual(len(containers[0].tasks), 2)
+        self.assertEqual([task["register"] for task in containers[1].tasks], ["mkdir_3"])
+
+    def test_kept(self):
+        touch = {"name": "Ensure file /tmp/x exists", "ansible.builtin.file": {"path": "/tmp/x", "state": "touch"}}
+        cases = {
+            "command between": [{"name": "Run", "ansible.builtin.command": "rm -rf /opt"}],
+            "parent removed": [{"name": "rm", "ansible.builtin.file": {"path": "/opt", "state": "absent"}}],
+            "copied over": [{"name": "cp", "ansible.builtin.copy": {"src": "files/opt", "dest": "/opt/"}}],
+            "package removed": [{"name": "rm", "ansible.builtin.apt": {"name": "bar", "state": "absent"}}],
+        }
+        for case, between in cases.items():
+            with self.subTest(case=case):
+                tasks = [mkdir("/opt/a", "mkdir_1"), install("foo bar", "apt_install_1")]
+                tasks += between
+                tasks += [mkdir("/opt/a", "mkdir_2"), install("foo bar", "apt_install_2")]
+                dropped = [name for container_name, name in dedupe_tasks([container("preinstall", *tasks)])]
+                if case == "command between":
+                    self.assertEqual(dropped, [])
+                elif case == "package removed":
+                    self.assertEqual(dropped, ["Ensure directory /opt/a exists"])
+                else:
+                    self.assertEqual(dropped, ["Install packages: foo bar"])
+        # not idempotent
+        self.assertEqual(dedupe_tasks([container("touch", touch, dict(touch))]), [])
+        # the register is used
+        used = {"name": "Write", "ansible.builtin.copy": {"content": "x", "dest": "/tmp/y"}, "when": "mkdir_2 is succeeded"}
+        self.assertEqual(dedupe_tasks([container("used", mkdir("/opt/a", "mkdir_1"), mkdir("/opt/a", "mkdir_2"), used)]), [])
+        # a hyphenated register, as prefixed with a role name, is used
+        used = {"name": "Write", "ansible.builtin.copy": {"content": "x", "dest": "/tmp/y"}, "when": "my-role_mkdir_2 is succeeded"}
+        self.assertEqual(
+            dedupe_tasks([container("used", mkdir("/opt/a", "my-role_mkdir_1"), mkdir("/opt/a", "my-role_mkdir_2"), used)]),
+            [],
+        )
+        # a different condition
+        conditional = {**mkdir("/opt/a", "mkdir_2"), "when": "sub_role is 'foo.wibble'"}
+        self.assertEqual(dedupe_tasks([container("when", mkdir("/opt/a", "mkdir_1"), conditional)]), [])
+
+    def test_related(self):
+        self.assertTrue(related(("path", "/opt"), ("path", "/opt/a/")))
+        self.assertTrue(related(("path", "/opt/a"), ("path", "/opt")))
+        self.assertFalse(related(("path", "/opt/a"), ("path", "/opt/ab")))
+        self.assertTrue(related(("path", "/opt/a"), ("path", "{{ MYDIR }}/a")))
+        self.assertFalse(related(("path", "/opt"), ("package", "opt")))
+        self.assertTrue(related(("package", None), ("package", "foo")))
+
+    def test_role(self):
+        tmp_dir = temp_dir(self)
+        role_dir = copy_role(tmp_dir)
+        with open(os.path.join(role_dir, "scripts", "preinstall"), "w") as f:
+            f.write("mkdir -p /opt/mydir\napt install bar\n")
+        with open(os.path.join(role_dir, "scripts", "postinstall"), "w") as f:
+            f.write("mkdir -p /opt/mydir\napt install bar\nmkdir -p /opt/other\n")
+        output = os.path.join(tmp_dir, "ansible")
+        config = {
+            **DEFAULT_CONFIG,
+            "input": role_dir,
+            "output": output,
+            "generator": "role",
+            "role_name": "foo",
+            "dedupe_tasks": True,
+        }
+        processor = SlackRoleProcessor(role_dir, os.path.join(output, "roles", "foo"), config)
+        processor.process()
+        postinstall = {tc.name: tc for tc in processor.get_tasks()}["postinstall"]
+        self.assertEqual(
+            [task["name"] for task in postinstall.tasks], ["Ensure directory /opt/other exists"]
+        )
+        with open(os.path.join(output, "roles", "foo", "tasks", "postinstall.yml")) as f:
+            self.assertNotIn("/opt/mydir", f.read())
+
+
+def update(register):
+    return {
+        "name": "Update apt cache",
+        "ansible.builtin.apt": {"update_cache": True},
+        "register": register,
+    }
+
+
+class TestMergePackages(unittest.TestCase):
+    def test_merged(self):
+        task_container = container(
+            "preinstall",
+            update("apt_update_1"),
+            install("foo", "apt_install_1"),
+            install("floob, bar", "apt_install_2"),
+            install("foo", "apt_install_3"),
+        )
+        self.assertEqual(merge_package_tasks([task_container]), 3)
+        self.assertEqual(task_container.tasks[0].as_dict(), {
+            "name": "Install packages: foo floob bar",
+            "ansible.builtin.apt": {"name": ["foo", "floob", "bar"], "state": "present", "update_cache": True},
+            "register": "apt_install_1",
+        })
+
+    def test_runs(self):
+        cases = {
+            "single": [install("foo", "apt_install_1")],
+            "command between": [
+                install("foo", "apt_install_1"),
+                {"name": "Run", "ansible.builtin.command": "foo --init"},
+                install("bar", "apt_install_2"),
+            ],
+            "different when": [
+                install("foo", "apt_install_1"),
+                {**install("bar", "apt_install_2"), "when": "sub_role is 'foo.wibble'"},
+            ],
+            "different options": [
+                install("foo", "apt_install_1"),
+                {
+                    "name": "Install packages: bar",
+                    "ansible.builtin.apt": {"name": "bar", "state": "present", "install_recommends": False},
+                },
+            ],
+            "different module": [
+                install("foo", "apt_install_1"),
+                {"name": "Install packages: bar", "ansible.builtin.yum": {"name": "bar", "state": "present"}},
+            ],
+            "removal": [
+                install("foo", "apt_install_1"),
+                {"name": "Remove bar", "ansible.builtin.apt": {"name": "bar", "state": "absent"}},
+            ],
+            "register used": [
+                install("foo", "apt_install_1"),
+                install("bar", "apt_install_2"),
+                {"name": "Show", "ansible.builtin.debug": {"var": "apt_install_2"}},
+            ],
+            "hyphenated register used": [
+                update("apt-get_update_1"),
+                install("bar", "apt_install_1"),
+                {"name": "Show", "ansible.builtin.debug": {"msg": "updated"}, "when": "apt-get_update_1 is succeeded"},
+            ],
+        }
+        for case, tasks in cases.items():
+            with self.subTest(case=case):
+                task_container = container("preinstall", *tasks)
+                self.assertEqual(merge_package_tasks([task_container]), 0)
+                self.assertEqual([task.as_dict() for task in task_container.tasks], tasks)
+
+    def test_updates(self):
+        task_container = container("preinstall", update("apt_update_1"), update("apt_update_2"))
+        self.assertEqual(merge_package_tasks([task_container]), 1)
+        self.assertEqual([task["register"] for task in task_container.tasks], ["apt_update_1"])
+
+
+def chmod(path, mode, register, **args):
+    return {
+        "name": f"Set permissions of {path} to {mode}",
+        "ansible.builtin.file": {"path": path, "mode": mode, **args},
+        "register": register,
+    }
+
+
+def touch(path, register):
+    return {
+        "name": f"Ensure file {path} exists",
+        "ansible.builtin.file": {"path": path, "state": "touch", "mode": "0644"},
+        "register": register,
+    }
+
+
+def write(path, register, **args):
+    return {
+        "name": f"Write text to {path}",
+        "ansible.builtin.copy": {"dest": path, "content": "hi", **args},
+        "register": register,
+    }
+
+
+class TestCollapseFiles(unittest.TestCase):
+    def test_collapsed(self):
+        chown = {
+            "name": "Set owner of /opt/a",
+            "ansible.builtin.file": {"path": "/opt/a/", "owner": "foo", "group": "bar"},
+            "register": "chown_1",
+        }
+        task_container = container(
+            "preinstall", mkdir("/opt/a", "mkdir_1"), chmod("/opt/a", "700", "chmod_1"), chown
+        )
+        self.assertEqual(collapse_file_tasks([task_container]), 2)
+        self.assertEqual(task_container.tasks[0].as_dict(), {
+            "name": "Ensure directory /opt/a exists; Set permissions of /opt/a to 700; Set owner of /opt/a",
+            "ansible.builtin.file": {
+                "path": "/opt/a", "state": "directory", "mode": "700", "owner": "foo", "group": "bar",
+            },
+            "register": "mkdir_1",
+        })
+
+    def test_kept(self):
+        cases = {
+            "other path": [mkdir("/opt/a", "mkdir_1"), chmod("/opt/b", "700", "chmod_1")],
+            "recursive": [mkdir("/opt/a", "mkdir_1"), chmod("/opt/a", "700", "chmod_1", recurse=True)],
+            "other state": [mkdir("/opt/a", "mkdir_1"), touch("/opt/a", "touch_1")],
+            "different when": [mkdir("/opt/a", "mkdir_1"), {**chmod("/opt/a", "700", "chmod_1"), "when": "x"}],
+            "register used": [
+                mkdir("/opt/a", "mkdir_1"),
+                chmod("/opt/a", "700", "chmod_1"),
+                {"name": "Show", "ansible.builtin.debug": {"var": "chmod_1"}},
+            ],
+        }
+        for case, tasks in cases.items():
+            with self.subTest(case=case):
+                task_container = container("preinstall", *tasks)
+                self.assertEqual(collapse_file_tasks([task_container]), 0)
+                self.assertEqual([task.as_dict() for task in task_container.tasks], tasks)
+
+
+class TestDropTouch(unittest.TestCase):
+    def test_dropped(self):
+        task_container = container("preinstall", touch("/tmp/x", "touch_1"), write("/tmp/x", "write_1", mode="0600"))
+        self.assertEqual(drop_touch_tasks([task_container]), 1)
+        self.assertEqual(task_container.tasks[0].as_dict(), write("/tmp/x", "write_1", mode="0600"))
+        # the touch's mode is kept
+        task_container = container("preinstall", touch("/tmp/x", "touch_1"), write("/tmp/x", "write_1"))
+        drop_touch_tasks([task_container])
+        self.assertEqual(task_container.tasks[0].as_dict(), write("/tmp/x", "write_1", mode="0644"))
+
+    def test_kept(self):
+        cases = {
+            "other path": [touch("/tmp/x", "touch_1"), write("/tmp/y", "write_1")],
+            "copy into directory": [touch("/tmp/x", "touch_1"), write("/tmp/x/", "write_1")],
+            "not forced": [touch("/tmp/x", "touch_1"), write("/tmp/x", "write_1", force=False)],
+            "not straight after": [touch("/tmp/x", "touch_1"), mkdir("/opt/a", "mkdir_1"), write("/tmp/x", "write_1")],
+            "register used": [
+                touch("/tmp/x", "touch_1"),
+                write("/tmp/x", "write_1"),
+                {"name": "Show", "ansible.builtin.debug": {"var": "touch_1"}},
+            ],
+        }
+        for case, tasks in cases.items():
+            with self.subTest(case=case):
+                task_container = container("preinstall", *tasks)
+                self.assertEqual(drop_touch_tasks([task_container]), 0)
+                self.assertEqual([task.as_dict() for task in task_container.tasks], tasks)
+
+
+class TestPassManager(unittest.TestCase):
+    def tasks(self):
+        return [
+            mkdir("/opt/a", "mkdir_1"),
+            chmod("/opt/a", "700", "chmod_1"),
+            touch("/tmp/x", "touch_1"),
+            write("/tmp/x", "write_1"),
+            install("foo", "apt_install_1"),
+            install("bar", "apt_install_2"),
+            mkdir("/opt/a", "mkdir_2"),
+        ]
+
+    def test_from_config(self):
+        everything = {"dedupe_tasks": True, "collapse_file_tasks": True, "drop_touch_tasks": True, "merge_packages": True}
+        self.assertEqual(
+            [task_pass.name for task_pass in PassManager.from_config(everything).passes],
+            ["dedupe", "collapse_files", "drop_touch", "merge_packages"],
+        )
+        passes = PassManager.from_config({**everything, "disabled_passes": ["dedupe", "drop_touch"]})
+        self.assertEqual([task_pass.name for task_pass in passes.passes], ["collapse_files", "merge_packages"])
+        self.assertFalse(passes.spans_containers)
+        self.assertEqual(PassManager.from_config(DEFAULT_CONFIG).passes, [])
+        with self.assertRaises(ValueError):
+            PassManager.from_config({"disabled_passes": ["wibble"]})
+
+    def test_run(self):
+        config = {"dedupe_tasks": True, "collapse_file_tasks": True, "drop_touch_tasks": True, "merge_packages": True}
+        passes = PassManager.from_config(config)
+        task_container = container("preinstall", *self.tasks())
+        stats = passes.run([task_container])
+        self.assertEqual(
+            {name: (pass_stats["tasks_in"], pass_stats["tasks_out"]) for name, pass_stats in stats.items()},
+            {"dedupe": (7, 7), "collapse_files": (7, 6), "drop_touch": (6, 5), "merge_packages": (5, 4)},
+        )
+        report = passes.report().splitlines()
+        self.assertEqual(report[0].split(), ["pass", "runs", "tasks", "in", "tasks", "out", "seconds"])
+        self.assertEqual(report[2].split()[:4], ["collapse_files", "1", "7", "6"])
+        self.assertEqual(len(report), 5)
+
+    def test_logged(self):
+        tmp_dir = temp_dir(self)
+        script = os.path.join(tmp_dir, "script.sh")
+        with open(script, "w") as f:
+            f.write("mkdir -p /opt/a\nchmod 700 /opt/a\n")
+        config = {
+            **DEFAULT_CONFIG,
+            "input": script,
+            "output": os.path.join(tmp_dir, "tasks.yml"),
+            "generator": "role_tasks",
+            "collapse_file_tasks": True,
+        }
+        with self.assertLogs(level="INFO") as logs:
+            ScriptProcessor(script, config).process()
+        report = [output for output in logs.output if "Optimisation passes" in output]
+        self.assertEqual(len(report), 1)
+        self.assertIn(script, report[0])
+        self.assertRegex(report[0], r"collapse_files\s+1\s+2\s+1\s")
+        # nothing is reported without passes
+        with mock.patch("script2ansible.optimise.logging") as logging:
+            ScriptProcessor(script, {**config, "collapse_file_tasks": False}).process()
+        logging.info.assert_not_called()
+
+    def test_untouched(self):
+        # with no passes, streamed tasks stay streamed
+        task_container = TaskContainer("preinstall")
+        task_container.stream(iter(self.tasks()))
+        PassManager.from_config(DEFAULT_CONFIG).run([task_container])
+        self.assertEqual(task_container.size(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
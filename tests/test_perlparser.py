@@ -1,7 +1,11 @@
 import unittest
 import os
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from script2ansible.PerlParser import PerlParser
+from script2ansible.workers import close_pools
 
 
 class TestPerlParser(unittest.TestCase):
@@ -285,6 +289,102 @@ BEGIN {
             taskcontainer.tasks[1]["ansible.builtin.file"]["path"], "/tmp/wobble.txt"
         )
 
+    def test_concurrent_and_chatty(self):
+        script_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, script_dir)
+        scripts = []
+        for i in range(4):
+            script = os.path.join(script_dir, f"script{i}.pl")
+            with open(script, "w") as f:
+                f.write(
+                    f"""
+                    for my $n (1..2000) {{
+                        print "chatter " x 10, "\\n";
+                        print STDERR "more chatter " x 10, "\\n";
+                        mkdir "/tmp/dir{i}_$n";
+                    }}
+                    """
+                )
+            scripts.append(script)
+
+        def parse(script):
+            return PerlParser(file_path=script, config={}).parse().tasks
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(parse, scripts))
+        for i, tasks in enumerate(results):
+            self.assertEqual(len(tasks), 2000)
+            self.assertEqual(tasks[-1]["ansible.builtin.file"]["path"], f"/tmp/dir{i}_2000")
+        # the instrumented scripts are removed
+        self.assertEqual(sorted(os.listdir(script_dir)), [os.path.basename(s) for s in scripts])
+
+    def test_streamed_ops(self):
+        parser = PerlParser(
+            script_string="for my $n (1..100000) { rmdir '/tmp/x'; }", config={}
+        )
+        tasks = parser.stream().iter_tasks()
+        self.assertEqual(next(tasks)["ansible.builtin.file"]["state"], "absent")
+        # abandoned part way, the perl is stopped
+        tasks.close()
+
+
+class TestPerlWorkers(unittest.TestCase):
+    SCRIPTS = [
+        "use File::Path qw(make_path); make_path('/tmp/dir1', '/tmp/dir2');",
+        """
+        use Env qw( $ROOT $VERBOSE STAGE);
+        print "not an op";
+        system("mv ${ROOT}foo_${VERBOSE} $STAGE/bar ");
+        open(my $fh, '>', "/tmp/caf\xc3\xa9");
+        """,
+        """
+        use Org::Turland::Custom qw(file_state);
+        file_state((path => '/tmp/wobble.txt'));
+        """,
+    ]
+
+    def setUp(self):
+        self.addCleanup(close_pools)
+
+    def parse(self, script_string, perl_workers):
+        parser = PerlParser(
+            script_string=script_string, config={"perl_workers": perl_workers}
+        )
+        return parser.parse().tasks
+
+    def test_same_as_one_shot(self):
+        for script_string in self.SCRIPTS:
+            self.assertEqual(self.parse(script_string, 1), self.parse(script_string, 0))
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError) as context:
+            self.parse("use File::Path qw(make_path);\nNOPE make_path('/tmp/dir1');\n", 1)
+        self.assertTrue("Bareword found" in str(context.exception))
+        with self.assertRaises(RuntimeError) as context:
+            self.parse("system('uptime'); exit 3;", 1)
+        self.assertTrue("failed with 3" in str(context.exception))
+        # the worker carries on after a failed script
+        self.assertEqual(len(self.parse(self.SCRIPTS[0], 1)), 2)
+
+    def test_abandoned_stream(self):
+        parser = PerlParser(
+            script_string="for my $n (1..10000) { rmdir '/tmp/x'; }",
+            config={"perl_workers": 1},
+        )
+        tasks = parser.stream().iter_tasks()
+        next(tasks)
+        tasks.close()
+        # the worker skipped the rest of the ops, and can be used again
+        self.assertEqual(len(self.parse(self.SCRIPTS[0], 1)), 2)
+
+    def test_pool(self):
+        with ThreadPoolExecutor(4) as executor:
+            results = list(
+                executor.map(lambda s: self.parse(s, 2), self.SCRIPTS * 4)
+            )
+        expected = [self.parse(s, 0) for s in self.SCRIPTS] * 4
+        self.assertEqual(results, expected)
+
 
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover
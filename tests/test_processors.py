@@ -0,0 +1,173 @@
+import unittest
+import os
+import filecmp
+import json
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.processors import SlackRoleProcessor, SlackRolesProcessor
+from helpers import copy_role, temp_dir
+
+
+class TestSlackRolesProcessor(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.roles_dir = os.path.join(self.tmp_dir, "slack", "roles")
+        for role_name in ("foo", "fab", "fib"):
+            copy_role(self.roles_dir, role_name)
+        # a stray file alongside the roles is ignored
+        with open(os.path.join(self.roles_dir, "README"), "w") as f:
+            f.write("not a role\n")
+
+    def convert(self, name, jobs):
+        output = os.path.join(self.tmp_dir, name)
+        config = {
+            **DEFAULT_CONFIG,
+            "input": self.roles_dir,
+            "output": output,
+            "generator": "role",
+            "jobs": jobs,
+        }
+        processor = SlackRolesProcessor(self.roles_dir, output, config)
+        processor.process()
+        return processor, output
+
+    def assertSameTree(self, left, right):
+        comparison = filecmp.dircmp(left, right)
+        self.assertEqual(comparison.left_only, [])
+        self.assertEqual(comparison.right_only, [])
+        for sub_dir in comparison.common_dirs:
+            self.assertSameTree(
+                os.path.join(left, sub_dir), os.path.join(right, sub_dir)
+            )
+        _, mismatch, errors = filecmp.cmpfiles(
+            left, right, comparison.common_files, shallow=False
+        )
+        self.assertEqual(mismatch + errors, [])
+
+    def test_serial(self):
+        processor, output = self.convert("serial", jobs=1)
+        self.assertEqual(len(processor.results), 3)
+        self.assertEqual(processor.failures(), [])
+        self.assertTrue(
+            os.path.isfile(os.path.join(output, "fab", "tasks", "preinstall.yml"))
+        )
+
+    def test_parallel_matches_serial(self):
+        serial, serial_output = self.convert("serial", jobs=1)
+        parallel, parallel_output = self.convert("parallel", jobs=3)
+        self.assertEqual(serial.results, parallel.results)
+        self.assertSameTree(serial_output, parallel_output)
+
+    def test_failure_is_summarised(self):
+        with open(os.path.join(self.roles_dir, "fib", "scripts", "preinstall"), "w") as f:
+            f.write("if [ ; then\n")
+        processor, _ = self.convert("broken", jobs=2)
+        failures = processor.failures()
+        self.assertEqual([failure["role"] for failure in failures], ["fib"])
+        self.assertEqual(len(processor.results), 3)
+
+
+class TestCopyTasks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.role_dir = copy_role(self.tmp_dir)
+        os.makedirs(os.path.join(self.role_dir, "files.wibble", "opt"))
+
+    def tasks(self, copy_tasks, **kwargs):
+        output = os.path.join(self.tmp_dir, copy_tasks)
+        config = {
+            **DEFAULT_CONFIG,
+            "input": self.role_dir,
+            "output": output,
+            "generator": "role",
+            "role_name": "foo",
+            "copy_tasks": copy_tasks,
+            **kwargs,
+        }
+        processor = SlackRoleProcessor(self.role_dir, os.path.join(output, "roles", "foo"), config)
+        processor.process()
+        return {tc.name: tc.tasks for tc in processor.get_tasks()}
+
+    def test_copy_tasks(self):
+        per_dir = self.tasks("per_dir")
+        self.assertEqual(len(per_dir["foo.wibble"]), 2)
+        loop = self.tasks("loop")
+        # a single directory stays a plain copy
+        self.assertEqual(loop["files"], per_dir["files"])
+        (task,) = loop["foo.wibble"]
+        self.assertEqual(task["ansible.builtin.copy"]["src"], "{{ item.src }}/")
+        self.assertEqual(task["when"], per_dir["foo.wibble"][0]["when"])
+        self.assertEqual(
+            task["loop"],
+            [
+                {"src": t["ansible.builtin.copy"]["src"].rstrip("/"), "dest": t["ansible.builtin.copy"]["dest"]}
+                for t in per_dir["foo.wibble"]
+            ],
+        )
+        synchronize = self.tasks("synchronize")
+        (task,) = synchronize["files"]
+        self.assertEqual(task["name"], "Synchronize foo files")
+        self.assertEqual(task["ansible.posix.synchronize"]["src"], "{{ item.src }}/")
+        self.assertEqual(task["loop"], [{"src": "files/etc", "dest": "/etc"}])
+        with self.assertRaises(ValueError):
+            self.tasks("teleport")
+
+    def test_copy_tasks_layout(self):
+        """
+        every mode copies the same directories' contents to the same dests
+        """
+
+        def copies(tasks):
+            pairs = []
+            for task_list in tasks.values():
+                for task in task_list:
+                    args = task.get("ansible.builtin.copy") or task.get("ansible.posix.synchronize")
+                    if args is None:
+                        continue
+                    for item in task.get("loop") or [{"src": args["src"], "dest": args["dest"]}]:
+                        src = args["src"].replace("{{ item.src }}", item["src"]) if "loop" in task else args["src"]
+                        dest = args["dest"].replace("{{ item.dest }}", item["dest"])
+                        pairs.append((src, dest))
+            return sorted(pairs)
+
+        per_dir = copies(self.tasks("per_dir"))
+        self.assertIn(("files/etc/", "/etc"), per_dir)
+        self.assertEqual(copies(self.tasks("loop")), per_dir)
+        self.assertEqual(copies(self.tasks("synchronize")), per_dir)
+
+    def test_manifests(self):
+        per_dir = self.tasks("per_dir")
+        tasks = self.tasks("per_dir", copy_manifests=True)
+        stat, *copies, mkdir, record = tasks["foo.wibble"]
+        self.assertEqual(stat["register"], "foo_wibble_manifest")
+        self.assertEqual(stat["ansible.builtin.stat"]["path"], "/var/lib/script2ansible/foo/foo.wibble.json")
+        self.assertEqual(stat["when"], "sub_role is 'foo.wibble'")
+        when, changed = record["when"]
+        self.assertEqual(when, "sub_role is 'foo.wibble'")
+        self.assertIn("foo_wibble_manifest.stat.checksum", changed)
+        self.assertEqual(
+            [copy["ansible.builtin.copy"] for copy in copies],
+            [copy["ansible.builtin.copy"] for copy in per_dir["foo.wibble"]],
+        )
+        self.assertEqual({copy["when"][1] for copy in copies} | {mkdir["when"][1]}, {changed})
+        self.assertEqual(record["ansible.builtin.copy"]["src"], "{{ role_path }}/manifests/foo.wibble.json")
+        # the main files/ is unconditional
+        self.assertEqual(tasks["files"][0]["register"], "foo_manifest")
+        self.assertNotIn("when", tasks["files"][0])
+        self.assertIsInstance(tasks["files"][-1]["when"], str)
+
+        manifest_path = os.path.join(self.tmp_dir, "per_dir", "roles", "foo", "manifests", "foo.json")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["copies"], [{"src": "files/etc", "dest": "/etc"}])
+        self.assertEqual([entry["path"] for entry in manifest["files"]], ["etc/flib/flob/config.json"])
+        # unchanged on another run, changed with the content
+        self.assertEqual(self.tasks("per_dir", copy_manifests=True)["files"][-1]["when"], tasks["files"][-1]["when"])
+        with open(os.path.join(self.role_dir, "files", "etc", "flib", "flob", "config.json"), "w") as f:
+            f.write("{}")
+        changed = self.tasks("per_dir", copy_manifests=True)
+        self.assertNotEqual(changed["files"][-1]["when"], tasks["files"][-1]["when"])
+        self.assertEqual(changed["foo.wibble"][-1]["when"], tasks["foo.wibble"][-1]["when"])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
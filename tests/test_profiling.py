@@ -0,0 +1,133 @@
+import unittest
+import json
+import os
+import pstats
+import tracemalloc
+from script2ansible import profiling
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.processors import SlackRolesProcessor
+from script2ansible.profiling import StageProfiler, profile_hooks, profiled, suffixed
+from helpers import copy_role, temp_dir
+
+
+@profiled("double", size=lambda value: value)
+def double(value):
+    return value * 2
+
+
+class TestStageProfiler(unittest.TestCase):
+    def test_inactive(self):
+        self.assertIsNone(profiling.active)
+        self.assertEqual(double(2), 4)
+
+    def test_record(self):
+        profiler = StageProfiler()
+        with profiler.activate():
+            double(3)
+            with profiler.role("foo"):
+                double(4)
+        self.assertIsNone(profiling.active)
+        self.assertEqual(profiler.stages["double"]["calls"], 2)
+        self.assertEqual(profiler.stages["double"]["bytes"], 7)
+        self.assertEqual(profiler.roles["foo"]["stages"]["double"]["bytes"], 4)
+        self.assertGreaterEqual(profiler.roles["foo"]["seconds"], 0)
+
+    def test_merge_and_report(self):
+        profiler = StageProfiler()
+        for role_name, seconds in (("fast", 0.1), ("slow", 2.0), ("middling", 1.0)):
+            other = StageProfiler()
+            with other.role(role_name):
+                other.record("parse_bash", seconds, 10)
+            other.roles[role_name]["seconds"] = seconds
+            # as it comes back from a --jobs worker
+            profiler.merge(json.loads(json.dumps(other.as_dict())))
+        self.assertAlmostEqual(profiler.stages["parse_bash"]["seconds"], 3.1)
+        self.assertEqual((profiler.stages["parse_bash"]["calls"], profiler.stages["parse_bash"]["bytes"]), (3, 30))
+        self.assertEqual([name for name, role in profiler.slowest_roles(2)], ["slow", "middling"])
+        report = profiler.report(2)
+        self.assertIn("parse_bash", report)
+        self.assertIn("slowest 2 of 3 roles", report)
+        self.assertNotIn("fast", report)
+
+
+class TestProfileRoles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.roles_dir = os.path.join(self.tmp_dir, "slack", "roles")
+        for role_name in ("foo", "fab"):
+            copy_role(self.roles_dir, role_name)
+
+    def test_jobs(self):
+        profiles = []
+        for jobs in (1, 2):
+            config = {
+                **DEFAULT_CONFIG,
+                "input": self.roles_dir,
+                "output": os.path.join(self.tmp_dir, f"ansible{jobs}"),
+                "generator": "role",
+                "jobs": jobs,
+                "profile": True,
+            }
+            profiler = StageProfiler()
+            with profiler.activate():
+                processor = SlackRolesProcessor(
+                    self.roles_dir, os.path.join(config["output"], "roles"), config
+                )
+                processor.process()
+            self.assertFalse(processor.failures())
+            self.assertTrue(all("profile" not in result for result in processor.results))
+            profiles.append(profiler)
+        for profiler in profiles:
+            self.assertEqual(set(profiler.roles), {"foo", "fab"})
+            for stage in ("get_parser", "parse_bash", "bash_lex", "stage_files", "generate_role"):
+                self.assertIn(stage, profiler.roles["fab"]["stages"])
+            self.assertEqual(profiler.stages["generate_role"]["calls"], 2)
+            self.assertGreater(profiler.stages["parse_bash"]["bytes"], 0)
+        self.assertEqual(profiles[0].stages["parse_bash"]["bytes"], profiles[1].stages["parse_bash"]["bytes"])
+
+
+class TestProfileHooks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+
+    def test_suffixed(self):
+        self.assertEqual(suffixed("out.pstats", "foo"), "out.foo.pstats")
+        self.assertEqual(suffixed("out", "foo"), "out.foo")
+        self.assertEqual(suffixed("out.pstats", None), "out.pstats")
+
+    def test_off(self):
+        with profile_hooks(DEFAULT_CONFIG):
+            double(1)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_hooks(self):
+        out = os.path.join(self.tmp_dir, "out.pstats")
+        config = {**DEFAULT_CONFIG, "cprofile": out, "tracemalloc": True}
+        with self.assertLogs(level="INFO") as logs:
+            with profile_hooks(config, "foo"):
+                double(21)
+        self.assertFalse(tracemalloc.is_tracing())
+        stats = pstats.Stats(os.path.join(self.tmp_dir, "out.foo.pstats"))
+        self.assertTrue(any(name == "double" for (path, line, name) in stats.stats))
+        self.assertTrue(any("Peak traced memory of foo" in line for line in logs.output))
+
+    def test_roles(self):
+        roles_dir = os.path.join(self.tmp_dir, "slack", "roles")
+        for role_name in ("foo", "fab"):
+            copy_role(roles_dir, role_name)
+        config = {
+            **DEFAULT_CONFIG,
+            "input": roles_dir,
+            "output": os.path.join(self.tmp_dir, "ansible"),
+            "generator": "role",
+            "cprofile": os.path.join(self.tmp_dir, "out.pstats"),
+        }
+        SlackRolesProcessor(roles_dir, os.path.join(config["output"], "roles"), config).process()
+        for role_name in ("foo", "fab"):
+            stats = pstats.Stats(os.path.join(self.tmp_dir, f"out.{role_name}.pstats"))
+            self.assertTrue(any(name == "process_files" for (path, line, name) in stats.stats))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,202 @@
+import unittest
+import errno
+import os
+import shutil
+from unittest import mock
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.processors import SlackRoleProcessor
+from script2ansible.staging import Stager, STAGE_MODES
+from helpers import EXAMPLE_ROLE, copy_role, temp_dir
+
+
+class TestStager(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.src = os.path.join(self.tmp_dir, "src.conf")
+        with open(self.src, "w") as f:
+            f.write("setting = 1\n")
+        os.chmod(self.src, 0o640)
+        self.dst = os.path.join(self.tmp_dir, "dst.conf")
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_modes(self):
+        for mode in STAGE_MODES:
+            with self.subTest(mode=mode):
+                Stager(mode)(self.src, self.dst)
+                self.assertEqual(self.read(self.dst), "setting = 1\n")
+                self.assertEqual(os.stat(self.dst).st_mode & 0o777, 0o640)
+                same_file = os.path.samefile(self.src, self.dst)
+                self.assertEqual(same_file, mode in ("hardlink", "symlink"))
+                self.assertEqual(os.path.islink(self.dst), mode == "symlink")
+
+    def test_restage_does_not_write_through_links(self):
+        Stager("hardlink")(self.src, self.dst)
+        other = os.path.join(self.tmp_dir, "other.conf")
+        with open(other, "w") as f:
+            f.write("other\n")
+        Stager("copy")(other, self.dst)
+        self.assertEqual(self.read(self.dst), "other\n")
+        self.assertEqual(self.read(self.src), "setting = 1\n")
+
+    def test_fallback(self):
+        stager = Stager("hardlink")
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "cross device")):
+            stager(self.src, self.dst)
+        self.assertEqual(self.read(self.dst), "setting = 1\n")
+        self.assertFalse(os.path.samefile(self.src, self.dst))
+        self.assertEqual((stager.mode, stager.fallbacks), ("copy", 1))
+
+    def test_from_config(self):
+        # a config without the keys gets the defaults
+        stager = Stager.from_config({})
+        self.assertEqual((stager.mode, stager.workers), ("copy", DEFAULT_CONFIG["copy_workers"]))
+        self.assertEqual(Stager.from_config({"copy_workers": 0}).workers, os.cpu_count())
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            Stager("teleport")
+
+    def test_role(self):
+        outputs = {}
+        for mode in STAGE_MODES:
+            output = os.path.join(self.tmp_dir, mode)
+            config = {
+                **DEFAULT_CONFIG,
+                "input": EXAMPLE_ROLE,
+                "output": output,
+                "generator": "role",
+                "role_name": "foo",
+                "stage_mode": mode,
+            }
+            role_output_dir = os.path.join(output, "roles", "foo")
+            SlackRoleProcessor(EXAMPLE_ROLE, role_output_dir, config).process()
+            files = {}
+            for dir_path, dir_names, file_names in os.walk(os.path.join(role_output_dir, "files")):
+                for file_name in file_names:
+                    path = os.path.join(dir_path, file_name)
+                    files[os.path.relpath(path, output)] = self.read(path)
+            self.assertTrue(files)
+            outputs[mode] = files
+        for mode in STAGE_MODES:
+            self.assertEqual(outputs[mode], outputs["copy"])
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.src = os.path.join(self.tmp_dir, "src")
+        self.dst = os.path.join(self.tmp_dir, "dst")
+        self.write("a.conf", "a\n")
+        self.write("sub/b.conf", "b\n")
+        self.write("sub/deeper/c.conf", "c\n")
+        os.symlink("/nowhere", os.path.join(self.src, "dangling"))
+
+    def write(self, name, text):
+        path = os.path.join(self.src, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def sync(self, mode="copy", checksum=False):
+        stager = Stager(mode, checksum)
+        stager.sync_tree(self.src, self.dst)
+        return stager.copied, stager.skipped, stager.removed
+
+    def listing(self, root):
+        found = {}
+        for dir_path, dir_names, file_names in os.walk(root):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                if os.path.exists(path):
+                    with open(path) as f:
+                        found[os.path.relpath(path, root)] = f.read()
+        return found
+
+    def test_sync(self):
+        self.assertEqual(self.sync(), (3, 0, 0))
+        self.assertEqual(self.listing(self.dst), self.listing(self.src))
+        self.assertEqual(self.sync(), (0, 3, 0))
+        # same size, another mtime
+        self.write("a.conf", "A\n")
+        os.utime(os.path.join(self.src, "a.conf"), (0, 10))
+        os.remove(os.path.join(self.src, "sub", "deeper", "c.conf"))
+        self.write("sub/new.conf", "new\n")
+        self.assertEqual(self.sync(), (2, 1, 1))
+        self.assertEqual(self.listing(self.dst), self.listing(self.src))
+        shutil.rmtree(os.path.join(self.src, "sub"))
+        self.assertEqual(self.sync(), (0, 1, 2))
+        self.assertEqual(self.listing(self.dst), {"a.conf": "A\n"})
+
+    def test_permissions_change(self):
+        self.sync()
+        os.chmod(os.path.join(self.src, "a.conf"), 0o600)
+        self.assertEqual(self.sync(), (1, 2, 0))
+        self.assertEqual(os.stat(os.path.join(self.dst, "a.conf")).st_mode & 0o777, 0o600)
+
+    def test_checksum(self):
+        self.sync()
+        # same content, different mtime
+        os.utime(os.path.join(self.src, "a.conf"), (0, 0))
+        self.assertEqual(self.sync(checksum=True), (0, 3, 0))
+        self.assertEqual(self.sync(), (1, 2, 0))
+
+    def test_mode_change(self):
+        self.assertEqual(self.sync("symlink"), (3, 0, 0))
+        self.assertEqual(self.sync("symlink"), (0, 3, 0))
+        self.assertEqual(self.sync("copy"), (3, 0, 0))
+        self.assertFalse(os.path.islink(os.path.join(self.dst, "a.conf")))
+        self.assertEqual(self.sync("hardlink"), (0, 3, 0))
+
+    def test_threads(self):
+        for n in range(50):
+            self.write(f"many/d{n % 7}/f{n}.conf", f"{n}\n")
+        os.chmod(os.path.join(self.src, "many", "d3"), 0o750)
+        stager = Stager("copy", workers=8)
+        stager.sync_trees([(self.src, self.dst), (os.path.join(self.src, "sub"), os.path.join(self.tmp_dir, "sub"))])
+        self.assertEqual((stager.copied, stager.skipped), (55, 0))
+        self.assertEqual(self.listing(self.dst), self.listing(self.src))
+        self.assertEqual(os.stat(os.path.join(self.dst, "many", "d3")).st_mode & 0o777, 0o750)
+        stager = Stager("hardlink", workers=8)
+        with mock.patch("os.link", side_effect=OSError(errno.EXDEV, "cross device")):
+            stager.sync_tree(self.src, os.path.join(self.tmp_dir, "linked"))
+        self.assertEqual(self.listing(os.path.join(self.tmp_dir, "linked")), self.listing(self.src))
+        self.assertEqual(stager.mode, "copy")
+        self.assertGreaterEqual(stager.fallbacks, 1)
+
+    def test_role_resync(self):
+        role_dir = copy_role(self.tmp_dir)
+        output = os.path.join(self.tmp_dir, "ansible")
+        config = {
+            **DEFAULT_CONFIG,
+            "input": role_dir,
+            "output": output,
+            "generator": "role",
+            "role_name": "foo",
+        }
+        files_dir = os.path.join(output, "roles", "foo", "files")
+        processor = SlackRoleProcessor(role_dir, os.path.join(output, "roles", "foo"), config)
+        processor.process()
+        staged = self.listing(files_dir)
+        self.assertEqual(processor.stager.copied, len(staged))
+        processor.process()
+        self.assertEqual(processor.stager.copied, 0)
+        self.assertEqual(processor.stager.skipped, len(staged))
+        # a top level directory dropped from the main files/, subroles are kept
+        top = [
+            name
+            for name in os.listdir(os.path.join(role_dir, "files"))
+            if os.path.isdir(os.path.join(role_dir, "files", name))
+        ]
+        shutil.rmtree(os.path.join(role_dir, "files", top[0]))
+        processor.process()
+        self.assertFalse(os.path.exists(os.path.join(files_dir, top[0])))
+        self.assertTrue(any(name.startswith("foo.") for name in os.listdir(files_dir)))
+        self.assertEqual(processor.stager.copied, 0)
+        self.assertGreater(processor.stager.removed, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,76 @@
+import unittest
+import json
+import pickle
+import sys
+from script2ansible.generators import dump_yaml
+from script2ansible.utility import Task, TaskContainer, to_plain
+
+
+class TestTask(unittest.TestCase):
+    def setUp(self):
+        self.plain = {
+            "name": "Run ldconfig",
+            "when": "x is changed",
+            "ansible.builtin.command": "ldconfig",
+            "changed_when": "false",
+            "register": "ldconfig_1",
+        }
+        self.task = Task(self.plain)
+
+    def test_mapping(self):
+        self.assertEqual(self.task, self.plain)
+        self.assertEqual(self.plain, self.task)
+        self.assertEqual(self.task.module, "ansible.builtin.command")
+        self.assertEqual(self.task.args, "ldconfig")
+        self.assertEqual(self.task.extras, {"changed_when": "false"})
+        self.assertEqual(len(self.task), 5)
+        self.assertNotIn("loop", self.task)
+        self.assertIsNone(self.task.get("loop"))
+        with self.assertRaises(KeyError):
+            self.task["loop"]
+        self.task["loop"] = [1, 2]
+        self.task["ansible.builtin.command"] = "ldconfig -v"
+        self.assertEqual(self.task.args, "ldconfig -v")
+        del self.task["changed_when"]
+        del self.task["when"]
+        self.assertIsNone(self.task.extras)
+        with self.assertRaises(KeyError):
+            del self.task["when"]
+        self.assertEqual(
+            self.task.as_dict(),
+            {"name": "Run ldconfig", "ansible.builtin.command": "ldconfig -v", "register": "ldconfig_1", "loop": [1, 2]},
+        )
+
+    def test_order(self):
+        # the canonical order, whatever the order given
+        self.assertEqual(
+            list(self.task),
+            ["name", "ansible.builtin.command", "register", "changed_when", "when"],
+        )
+        self.assertEqual(list(Task({"args": {}, "shell": "ls"})), ["shell", "args"])
+
+    def test_module_interned(self):
+        module = "".join(["ansible.builtin.", "file"])
+        self.assertIs(Task({module: {}}).module, sys.intern("ansible.builtin.file"))
+
+    def test_serialise(self):
+        self.assertEqual(json.dumps([self.task], default=to_plain), json.dumps([dict(self.task)]))
+        with self.assertRaises(TypeError):
+            json.dumps(object(), default=to_plain)
+        self.assertEqual(dump_yaml([self.task]), dump_yaml([dict(self.task)]))
+        self.assertEqual(pickle.loads(pickle.dumps(self.task)), self.task)
+
+    def test_container(self):
+        task_container = TaskContainer("tasks")
+        task_container.add_task(dict(self.plain))
+        task_container.add_task(self.task)
+        self.assertIsInstance(task_container.tasks[0], Task)
+        self.assertIs(task_container.tasks[1], self.task)
+        task_container.tasks = [self.plain]
+        self.assertIsInstance(task_container.tasks[0], Task)
+        task_container.stream(iter([self.plain]))
+        self.assertIsInstance(task_container.tasks[-1], Task)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
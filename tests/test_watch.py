@@ -0,0 +1,166 @@
+import unittest
+import os
+import shutil
+from unittest import mock
+from script2ansible.config import DEFAULT_CONFIG
+from script2ansible.processors import SlackRoleProcessor, SlackRolesProcessor
+from script2ansible import watch
+from script2ansible.watch import Watcher, restat, snapshot
+from helpers import copy_role, temp_dir
+
+
+class TestWatcher(unittest.TestCase):
+    INOTIFY = True
+
+    def setUp(self):
+        self.tmp_dir = temp_dir(self)
+        self.roles_dir = os.path.join(self.tmp_dir, "slack", "roles")
+        self.role_dir = copy_role(self.roles_dir)
+        self.output = os.path.join(self.tmp_dir, "ansible")
+        self.config = {
+            **DEFAULT_CONFIG,
+            "input": self.role_dir,
+            "output": self.output,
+            "generator": "role",
+            "role_name": "foo",
+            "watch_inotify": self.INOTIFY,
+        }
+        self.role_output_dir = os.path.join(self.output, "roles", "foo")
+        self.processor = SlackRoleProcessor(self.role_dir, self.role_output_dir, self.config)
+        self.processor.process()
+        self.watcher = Watcher(self.config)
+        self.watcher.add(self.processor)
+        self.addCleanup(self.watcher.remove, self.processor)
+
+    def task_file(self, name):
+        return os.path.join(self.role_output_dir, "tasks", f"{name}.yml")
+
+    def test_nothing_changed(self):
+        self.assertEqual(self.watcher.poll(), set())
+
+    def test_script_change(self):
+        os.utime(self.task_file("files"), (0, 0))
+        with open(os.path.join(self.role_dir, "scripts", "preinstall"), "a") as f:
+            f.write("\ntouch /tmp/watched.txt\n")
+        self.assertEqual(self.watcher.poll(), {"preinstall"})
+        with open(self.task_file("preinstall")) as f:
+            self.assertIn("/tmp/watched.txt", f.read())
+        # untouched task files are not rewritten
+        self.assertEqual(os.stat(self.task_file("files")).st_mtime, 0)
+        self.assertEqual(self.watcher.poll(), set())
+
+    def test_subrole_file_change(self):
+        new_dir = os.path.join(self.role_dir, "files.wibble", "opt")
+        os.makedirs(new_dir)
+        with open(os.path.join(new_dir, "new.conf"), "w") as f:
+            f.write("new\n")
+        self.assertEqual(self.watcher.poll(), {"foo.wibble"})
+        with open(self.task_file("foo.wibble")) as f:
+            self.assertIn("dest: /opt", f.read())
+
+    def test_new_subrole(self):
+        new_dir = os.path.join(self.role_dir, "files.wubble", "etc")
+        os.makedirs(new_dir)
+        with open(os.path.join(new_dir, "wubble.conf"), "w") as f:
+            f.write("wubble\n")
+        self.assertEqual(self.watcher.poll(), {"foo.wubble"})
+        self.assertTrue(os.path.isfile(self.task_file("foo.wubble")))
+        with open(self.task_file("main")) as f:
+            self.assertIn("foo.wubble.yml", f.read())
+
+    def test_new_role(self):
+        config = {**self.config, "input": self.roles_dir}
+        del config["role_name"]
+        output_root = os.path.join(self.tmp_dir, "watched")
+        watcher = Watcher(config, roles=SlackRolesProcessor(self.roles_dir, output_root, config))
+        watcher.start()
+        self.assertEqual(len(watcher.processors), 1)
+        copy_role(self.roles_dir, "bar")
+        watcher.poll()
+        self.assertEqual(len(watcher.processors), 2)
+        self.assertTrue(
+            os.path.isfile(os.path.join(output_root, "bar", "tasks", "preinstall.yml"))
+        )
+
+    def test_role_removed_while_listed(self):
+        config = {**self.config, "input": self.roles_dir}
+        del config["role_name"]
+        roles = SlackRolesProcessor(self.roles_dir, os.path.join(self.tmp_dir, "watched"), config)
+        watcher = Watcher(config, roles=roles)
+        gone = os.path.join(self.roles_dir, "gone")
+        listed = list(roles.get_roles()) + [(gone, os.path.join(self.tmp_dir, "gone"), {**config, "role_name": "gone"})]
+        with mock.patch.object(roles, "get_roles", return_value=listed):
+            watcher.start()
+        self.assertEqual(list(watcher.role_processors), [self.role_dir])
+
+    def test_replaced_script(self):
+        # as editors save, write a new file then rename it over the old
+        path = os.path.join(self.role_dir, "scripts", "preinstall")
+        with open(path + ".swp", "w") as f:
+            f.write("touch /tmp/replaced.txt\n")
+        os.replace(path + ".swp", path)
+        self.assertEqual(self.watcher.poll(), {"preinstall"})
+
+    def test_removed_subrole_dir(self):
+        shutil.rmtree(os.path.join(self.role_dir, "files.wibble", "opt"), ignore_errors=True)
+        os.makedirs(os.path.join(self.role_dir, "files.wibble", "opt", "a"))
+        with open(os.path.join(self.role_dir, "files.wibble", "opt", "a", "a.conf"), "w") as f:
+            f.write("a\n")
+        self.assertEqual(self.watcher.poll(), {"foo.wibble"})
+        shutil.rmtree(os.path.join(self.role_dir, "files.wibble", "opt"))
+        self.assertEqual(self.watcher.poll(), {"foo.wibble"})
+        with open(self.task_file("foo.wibble")) as f:
+            self.assertNotIn("/opt", f.read())
+
+    def test_polls_by_events(self):
+        if not self.watcher.inotify:
+            self.skipTest("polling")
+        self.assertIn(self.processor, self.watcher.events)
+        # nothing is walked or stat'ed when nothing changed
+        with mock.patch.object(watch, "snapshot", wraps=snapshot) as walk:
+            self.assertEqual(self.watcher.poll(), set())
+            walk.assert_not_called()
+            with open(os.path.join(self.role_dir, "scripts", "preinstall"), "a") as f:
+                f.write("\ntouch /tmp/watched.txt\n")
+            self.assertEqual(self.watcher.poll(), {"preinstall"})
+            self.assertEqual(
+                [call.args[0] for call in walk.call_args_list],
+                [[os.path.join(self.role_dir, "scripts", "preinstall")]],
+            )
+
+    def test_lost_events(self):
+        if not self.watcher.inotify:
+            self.skipTest("polling")
+        self.watcher.events[self.processor].lost = True
+        with mock.patch.object(watch, "snapshot", wraps=snapshot) as walk:
+            self.assertEqual(self.watcher.poll(), set())
+            walk.assert_called_once()
+        self.assertFalse(self.watcher.events[self.processor].lost)
+
+
+class TestWatcherPolling(TestWatcher):
+    INOTIFY = False
+
+
+class TestRestat(unittest.TestCase):
+    def test_restat(self):
+        tmp_dir = temp_dir(self)
+        os.makedirs(os.path.join(tmp_dir, "a", "b"))
+        for name in ("a/x", "a/b/y", "z"):
+            with open(os.path.join(tmp_dir, name), "w") as f:
+                f.write(name)
+        state = snapshot([tmp_dir])
+        with open(os.path.join(tmp_dir, "a", "x"), "a") as f:
+            f.write("more")
+        self.assertEqual(restat(state, os.path.join(tmp_dir, "a", "x")), {os.path.join(tmp_dir, "a", "x")})
+        self.assertEqual(restat(state, os.path.join(tmp_dir, "z")), set())
+        shutil.rmtree(os.path.join(tmp_dir, "a"))
+        self.assertEqual(
+            restat(state, os.path.join(tmp_dir, "a")),
+            {os.path.join(tmp_dir, "a", "x"), os.path.join(tmp_dir, "a", "b", "y")},
+        )
+        self.assertEqual(state, snapshot([tmp_dir]))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover